@@ -0,0 +1,12 @@
+"""Benchmarks offline do bot, rode a partir da raiz do repositório com `python -m benchmarks.<módulo>`"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# O main.py exige SHEETS_FILE no import
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.environ.setdefault('SHEETS_FILE', str(Path(tempfile.gettempdir()) / 'bench_sheets.csv'))
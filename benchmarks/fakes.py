@@ -0,0 +1,98 @@
+"""Substitutos dos objetos do discord.py, só com o que os comandos do bot usam, guardando tudo que é enviado"""
+from itertools import count
+from typing import List, Optional
+
+_ids = count(1)
+
+
+class FakeMessage:
+    def __init__(self, content: str = '', author: 'FakeUser' = None, guild: 'FakeGuild' = None,
+                 channel: 'FakeChannel' = None, attachments: List['FakeAttachment'] = (), file=None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.attachments = list(attachments)
+        self.file = file
+        self.deleted = False
+        # ConnectionState do bot, só necessário quando a mensagem passa pelo bot.process_commands
+        self._state = None
+
+    async def delete(self):
+        self.deleted = True
+
+
+class _FakeDestination:
+    def __init__(self):
+        self.id = next(_ids)
+        self.sent = []  # type: List[FakeMessage]
+
+    async def send(self, content: Optional[str] = None, *, file=None, **kwargs):
+        if file is not None:
+            # Como no envio de verdade, o arquivo é lido inteiro
+            file.fp.read()
+        message = FakeMessage(content=content, file=file)
+        self.sent.append(message)
+        return message
+
+
+class FakeUser(_FakeDestination):
+    def __init__(self, user_id: int = None, bot: bool = False):
+        super().__init__()
+        if user_id is not None:
+            self.id = user_id
+        self.bot = bot
+        self.name = f'user{self.id}'
+        self.mention = f'<@{self.id}>'
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel(_FakeDestination):
+    def __init__(self, guild: 'FakeGuild' = None):
+        super().__init__()
+        self.guild = guild
+        self.name = f'channel{self.id}'
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = None):
+        self.id = next(_ids) if guild_id is None else guild_id
+        self.name = f'guild{self.id}'
+
+    def get_member(self, user_id: int):
+        # Sem o cache de membros, como um bot sem o intent de membros
+        return None
+
+    def __str__(self):
+        return self.name
+
+
+class FakeAttachment:
+    def __init__(self, data: bytes, filename: str = 'ficha.pdf'):
+        self.data = data
+        self.filename = filename
+        self.size = len(data)
+
+    async def read(self) -> bytes:
+        return self.data
+
+    async def save(self, fp):
+        fp.write(self.data)
+        return len(self.data)
+
+
+class FakeContext:
+    """O suficiente de um commands.Context para chamar os comandos diretamente"""
+
+    def __init__(self, guild: FakeGuild = None, author: FakeUser = None, content: str = '',
+                 attachments: List[FakeAttachment] = ()):
+        self.guild = guild or FakeGuild()
+        self.author = author or FakeUser()
+        self.channel = FakeChannel(self.guild)
+        self.message = FakeMessage(content, self.author, self.guild, self.channel, attachments)
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        return await self.channel.send(content, **kwargs)
@@ -0,0 +1,64 @@
+"""Gera PDFs com os campos de formulário (AcroForm) que o `_read_sheet_from_pdf` lê, sem depender de uma ficha real"""
+import random
+from typing import List, Optional, Tuple
+
+from main import IMPORTANT_FIELDS
+
+DISCIPLINAS_PDF = ['Animalismo', 'Auspícios', 'Celeridade', 'Dominação', 'Fortitude', 'Ofuscação', 'Potência',
+                   'Presença']
+
+
+def _pdf_string(text: str) -> bytes:
+    data = text.encode('latin-1')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def sheet_fields(rng: random.Random) -> List[Tuple[str, bytes, Optional[bytes]]]:
+    """Campos (nome, tipo, valor) de uma ficha aleatória"""
+    fields = []
+    for field, qtd in IMPORTANT_FIELDS:
+        level = rng.randint(0, qtd)
+        for i, suffix in enumerate([''] + list(range(1, qtd))):
+            fields.append((f'{field}{suffix}', b'/Btn', b'/Sim' if i < level else b'/Off'))
+    disciplinas = rng.sample(DISCIPLINAS_PDF, rng.randint(0, 6))
+    for i, (disciplina_suffix, level_suffix) in enumerate(zip([''] + list(range(1, 6)), 'ACEBDF')):
+        name = _pdf_string(disciplinas[i]) if i < len(disciplinas) else None
+        fields.append((f'Nome da Disciplina{disciplina_suffix}', b'/Tx', name))
+        for power_suffix in [''] + list(range(1, 5)):
+            fields.append((f'Poder{level_suffix}{power_suffix}', b'/Btn', b'/Sim' if rng.random() < .5 else b'/Off'))
+    return fields
+
+
+def fillable_pdf(rng: random.Random = None, extra_fields: int = 0,
+                 fields: List[Tuple[str, bytes, Optional[bytes]]] = None) -> bytes:
+    """PDF de uma página com os campos da ficha, `extra_fields` adiciona campos que o bot ignora.
+
+    `fields` substitui os campos sorteados, para gerar fichas com campos faltando ou repetidos.
+    """
+    rng = rng or random.Random()
+    if fields is None:
+        fields = sheet_fields(rng)
+    fields = fields + [(f'Anotação{i}', b'/Tx', _pdf_string('x' * 20)) for i in range(extra_fields)]
+    first_field = 4
+    refs = b' '.join(b'%d 0 R' % (first_field + i) for i in range(len(fields)))
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R /AcroForm << /Fields [' + refs + b'] >> >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>',
+    ]
+    for name, field_type, value in fields:
+        obj = b'<< /FT ' + field_type + b' /T ' + _pdf_string(name)
+        if value is not None:
+            obj += b' /V ' + value
+        objects.append(obj + b' >>')
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + obj + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
@@ -0,0 +1,306 @@
+"""Carga sobre o pipeline completo de comandos, com o transporte do Discord substituído por um stub local.
+
+Uso: python -m benchmarks.replay [--taxa 200] [--duracao 10] [--backend csv|sqlite] [--latencia-envio 0.05]
+                                 [--gravar fluxo.jsonl | --reproduzir fluxo.jsonl] [--saida relatorio.json]
+                                 [--orcamento-loop 0.1]
+
+As mensagens, sintéticas ou gravadas, chegam nos seus instantes a partir de vários servidores e jogadores e passam
+pelo bot.get_context e bot.invoke como no on_message. Os envios dos canais passam pela fila de saída e pelo
+Messageable.send do discord.py até o stub do HTTPClient, as DMs vão direto para o stub. No fim são mostrados a vazão
+sustentada, a latência por comando, os travamentos do event loop e o resumo do METRICS. Com --orcamento-loop o
+WATCHDOG roda no modo estrito e os comandos que travarem o loop além do orçamento aparecem nos erros como
+LoopBudgetExceeded.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+from asyncio import create_task, gather, sleep, Event
+from collections import Counter, defaultdict, namedtuple
+from pathlib import Path
+from time import perf_counter
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+import main
+from benchmarks import ROOT
+from benchmarks.fakes import FakeAttachment, FakeChannel, FakeGuild, FakeMessage, FakeUser
+from benchmarks.pdfs import fillable_pdf
+from benchmarks.suite import write_synthetic_stores
+
+ReplayEvent = namedtuple('ReplayEvent', ['t', 'guild', 'user', 'mensagem', 'anexo_pdf'])
+
+# (modelo da mensagem, peso) dos fluxos sintéticos
+COMMAND_MIX = [
+    ('%roll5e {parada} {fome} {dificuldade}', 30),
+    ('%roll5f força+briga fome {dificuldade}', 20),
+    ('%setf fome {fome}', 15),
+    ('%rcf', 15),
+    ('%roll 4d6kh3+1d8+2', 10),
+    ('%getf fome', 5),
+    ('%ficha', 5),
+]
+
+
+def synthetic_stream(keys: List[tuple], rate: float, duration: float, seed: int = 0) -> List[ReplayEvent]:
+    """Chegadas de Poisson com `rate` mensagens por segundo, de jogadores que já têm ficha"""
+    rng = random.Random(seed)
+    templates = [x for x, _ in COMMAND_MIX]
+    weights = [x for _, x in COMMAND_MIX]
+    events = []
+    t = rng.expovariate(rate)
+    while t < duration:
+        guild, user, _ = rng.choice(keys)
+        template = rng.choices(templates, weights)[0]
+        mensagem = template.format(parada=rng.randint(1, 15), fome=rng.randint(0, 5), dificuldade=rng.randint(0, 6))
+        events.append(ReplayEvent(t, int(guild), int(user), mensagem, template == '%ficha'))
+        t += rng.expovariate(rate)
+    return events
+
+
+def write_stream(events: Iterable[ReplayEvent], path: Path):
+    with path.open('w') as fp:
+        for event in events:
+            fp.write(json.dumps(event._asdict(), ensure_ascii=False) + '\n')
+
+
+def read_stream(path: Path) -> List[ReplayEvent]:
+    with path.open() as fp:
+        return [ReplayEvent(**json.loads(line)) for line in fp if line.strip()]
+
+
+class StubTransport:
+    """Faz o papel do HTTPClient e das DMs, com uma latência fixa por envio"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.channel_sends = 0
+        self.direct_sends = 0
+        self.files = 0
+        self.bytes = 0
+        self.deleted = 0
+        self._ids = 1 << 40
+
+    def _payload(self, channel_id, content) -> dict:
+        self._ids += 1
+        return {
+            'id': self._ids, 'channel_id': channel_id, 'content': content or '', 'attachments': [], 'embeds': [],
+            'edited_timestamp': None, 'type': 0, 'pinned': False, 'mention_everyone': False, 'tts': False,
+            'author': {'id': 1, 'username': 'bot', 'discriminator': '0000', 'avatar': None, 'bot': True},
+        }
+
+    async def send_message(self, channel_id, content, **kwargs):
+        self.channel_sends += 1
+        await sleep(self.latency)
+        return self._payload(channel_id, content)
+
+    async def send_files(self, channel_id, *, files, content=None, **kwargs):
+        self.channel_sends += 1
+        for file in files:
+            self.files += 1
+            self.bytes += len(file.fp.read())
+        await sleep(self.latency)
+        return self._payload(channel_id, content)
+
+    async def send_direct(self, content=None, **kwargs):
+        self.direct_sends += 1
+        await sleep(self.latency)
+
+
+class ReplayUser(FakeUser):
+    def __init__(self, user_id: int, transport: StubTransport):
+        super().__init__(user_id)
+        self.transport = transport
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        await self.transport.send_direct(content, **kwargs)
+
+
+class ReplayMessage(FakeMessage):
+    def __init__(self, transport: StubTransport, **kwargs):
+        super().__init__(**kwargs)
+        self.transport = transport
+
+    async def delete(self):
+        self.transport.deleted += 1
+        await sleep(self.transport.latency)
+
+
+class Replay:
+    def __init__(self, transport: StubTransport, pdfs: List[bytes], stall_threshold: float):
+        self.transport = transport
+        self.pdfs = pdfs
+        self.stall_threshold = stall_threshold
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.loop_lag = []  # type: List[float]
+        self._guilds = {}
+        self._channels = {}
+        self._users = {}
+        self._bot_user = FakeUser(1 << 62, bot=True)
+
+    def install(self):
+        main.bot.http = self.transport
+        main.bot._connection.http = self.transport
+        main.bot._connection.user = self._bot_user
+        main.bot.add_listener(self.on_command_error, 'on_command_error')
+
+    async def on_command_error(self, ctx, error):
+        self.errors[f'{ctx.command} {type(getattr(error, "original", error)).__name__}'] += 1
+
+    def _message(self, event: ReplayEvent) -> ReplayMessage:
+        guild = self._guilds.get(event.guild)
+        if guild is None:
+            guild = self._guilds[event.guild] = FakeGuild(event.guild)
+            self._channels[event.guild] = FakeChannel(guild)
+        user = self._users.get(event.user)
+        if user is None:
+            user = self._users[event.user] = ReplayUser(event.user, self.transport)
+        attachments = [FakeAttachment(random.choice(self.pdfs))] if event.anexo_pdf else []
+        message = ReplayMessage(self.transport, content=event.mensagem, author=user, guild=guild,
+                                channel=self._channels[event.guild], attachments=attachments)
+        message._state = main.bot._connection
+        return message
+
+    async def dispatch(self, event: ReplayEvent):
+        message = self._message(event)
+        start = perf_counter()
+        ctx = await main.bot.get_context(message)
+        await main.bot.invoke(ctx)
+        name = ctx.command.name if ctx.command is not None else '?'
+        self.latencies[name].append(perf_counter() - start)
+
+    async def watch_loop(self, stop: Event, interval: float = 0.005):
+        while not stop.is_set():
+            start = perf_counter()
+            await sleep(interval)
+            self.loop_lag.append(perf_counter() - start - interval)
+
+    async def run(self, events: List[ReplayEvent]) -> float:
+        stop = Event()
+        watcher = create_task(self.watch_loop(stop))
+        tasks = []
+        start = perf_counter()
+        for event in events:
+            delay = start + event.t - perf_counter()
+            if delay > 0:
+                await sleep(delay)
+            tasks.append(create_task(self.dispatch(event)))
+        await gather(*tasks)
+        await main.OUTBOUND.drain()
+        elapsed = perf_counter() - start
+        stop.set()
+        await watcher
+        return elapsed
+
+    def report(self, elapsed: float, offered: int) -> dict:
+        lag = np.array(self.loop_lag or [0.])
+        stalls = lag[lag >= self.stall_threshold]
+        total = sum(len(x) for x in self.latencies.values())
+        return {
+            'mensagens': offered,
+            'duracao_s': elapsed,
+            'comandos_s': total / elapsed,
+            'envios_canal': self.transport.channel_sends,
+            'envios_dm': self.transport.direct_sends,
+            'arquivos': self.transport.files,
+            'bytes_enviados': self.transport.bytes,
+            'erros': dict(self.errors),
+            'comandos': {
+                name: {
+                    'n': len(samples),
+                    'p50_ms': float(np.percentile(samples, 50) * 1000),
+                    'p99_ms': float(np.percentile(samples, 99) * 1000),
+                    'max_ms': float(np.max(samples) * 1000),
+                } for name, samples in sorted(self.latencies.items())
+            },
+            'event_loop': {
+                'atraso_p50_ms': float(np.percentile(lag, 50) * 1000),
+                'atraso_p99_ms': float(np.percentile(lag, 99) * 1000),
+                'atraso_max_ms': float(lag.max() * 1000),
+                'travamentos': int(len(stalls)),
+                'tempo_travado_s': float(stalls.sum()),
+            },
+        }
+
+
+def print_report(report: dict):
+    print(f'{report["mensagens"]} mensagens em {report["duracao_s"]:.1f}s, {report["comandos_s"]:.1f} comandos/s')
+    print(f'Envios: {report["envios_canal"]} no canal, {report["envios_dm"]} por DM, {report["arquivos"]} imagens '
+          f'({report["bytes_enviados"] / 1024:.0f} KB)')
+    print(f'\n{"comando":<12} {"n":>7} {"p50 ms":>9} {"p99 ms":>9} {"máx ms":>9}')
+    for name, x in report['comandos'].items():
+        print(f'{name:<12} {x["n"]:>7} {x["p50_ms"]:>9.1f} {x["p99_ms"]:>9.1f} {x["max_ms"]:>9.1f}')
+    loop = report['event_loop']
+    print(f'\nEvent loop: atraso p50 {loop["atraso_p50_ms"]:.1f}ms, p99 {loop["atraso_p99_ms"]:.1f}ms, '
+          f'máx {loop["atraso_max_ms"]:.1f}ms, {loop["travamentos"]} travamentos somando {loop["tempo_travado_s"]:.2f}s')
+    if report['erros']:
+        print('\nErros:')
+        for name, value in sorted(report['erros'].items()):
+            print(f'  {name}: {value}')
+    print()
+    print('\n'.join(main.METRICS.summary()))
+
+
+async def run(args, workdir: Path) -> dict:
+    csv_path, db_path, keys = write_synthetic_stores(args.personagens, workdir)
+    if args.backend == 'sqlite':
+        store = main.SqliteSheetStore(db_path)
+    else:
+        store = main.CsvSheetStore(csv_path, main.SHEETS_FLUSH_INTERVAL, main.SHEETS_FLUSH_THRESHOLD)
+    store.load()
+    store.start()
+    main.SHEET_STORE = store
+
+    if args.reproduzir is not None:
+        events = read_stream(args.reproduzir)
+    else:
+        events = synthetic_stream(keys, args.taxa, args.duracao, args.seed)
+    if args.gravar is not None:
+        write_stream(events, args.gravar)
+
+    rng = random.Random(args.seed)
+    replay = Replay(StubTransport(args.latencia_envio), [fillable_pdf(rng) for _ in range(8)], args.travamento)
+    replay.install()
+    main.WATCHDOG = main.LoopWatchdog(args.travamento, args.orcamento_loop)
+    main.WATCHDOG.start()
+    try:
+        elapsed = await replay.run(events)
+    finally:
+        main.WATCHDOG.stop()
+        # Sem isso as tarefas de envio ainda estariam pendentes quando o event loop fecha
+        await main.OUTBOUND.close()
+        await store.flush()
+        store.close()
+    return replay.report(elapsed, len(events))
+
+
+def main_cli():
+    # Os caminhos relativos dos argumentos e das variáveis de ambiente partem da raiz do repositório
+    os.chdir(ROOT)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--taxa', type=float, default=200, help='mensagens por segundo do fluxo sintético')
+    parser.add_argument('--duracao', type=float, default=10, help='duração em segundos do fluxo sintético')
+    parser.add_argument('--personagens', type=int, default=10_000, help='quantidade de fichas sintéticas')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default=main.SHEETS_BACKEND)
+    parser.add_argument('--latencia-envio', type=float, default=0.05, help='latência simulada de cada envio em s')
+    parser.add_argument('--travamento', type=float, default=0.05,
+                        help='atraso do event loop em s a partir do qual conta como travamento')
+    parser.add_argument('--orcamento-loop', type=float,
+                        help='falha com LoopBudgetExceeded os comandos que travarem o event loop por mais s que isto')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gravar', type=Path, help='grava o fluxo de mensagens usado neste JSONL')
+    parser.add_argument('--reproduzir', type=Path, help='reproduz um fluxo de mensagens gravado em JSONL')
+    parser.add_argument('--saida', type=Path, help='grava o relatório neste JSON')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        report = main.bot.loop.run_until_complete(run(args, Path(workdir)))
+    print_report(report)
+    if args.saida is not None:
+        args.saida.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main_cli()
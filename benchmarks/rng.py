@@ -0,0 +1,35 @@
+"""Compara a vazão da DiceSource com o caminho antigo via np.random.choice.
+
+Uso: python -m benchmarks.rng
+"""
+from timeit import Timer
+
+import numpy as np
+
+from main import DiceSource
+
+FACES = np.arange(1, 11, dtype=np.uint)
+
+
+def _throughput(function, dice: int) -> float:
+    timer = Timer(function)
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=loops)) / loops
+    return dice / best
+
+
+def main():
+    dice = DiceSource(seed=0)
+    print(f'{"caso":<28} {"antigo (dados/s)":>18} {"DiceSource (dados/s)":>22} {"ganho":>8}')
+    for size in (1, 5, 15, 100, 10_000):
+        old = _throughput(lambda: np.random.choice(FACES, size), size)
+        new = _throughput(lambda: dice.d10(size, 1234), size)
+        print(f'{f"d10 x {size}":<28} {old:>18,.0f} {new:>22,.0f} {new / old:>7.1f}x')
+    for faces, size in ((6, 4), (20, 1), (6, 1000), (100, 100_000)):
+        old = _throughput(lambda: np.random.choice(np.arange(1, faces + 1, dtype=int), size), size)
+        new = _throughput(lambda: dice.integers(faces, size, 1234), size)
+        print(f'{f"{size}d{faces}":<28} {old:>18,.0f} {new:>22,.0f} {new / old:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
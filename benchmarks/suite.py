@@ -0,0 +1,233 @@
+"""Benchmarks dos caminhos quentes dos comandos sem conexão com o Discord.
+
+Uso: python -m benchmarks.suite [--tamanhos 10000 100000 1000000] [--saida resultado.json] [--comparar antes.json]
+
+Mede latência (percentis), pico de memória alocada por chamada (tracemalloc) e vazão de cada caso. Os comandos recebem
+os contextos falsos de benchmarks.fakes, as fichas vêm de armazenamentos sintéticos com `tamanhos` personagens e os
+PDFs são gerados por benchmarks.pdfs.
+"""
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+import main
+from benchmarks import ROOT
+from benchmarks.fakes import FakeAttachment, FakeContext, FakeGuild, FakeUser
+from benchmarks.pdfs import fillable_pdf
+
+REGRESSION_TOLERANCE = 0.1
+
+
+def synthetic_sheets(size: int, seed: int = 0) -> pd.DataFrame:
+    """`size` personagens, dois por jogador ('' e 'ficha2') e cem jogadores por servidor"""
+    rng = np.random.default_rng(seed)
+    users = np.arange(size) // 2
+    index = pd.MultiIndex.from_arrays(
+        [users // 100, users, np.where(np.arange(size) % 2, 'ficha2', '')], names=['guild', 'user', 'character'])
+    values = rng.integers(0, 6, (size, len(main.SHEET_COLUMNS)))
+    return pd.DataFrame(values, index=index, columns=main.SHEET_COLUMNS)
+
+
+def write_synthetic_stores(size: int, workdir: Path) -> Tuple[Path, Path, list]:
+    """Grava as fichas sintéticas em CSV e SQLite, devolve os caminhos e as chaves das fichas principais"""
+    sheets = synthetic_sheets(size)
+    csv_path = workdir / f'fichas_{size}.csv'
+    db_path = workdir / f'fichas_{size}.sqlite3'
+    sheets.to_csv(csv_path)
+    if db_path.exists():
+        db_path.unlink()
+    main.import_csv_to_sqlite(csv_path, db_path)
+    return csv_path, db_path, sheets.index[::2].tolist()
+
+
+async def _call(function: Callable):
+    result = function()
+    if inspect.isawaitable(result):
+        await result
+
+
+async def measure(function: Callable, iterations: int, warmup: int = 2) -> Dict[str, float]:
+    for _ in range(warmup):
+        await _call(function)
+    samples = []
+    start = perf_counter()
+    for _ in range(iterations):
+        call_start = perf_counter()
+        await _call(function)
+        samples.append(perf_counter() - call_start)
+    total = perf_counter() - start
+
+    peaks = []
+    tracemalloc.start()
+    for _ in range(min(iterations, 10)):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await _call(function)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    samples = np.array(samples) * 1000
+    return {
+        'iteracoes': iterations,
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p90_ms': float(np.percentile(samples, 90)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+        'ops_s': iterations / total,
+        'pico_alocado_kb': float(np.median(peaks)) / 1024,
+    }
+
+
+def command_cases(rng: random.Random):
+    """Casos que não dependem das fichas, (nome, função, iterações)"""
+    ctx = FakeContext()
+    pdfs = [fillable_pdf(rng) for _ in range(8)]
+    normais = main.DICE.d10(90)
+    fome = main.DICE.d10(10)
+    yield 'roll5e 15 dados', lambda: main.roll5e(ctx, '15', '3', '4'), 500
+    yield 'roll5e 7 dados x20', lambda: main.roll5e(ctx, '7', '2', '3', 'x20'), 200
+    yield 'roll_dnd 4d6kh3+2d8+5', lambda: main.roll_dnd(ctx, '4d6kh3+2d8+5'), 500
+    yield '_roll_dnd 1000000d6kh3', lambda: main._roll_dnd('1000000d6kh3'), 20
+    yield 'roll_dnd 100d10!', lambda: main.roll_dnd(ctx, '100d10!'), 500
+    yield '_roll_dnd 1000000d10!>=8', lambda: main._roll_dnd('1000000d10!>=8'), 20
+    yield 'create_image 100 dados', lambda: main.create_image(normais, fome), 200
+    yield 'create_image_file 100 dados', lambda: main.create_image_file(normais, fome, 'x.png'), 100
+    yield 'create_image_file 1 dado', lambda: main.create_image_file(normais[:1], [], 'x.png'), 500
+    yield '_read_sheet_from_pdf', lambda: main._read_sheet_from_pdf(rng.choice(pdfs)), 50
+
+
+def store_cases(size: int, workdir: Path, rng: random.Random):
+    """Casos das fichas para cada backend com `size` personagens"""
+    csv_path, db_path, keys = write_synthetic_stores(size, workdir)
+    pdfs = [fillable_pdf(rng) for _ in range(8)]
+
+    stores = {
+        'csv': main.CsvSheetStore(csv_path, main.SHEETS_FLUSH_INTERVAL, main.SHEETS_FLUSH_THRESHOLD),
+        'sqlite': main.SqliteSheetStore(db_path),
+    }
+    load_iterations = 3 if size <= 100_000 else 1
+    yield f'start_store csv {size}', lambda: main.CsvSheetStore(csv_path, 1, 1).load(), load_iterations
+
+    def load_sqlite():
+        store = main.SqliteSheetStore(db_path)
+        store.load()
+        store.close()
+
+    yield f'start_store sqlite {size}', load_sqlite, load_iterations
+    for backend, store in stores.items():
+        store.load()
+
+        def use_store(store=store):
+            main.SHEET_STORE = store
+
+        def evaluate(store=store):
+            use_store(store)
+            guild, user, _ = rng.choice(keys)
+            return main.evaluate_sheet_expression(guild, user, 'força+briga+ficha2.fome')
+
+        def save(store=store):
+            use_store(store)
+            guild, user, _ = rng.choice(keys)
+            ctx = FakeContext(FakeGuild(guild), FakeUser(user), attachments=[FakeAttachment(rng.choice(pdfs))])
+            return main.read_sheet(ctx, 'ficha2')
+
+        def set_value(store=store):
+            use_store(store)
+            guild, user, _ = rng.choice(keys)
+            return main.increment_sheet_value(FakeContext(FakeGuild(guild), FakeUser(user)), 'fome', 'fome+1')
+
+        def roll_group(store=store):
+            use_store(store)
+            guild, user, _ = rng.choice(keys)
+            return main.roll_group(FakeContext(FakeGuild(guild), FakeUser(user)), 'raciocínio+prontidão')
+
+        yield f'evaluate_sheet_expression {backend} {size}', evaluate, 500
+        yield f'setf {backend} {size}', set_value, 300
+        yield f'save_sheet {backend} {size}', save, 30
+        yield f'rollgrupo {backend} {size}', roll_group, 100
+        if backend == 'csv':
+            def flush(store=store):
+                store.writer.dirty = 1
+                return store.flush()
+
+            yield f'flush csv {size}', flush, load_iterations
+        store.close()
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict]):
+    print(f'\n{"caso":<45} {"antes p50":>10} {"agora p50":>10} {"razão":>7}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_ms']
+        ratio = result['p50_ms'] / before if before else float('inf')
+        flag = '  REGRESSÃO' if ratio > 1 + REGRESSION_TOLERANCE else ''
+        print(f'{name:<45} {before:>10.3f} {result["p50_ms"]:>10.3f} {ratio:>7.2f}{flag}')
+
+
+async def run(sizes: List[int], only: str, iteration_scale: float) -> Dict[str, dict]:
+    rng = random.Random(0)
+    results = {}
+    print(f'{"caso":<45} {"p50 ms":>9} {"p99 ms":>9} {"ops/s":>10} {"pico KB":>9}')
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = list(command_cases(rng))
+        for size in sizes:
+            cases.append(store_cases(size, Path(workdir), rng))
+        for group in cases:
+            for name, function, iterations in (group if not isinstance(group, tuple) else [group]):
+                if only and only not in name:
+                    continue
+                result = results[name] = await measure(function, max(1, int(iterations * iteration_scale)))
+                print(f'{name:<45} {result["p50_ms"]:>9.3f} {result["p99_ms"]:>9.3f} {result["ops_s"]:>10.1f} '
+                      f'{result["pico_alocado_kb"]:>9.1f}')
+    # Sem isso as tarefas de envio ainda estariam pendentes quando o event loop fecha
+    await main.OUTBOUND.close()
+    return results
+
+
+def main_cli():
+    # Os caminhos relativos dos argumentos e das variáveis de ambiente partem da raiz do repositório
+    os.chdir(ROOT)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tamanhos', type=int, nargs='*', default=[10_000],
+                        help='quantidades de personagens dos armazenamentos sintéticos')
+    parser.add_argument('--casos', default='', help='roda só os casos que contêm este texto')
+    parser.add_argument('--escala', type=float, default=1., help='multiplica as iterações de cada caso')
+    parser.add_argument('--saida', type=Path, help='grava os resultados neste JSON')
+    parser.add_argument('--comparar', type=Path, help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+    results = main.bot.loop.run_until_complete(run(args.tamanhos, args.casos, args.escala))
+    if args.saida is not None:
+        args.saida.write_text(json.dumps({
+            'revisao': revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'resultados': results,
+        }, indent=2))
+    if args.comparar is not None:
+        compare(results, json.loads(args.comparar.read_text())['resultados'])
+
+
+if __name__ == '__main__':
+    main_cli()
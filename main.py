@@ -1,31 +1,100 @@
+from time import perf_counter, sleep as blocking_sleep, time
+
+STARTUP_STARTED_AT = perf_counter()
+
 import os
+import hashlib
+import struct
+import zlib
+import zipfile
 import ast
+import argparse
+import sqlite3
+import signal
+import subprocess
+import sys
+import threading
+import multiprocessing
+import traceback
+import weakref
 import operator as op
+from abc import ABC, abstractmethod
 from io import BytesIO
 import re
-from typing import List
-from tempfile import TemporaryDirectory
+from typing import List, Optional, Callable, Dict, Iterator, Sequence, Set, Tuple, TYPE_CHECKING
 from pathlib import Path
-from asyncio import create_task, Lock
+from functools import lru_cache
+from bisect import bisect_left
+from math import prod
+from collections import namedtuple, OrderedDict
+from asyncio import create_task, gather, wrap_future, Lock, Semaphore, Event, PriorityQueue, wait_for, \
+    TimeoutError as AsyncTimeoutError, get_event_loop, sleep, start_server, IncompleteReadError, LimitOverrunError, \
+    current_task, wait, Future as AsyncFuture
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from contextlib import asynccontextmanager, contextmanager
 
 from dotenv import load_dotenv
 import numpy as np
-import cv2
-from PyPDF2 import PdfFileReader
 from unidecode import unidecode
-import pandas as pd
 
 from discord.ext import commands
 from discord.ext.commands import Context
 from discord import File, Attachment, Message, User
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
              ast.Div: op.truediv, ast.USub: op.neg, ast.UAdd: op.pos}
 
+
+def log_startup_phase(phase: str, started_at: float) -> float:
+    now = perf_counter()
+    print(f'Inicialização: {phase} em {(now - started_at) * 1000:.0f}ms')
+    return now
+
+
+PHASE_STARTED_AT = log_startup_phase('imports', STARTUP_STARTED_AT)
+
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 SHEETS_FILE = Path(os.getenv('SHEETS_FILE'))
-DF_LOCK = Lock()
+SHEETS_FLUSH_INTERVAL = float(os.getenv('SHEETS_FLUSH_INTERVAL', '5'))
+SHEETS_FLUSH_THRESHOLD = int(os.getenv('SHEETS_FLUSH_THRESHOLD', '50'))
+SHEETS_BACKEND = os.getenv('SHEETS_BACKEND', 'csv')
+ROLL_LOG_FILE = Path(os.getenv('ROLL_LOG_FILE', str(SHEETS_FILE.with_name('rolagens.bin'))))
+ROLL_LOG_FLUSH_INTERVAL = float(os.getenv('ROLL_LOG_FLUSH_INTERVAL', '5'))
+SHEETS_DB = Path(os.getenv('SHEETS_DB', str(SHEETS_FILE.with_suffix('.sqlite3'))))
+SHEET_LOCK_STRIPES = int(os.getenv('SHEET_LOCK_STRIPES', '64'))
+SHEET_LOCK_WAIT_WARNING = float(os.getenv('SHEET_LOCK_WAIT_WARNING', '0.1'))
+EXPRESSION_CACHE_SIZE = int(os.getenv('EXPRESSION_CACHE_SIZE', '1024'))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '2'))
+PDF_QUEUE_LIMIT = int(os.getenv('PDF_QUEUE_LIMIT', '20'))
+BULK_IMPORT_LIMIT = int(os.getenv('BULK_IMPORT_LIMIT', '30'))
+PDF_CACHE_SIZE = int(os.getenv('PDF_CACHE_SIZE', '256'))
+DICE_SEED = os.getenv('DICE_SEED')
+DICE_STREAMS = int(os.getenv('DICE_STREAMS', '4096'))
+MACRO_CACHE_SIZE = int(os.getenv('MACRO_CACHE_SIZE', '4096'))
+METRICS_FILE = os.getenv('METRICS_FILE')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', '15'))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.1'))
+LOOP_STRICT_BUDGET = float(os.getenv('LOOP_STRICT_BUDGET')) if os.getenv('LOOP_STRICT_BUDGET') else None
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = [int(x) for x in os.getenv('SHARD_IDS', '').split(',') if x.strip()] or None
+SHARD_START_INTERVAL = float(os.getenv('SHARD_START_INTERVAL', '5'))
+OUTBOUND_WINDOW = float(os.getenv('OUTBOUND_WINDOW', '0.05'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))
+OUTBOUND_MAX_DEPTH = int(os.getenv('OUTBOUND_MAX_DEPTH', '1000'))
+# Os arquivos do bot ficam ao lado do main.py, então importar ele não depende do diretório atual
+STARTUP_CACHE = Path(os.getenv('STARTUP_CACHE', str(Path(__file__).resolve().with_name('startup_cache.npz'))))
+DICE_IMAGE_FILE = Path(__file__).resolve().with_name('d10_faces.png')
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'paleta')
+IMAGE_PALETTE_SIZE = int(os.getenv('IMAGE_PALETTE_SIZE', '32'))
+IMAGE_BYTE_BUDGET = int(os.getenv('IMAGE_BYTE_BUDGET', str(256 * 1024)))
+if IMAGE_FORMAT not in ('paleta', 'webp', 'png'):
+    raise ValueError(f'IMAGE_FORMAT desconhecido: {IMAGE_FORMAT}')
 
 IMPORTANT_FIELDS = [
     ('Fome', 5),
@@ -120,72 +189,808 @@ if DEBUG:
             _inserted_keys.add(k)
         return final_dict
 
-ALIAS = {
-    **create_alias_dict('fome', 'fom', 'quantas_chupadas_tenho_que_dar'),
-    **create_alias_dict('força de vontade', 'foc', 'von', 'vontade'),
-    **create_alias_dict('humanidade', 'hum'),
-    **create_alias_dict('vitalidade', 'vit', 'vida', 'quanto_tapa_aguento', 'hp_max', 'sangue'),
-    **create_alias_dict('vitalidade atual', 'via', 'vida_atual', 'vou_mim_morrer', 'hp'),
-    **create_alias_dict('força', 'for', 'maromba', 'bicipes', 'body_build', 'biiir', 'se_liga_no_shape_do_pai',
-                        'se_liga_no_shape_da_mae'),
-    **create_alias_dict('destreza', 'agilidade', 'dex', 'agi'),
-    **create_alias_dict('vigor', 'vig', 'pulmao', 'stamina', 'sta'),
-    **create_alias_dict('carisma', 'car', 'fala_mansa'),
-    **create_alias_dict('manipulação', 'man', 'mai'),
-    **create_alias_dict('autocontrole', 'auc', 'auto_controle', 'nao_ser_louco', 'compostura', 'com'),
-    **create_alias_dict('inteligência', 'int', 'ine'),
-    **create_alias_dict('raciocínio', 'rac', 'pensa_rapido'),
-    **create_alias_dict('determinação', 'det'),
-    **create_alias_dict('atletismo', 'atl', 'corre_corre', 'corre_berg', 'deu_ruim', 'vel'),
-    **create_alias_dict('armas brancas', 'arb', 'olha_a_faca'),
-    **create_alias_dict('armas de fogo', 'arf', 'pou_pou', 'pou'),
-    **create_alias_dict('briga', 'bri', 'fight', 'cai_na_mao', 'voadora', 'voadora_de_duas_pernas'),
-    **create_alias_dict('condução', 'con', 'vrum'),
-    **create_alias_dict('furtividade', 'fur', 'invisibilidade'),
-    **create_alias_dict('ofícios', 'ofi', 'oficio'),
-    **create_alias_dict('roubo', 'rou', 'pick_pocket', 'perdeu_playboy', 'perdeu_preiboi', 'ladroagem', 'lad'),
-    **create_alias_dict('sobrevivencia', 'sob', 'survive', 'i_will_survive'),
-    **create_alias_dict('empatia com animais', 'ema', 'auau', 'miau', 'beeh', 'bzz', 'relinchar'),
-    **create_alias_dict('etiqueta', 'eti', 'frescura'),
-    **create_alias_dict('intimidação', 'ini'),
-    **create_alias_dict('intuição', 'inu', 'terceiro_olho', 'sagacidade', 'sag'),
-    **create_alias_dict('lábia', 'lab', 'subterfugio', 'sub'),
-    **create_alias_dict('liderança', 'lid'),
-    **create_alias_dict('manha', 'mah'),
-    **create_alias_dict('performance', 'per', 'pef', 'canta_raul'),
-    **create_alias_dict('persuasão', 'pes', 'hinode'),
-    **create_alias_dict('acadêmicos', 'aca', 'erudicao', 'eru', 'sabido'),
-    **create_alias_dict('ciências', 'cie'),
-    **create_alias_dict('finanças', 'fin', 'pirâmide', 'bitcoin'),
-    **create_alias_dict('investigação', 'inv', 'parece_que_temos_um_xeroque_rolmes_aqui'),
-    **create_alias_dict('medicina', 'med', 'doutor_mim_salve'),
-    **create_alias_dict('ocultismo', 'ocu', 'chapeu_de_aluminio'),
-    **create_alias_dict('política', 'pol', 'roubo_socialmente_aceitavel'),
-    **create_alias_dict('percepção', 'prontidao', 'pec', 'perc', 'pron', 'ta_ligado'),
-    **create_alias_dict('tecnologia', 'tec', 'hack', 'formata_o_uindous'),
-    **create_alias_dict('animalismo', 'ani'),
-    **create_alias_dict('auspícios', 'aus', 'auspicio'),
-    **create_alias_dict('celeridade', 'cel'),
-    **create_alias_dict('dominação', 'dom'),
-    **create_alias_dict('feitiçaria de sangue', 'feiticaria', 'fei', 'rituais'),
-    **create_alias_dict('fortitude', 'foi'),
-    **create_alias_dict('oblívio', 'obl'),
-    **create_alias_dict('ofuscação', 'ofu'),
-    **create_alias_dict('potência', 'pot'),
-    **create_alias_dict('presença', 'pre'),
-    **create_alias_dict('metamorfose', 'met'),
-    **create_alias_dict('alquimia sangue fraco', 'asf'),
+
+def build_alias() -> Dict[str, str]:
+    return {
+        **create_alias_dict('fome', 'fom', 'quantas_chupadas_tenho_que_dar'),
+        **create_alias_dict('força de vontade', 'foc', 'von', 'vontade'),
+        **create_alias_dict('humanidade', 'hum'),
+        **create_alias_dict('vitalidade', 'vit', 'vida', 'quanto_tapa_aguento', 'hp_max', 'sangue'),
+        **create_alias_dict('vitalidade atual', 'via', 'vida_atual', 'vou_mim_morrer', 'hp'),
+        **create_alias_dict('força', 'for', 'maromba', 'bicipes', 'body_build', 'biiir', 'se_liga_no_shape_do_pai',
+                            'se_liga_no_shape_da_mae'),
+        **create_alias_dict('destreza', 'agilidade', 'dex', 'agi'),
+        **create_alias_dict('vigor', 'vig', 'pulmao', 'stamina', 'sta'),
+        **create_alias_dict('carisma', 'car', 'fala_mansa'),
+        **create_alias_dict('manipulação', 'man', 'mai'),
+        **create_alias_dict('autocontrole', 'auc', 'auto_controle', 'nao_ser_louco', 'compostura', 'com'),
+        **create_alias_dict('inteligência', 'int', 'ine'),
+        **create_alias_dict('raciocínio', 'rac', 'pensa_rapido'),
+        **create_alias_dict('determinação', 'det'),
+        **create_alias_dict('atletismo', 'atl', 'corre_corre', 'corre_berg', 'deu_ruim', 'vel'),
+        **create_alias_dict('armas brancas', 'arb', 'olha_a_faca'),
+        **create_alias_dict('armas de fogo', 'arf', 'pou_pou', 'pou'),
+        **create_alias_dict('briga', 'bri', 'fight', 'cai_na_mao', 'voadora', 'voadora_de_duas_pernas'),
+        **create_alias_dict('condução', 'con', 'vrum'),
+        **create_alias_dict('furtividade', 'fur', 'invisibilidade'),
+        **create_alias_dict('ofícios', 'ofi', 'oficio'),
+        **create_alias_dict('roubo', 'rou', 'pick_pocket', 'perdeu_playboy', 'perdeu_preiboi', 'ladroagem', 'lad'),
+        **create_alias_dict('sobrevivencia', 'sob', 'survive', 'i_will_survive'),
+        **create_alias_dict('empatia com animais', 'ema', 'auau', 'miau', 'beeh', 'bzz', 'relinchar'),
+        **create_alias_dict('etiqueta', 'eti', 'frescura'),
+        **create_alias_dict('intimidação', 'ini'),
+        **create_alias_dict('intuição', 'inu', 'terceiro_olho', 'sagacidade', 'sag'),
+        **create_alias_dict('lábia', 'lab', 'subterfugio', 'sub'),
+        **create_alias_dict('liderança', 'lid'),
+        **create_alias_dict('manha', 'mah'),
+        **create_alias_dict('performance', 'per', 'pef', 'canta_raul'),
+        **create_alias_dict('persuasão', 'pes', 'hinode'),
+        **create_alias_dict('acadêmicos', 'aca', 'erudicao', 'eru', 'sabido'),
+        **create_alias_dict('ciências', 'cie'),
+        **create_alias_dict('finanças', 'fin', 'pirâmide', 'bitcoin'),
+        **create_alias_dict('investigação', 'inv', 'parece_que_temos_um_xeroque_rolmes_aqui'),
+        **create_alias_dict('medicina', 'med', 'doutor_mim_salve'),
+        **create_alias_dict('ocultismo', 'ocu', 'chapeu_de_aluminio'),
+        **create_alias_dict('política', 'pol', 'roubo_socialmente_aceitavel'),
+        **create_alias_dict('percepção', 'prontidao', 'pec', 'perc', 'pron', 'ta_ligado'),
+        **create_alias_dict('tecnologia', 'tec', 'hack', 'formata_o_uindous'),
+        **create_alias_dict('animalismo', 'ani'),
+        **create_alias_dict('auspícios', 'aus', 'auspicio'),
+        **create_alias_dict('celeridade', 'cel'),
+        **create_alias_dict('dominação', 'dom'),
+        **create_alias_dict('feitiçaria de sangue', 'feiticaria', 'fei', 'rituais'),
+        **create_alias_dict('fortitude', 'foi'),
+        **create_alias_dict('oblívio', 'obl'),
+        **create_alias_dict('ofuscação', 'ofu'),
+        **create_alias_dict('potência', 'pot'),
+        **create_alias_dict('presença', 'pre'),
+        **create_alias_dict('metamorfose', 'met'),
+        **create_alias_dict('alquimia sangue fraco', 'asf'),
+    }
+
+
+DICE_HEIGHT = 66
+DICE_WIDTH = 62
+BLANK_DICE_INDEX = 20
+
+
+def read_dice_tiles(path: Path) -> np.ndarray:
+    """Atlas achatado (bestial * 10 + face - 1, altura, largura, BGR) com um dado em branco no final, para montar a
+    imagem com um único gather"""
+    import cv2
+    image = cv2.imread(str(path))
+    faces = {
+        (False, 10): image[0:66, 0:62],
+        (False, 1): image[0:66, 62:124],
+        (False, 2): image[0:66, 124:186],
+        (False, 3): image[0:66, 186:248],
+        (False, 4): image[0:66, 248:310],
+        (False, 5): image[66:132, 0:62],
+        (False, 6): image[66:132, 62:124],
+        (False, 7): image[66:132, 124:186],
+        (False, 8): image[66:132, 186:248],
+        (False, 9): image[66:132, 248:310],
+        (True, 10): image[132:198, 0:62],
+        (True, 1): image[132:198, 62:124],
+        (True, 2): image[132:198, 124:186],
+        (True, 3): image[132:198, 186:248],
+        (True, 4): image[132:198, 248:310],
+        (True, 5): image[198:310, 0:62],
+        (True, 6): image[198:310, 62:124],
+        (True, 7): image[198:310, 124:186],
+        (True, 8): image[198:310, 186:248],
+        (True, 9): image[198:310, 248:310],
+    }
+    tiles = [faces[(bestial, face)] for bestial in (False, True) for face in range(1, 11)]
+    tiles.append(np.full((DICE_HEIGHT, DICE_WIDTH, 3), 255, dtype=np.uint8))
+    return np.ascontiguousarray(np.stack(tiles))
+
+
+def quantize_tiles(tiles: np.ndarray, colors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Paleta (colors, BGR) por k-means e o atlas em índices dessa paleta"""
+    import cv2
+    pixels = tiles.reshape((-1, 3)).astype(np.float32)
+    cv2.setRNGSeed(0)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.5)
+    _, labels, centers = cv2.kmeans(pixels, colors, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    palette = np.clip(np.round(centers), 0, 255).astype(np.uint8)
+    return palette, labels.reshape(tiles.shape[:3]).astype(np.uint8)
+
+
+def build_startup_tables() -> Dict[str, np.ndarray]:
+    alias = build_alias()
+    tiles = read_dice_tiles(DICE_IMAGE_FILE)
+    palette, tiles_indexed = quantize_tiles(tiles, IMAGE_PALETTE_SIZE)
+    return {
+        'alias_keys': np.array(list(alias.keys())),
+        'alias_values': np.array(list(alias.values())),
+        'tiles': tiles,
+        'palette': palette,
+        'tiles_indexed': tiles_indexed,
+    }
+
+
+def _startup_fingerprint() -> str:
+    """Muda sempre que o código das tabelas, a imagem dos dados ou o tamanho da paleta mudam"""
+    digest = hashlib.sha1(Path(__file__).read_bytes())
+    digest.update(DICE_IMAGE_FILE.read_bytes())
+    digest.update(str(IMAGE_PALETTE_SIZE).encode())
+    return digest.hexdigest()
+
+
+def write_startup_cache(path: Path, fingerprint: str, tables: Dict[str, np.ndarray]):
+    temp_path = path.with_name(f'{path.name}.tmp.npz')
+    np.savez(temp_path, fingerprint=np.array(fingerprint), **tables)
+    os.replace(temp_path, path)
+
+
+def load_startup_tables() -> Tuple[Dict[str, np.ndarray], str]:
+    """Carrega os apelidos, o atlas dos dados e a paleta do STARTUP_CACHE, gerando de novo se estiver desatualizado"""
+    fingerprint = _startup_fingerprint()
+    if not DEBUG:
+        try:
+            with np.load(STARTUP_CACHE, allow_pickle=False) as cache:
+                if str(cache['fingerprint']) == fingerprint:
+                    return {k: cache[k] for k in cache.files if k != 'fingerprint'}, 'cache'
+        except (OSError, KeyError, ValueError):
+            pass
+    tables = build_startup_tables()
+    try:
+        write_startup_cache(STARTUP_CACHE, fingerprint, tables)
+    except OSError as e:
+        print('WARNING não foi possível gravar o cache de inicialização', repr(e))
+    return tables, 'gerado'
+
+
+STARTUP_TABLES, _startup_source = load_startup_tables()
+ALIAS = dict(zip(STARTUP_TABLES['alias_keys'].tolist(), STARTUP_TABLES['alias_values'].tolist()))
+DICE_TILES = STARTUP_TABLES['tiles']
+# O mesmo atlas em índices da DICE_PALETTE, as imagens são montadas e codificadas nesse espaço
+DICE_PALETTE = STARTUP_TABLES['palette']
+DICE_TILES_INDEXED = STARTUP_TABLES['tiles_indexed']
+PHASE_STARTED_AT = log_startup_phase(f'tabelas ({_startup_source})', PHASE_STARTED_AT)
+
+SHEET_COLUMNS = sorted(set(ALIAS.values()))
+
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+METRICS_HELP = {
+    'vampiro_command_seconds': 'Latência de ponta a ponta dos comandos, da mensagem recebida ao fim do comando',
+    'vampiro_command_errors_total': 'Comandos que terminaram com erro',
+    'vampiro_sheet_lock_wait_seconds': 'Espera pelo lock das fichas',
+    'vampiro_sheet_lock_hold_seconds': 'Tempo segurando o lock das fichas',
+    'vampiro_sheet_lock_contended_total': 'Aquisições do lock das fichas que encontraram o lock ocupado',
+    'vampiro_persistence_seconds': 'Tempo das operações de gravação e leitura das fichas',
+    'vampiro_pdf_parse_seconds': 'Leitura das fichas em PDF',
+    'vampiro_pdf_cache_hits_total': 'Fichas em PDF já lidas antes, encontradas pelo hash do conteúdo',
+    'vampiro_image_seconds': 'Montagem e codificação das imagens dos dados',
+    'vampiro_send_seconds': 'Envio de mensagens pela fila de saída',
+    'vampiro_outbound_wait_seconds': 'Tempo das mensagens na fila de saída até o envio',
+    'vampiro_outbound_coalesced_total': 'Mensagens juntadas a outra para o mesmo destino',
+    'vampiro_outbound_errors_total': 'Envios que falharam',
+    'vampiro_outbound_queue_depth': 'Mensagens esperando na fila de saída',
+    'vampiro_event_loop_lag_seconds': 'Atraso do event loop medido pelo watchdog',
+    'vampiro_event_loop_stalls_total': 'Travamentos do event loop acima do LOOP_STALL_THRESHOLD, por comando',
 }
 
-BACKSLASH = '\\'
 
-REGEX_ALIAS = f"(?:([a-z0-9_]+){BACKSLASH}.)?({'|'.join(sorted(ALIAS.keys(), key=len, reverse=True))})"
+class Histogram:
+    """Histograma cumulativo no formato do Prometheus, em segundos"""
+
+    def __init__(self, buckets: Sequence[float] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimativa interpolando dentro do bucket, como o histogram_quantile do Prometheus"""
+        rank = q * self.count
+        seen = 0
+        lower = 0.
+        for upper, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = upper
+        return self.max
+
+
+def _prometheus_labels(labels: Tuple[Tuple[str, str], ...], le: Optional[str] = None) -> str:
+    if le is not None:
+        labels = labels + (('le', le),)
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """Histogramas e contadores do bot, também alimentados pelas threads dos executores"""
+
+    def __init__(self):
+        self.histograms = {}  # type: Dict[Tuple[str, tuple], Histogram]
+        self.counters = {}  # type: Dict[Tuple[str, tuple], int]
+        self.gauges = {}  # type: Dict[Tuple[str, tuple], float]
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def prometheus(self) -> str:
+        """Todas as métricas no formato texto do Prometheus"""
+        with self._lock:
+            histograms = sorted((k, list(h.counts), h.count, h.sum) for k, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        lines = []
+        last_name = None
+        for (name, labels), counts, count, total in histograms:
+            if name != last_name:
+                lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} histogram']
+                last_name = name
+            cumulative = 0
+            for upper, bucket in zip(METRICS_BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_prometheus_labels(labels, str(upper))} {cumulative}')
+            lines.append(f'{name}_bucket{_prometheus_labels(labels, "+Inf")} {count}')
+            lines.append(f'{name}_sum{_prometheus_labels(labels)} {total}')
+            lines.append(f'{name}_count{_prometheus_labels(labels)} {count}')
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} counter']
+                last_name = name
+            lines.append(f'{name}{_prometheus_labels(labels)} {value}')
+        for (name, labels), value in gauges:
+            if name != last_name:
+                lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} gauge']
+                last_name = name
+            lines.append(f'{name}{_prometheus_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> List[str]:
+        """Uma linha por série com contagem, média, p50, p99 e máximo em ms"""
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        lines = [f'{"métrica":<40} {"n":>7} {"média":>8} {"p50":>8} {"p99":>8} {"máx":>8}']
+        for (name, labels), h in histograms:
+            label = name[len('vampiro_'):-len('_seconds')] + ''.join(f' {v}' for _, v in labels)
+            lines.append(f'{label[:40]:<40} {h.count:>7} {h.sum / h.count * 1000:>8.1f} '
+                         f'{h.quantile(.5) * 1000:>8.1f} {h.quantile(.99) * 1000:>8.1f} {h.max * 1000:>8.1f}')
+        for (name, labels), value in counters:
+            label = name[len('vampiro_'):-len('_total')] + ''.join(f' {v}' for _, v in labels)
+            lines.append(f'{label[:40]:<40} {value:>7}')
+        for (name, labels), value in gauges:
+            label = name[len('vampiro_'):] + ''.join(f' {v}' for _, v in labels)
+            lines.append(f'{label[:40]:<40} {value:>7g}')
+        return lines
+
+
+METRICS = Metrics()
+
+
+PRIORITY_ROLL = 0
+PRIORITY_INFO = 1
+
+
+class TokenBucket:
+    """`capacity` envios a cada `period` segundos, como os buckets de rate limit do Discord"""
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = perf_counter()
+
+    def wait_time(self) -> float:
+        now = perf_counter()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0. if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        """Cheio de novo, igual a um bucket novo"""
+        self.wait_time()
+        return self.tokens >= self.capacity
+
+    def take(self):
+        self.tokens -= 1
+
+
+OutboundMessage = namedtuple('OutboundMessage', ['send', 'content', 'file', 'priority', 'queued_at', 'future'])
+
+
+class OutboundQueue:
+    """Fila central dos envios do bot.
+
+    As mensagens para o mesmo canal ou DM que chegam dentro de `window` segundos são juntadas em uma só (no máximo um
+    arquivo e DISCORD_MESSAGE_LIMIT caracteres), cada destino e o bot inteiro têm o seu bucket de envios, e quando
+    vários destinos estão prontos os que têm resultados de rolagens são atendidos primeiro. A ordem das mensagens de
+    um mesmo destino é sempre mantida, e os erros de envio são registrados no log em vez de se perderem em tarefas.
+
+    Os buckets dos destinos ficam em ordem de último uso e os que já encheram de novo são descartados, então só os
+    destinos que enviaram no último período ocupam memória.
+    """
+
+    def __init__(self, window: float, workers: int, destination_rate: Tuple[int, float],
+                 global_rate: Tuple[int, float], max_depth: int):
+        self.window = window
+        self.workers = workers
+        self.destination_rate = destination_rate
+        self.global_bucket = TokenBucket(*global_rate)
+        self.max_depth = max_depth
+        self.depth = 0
+        self._pending = {}  # type: Dict[tuple, List[OutboundMessage]]
+        self._buckets = OrderedDict()  # type: OrderedDict[tuple, TokenBucket]
+        self._unsent = set()  # type: Set[AsyncFuture]
+        self._scheduled = set()
+        self._ready = None  # type: Optional[PriorityQueue]
+        self._tasks = []
+        self._sequence = 0
+
+    def _start(self):
+        self._ready = PriorityQueue()
+        self._tasks = [create_task(self._worker()) for _ in range(self.workers)]
+
+    def _set_depth(self, delta: int):
+        self.depth += delta
+        METRICS.set_gauge('vampiro_outbound_queue_depth', self.depth)
+
+    async def send(self, key: tuple, send: Callable, content: Optional[str] = None, file: Optional[File] = None,
+                   priority: int = PRIORITY_INFO) -> AsyncFuture:
+        """Enfileira a mensagem e retorna logo, só espera o envio quando a fila passa de `max_depth`.
+
+        Retorna um future com a mensagem enviada, a mesma para todas as que foram juntadas em um envio, ou com a
+        exceção do envio, que também vai para o log mesmo se ninguém esperar o future.
+        """
+        if self._ready is None:
+            self._start()
+        future = get_event_loop().create_future()
+        self._pending.setdefault(key, []).append(
+            OutboundMessage(send, content, file, priority, perf_counter(), future))
+        self._unsent.add(future)
+        future.add_done_callback(self._unsent.discard)
+        self._set_depth(1)
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            get_event_loop().call_later(self.window, self._schedule, key)
+        if self.depth > self.max_depth:
+            await wait([future])
+        return future
+
+    def _schedule(self, key: tuple, delay: float = 0.):
+        if delay > 0:
+            get_event_loop().call_later(delay, self._schedule, key)
+            return
+        self._sequence += 1
+        self._ready.put_nowait((min(x.priority for x in self._pending[key]), self._sequence, key))
+
+    def _take_batch(self, key: tuple) -> List[OutboundMessage]:
+        pending = self._pending[key]
+        batch = [pending[0]]
+        size = len(pending[0].content or '')
+        has_file = pending[0].file is not None
+        for message in pending[1:]:
+            size += len(message.content or '') + 1
+            if size > DISCORD_MESSAGE_LIMIT or (has_file and message.file is not None):
+                break
+            has_file = has_file or message.file is not None
+            batch.append(message)
+        del pending[:len(batch)]
+        return batch
+
+    async def _worker(self):
+        while True:
+            _, _, key = await self._ready.get()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*self.destination_rate)
+            delay = max(bucket.wait_time(), self.global_bucket.wait_time())
+            if delay > 0:
+                # Outro destino pode ser atendido enquanto este espera o seu bucket
+                self._schedule(key, delay)
+                continue
+            bucket.take()
+            self.global_bucket.take()
+            self._buckets.move_to_end(key)
+            self._evict_idle_buckets()
+            batch = self._take_batch(key)
+            self._set_depth(-len(batch))
+            await self._deliver(key, batch)
+            if self._pending[key]:
+                self._schedule(key)
+            else:
+                del self._pending[key]
+                self._scheduled.discard(key)
+
+    def _evict_idle_buckets(self):
+        """Descarta os buckets cheios do início, todos enchem no mesmo ritmo então os seguintes ainda não encheram"""
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if not bucket.full():
+                return
+            del self._buckets[key]
+
+    async def _deliver(self, key: tuple, batch: List[OutboundMessage]):
+        now = perf_counter()
+        for message in batch:
+            METRICS.observe('vampiro_outbound_wait_seconds', now - message.queued_at)
+        if len(batch) > 1:
+            METRICS.increment('vampiro_outbound_coalesced_total', len(batch) - 1)
+        content = '\n'.join(x.content for x in batch if x.content) or None
+        file = next((x.file for x in batch if x.file is not None), None)
+        try:
+            with METRICS.time('vampiro_send_seconds', destino=key[0]):
+                sent = await batch[0].send(content, file=file)
+        except Exception as e:
+            METRICS.increment('vampiro_outbound_errors_total', destino=key[0])
+            print(f'ERROR ao enviar mensagem para {key}', repr(e))
+            for message in batch:
+                if not message.future.done():
+                    message.future.set_exception(e)
+                    # Já registrado no log, o asyncio não precisa avisar se ninguém esperar o future
+                    message.future.exception()
+            return
+        for message in batch:
+            if not message.future.done():
+                message.future.set_result(sent)
+
+    async def drain(self):
+        """Espera todas as mensagens enfileiradas até agora serem enviadas, inclusive as que já estão sendo enviadas"""
+        if self._unsent:
+            await wait(list(self._unsent))
+
+    async def close(self):
+        """Envia o que falta e encerra as tarefas de envio, uma nova mensagem inicia a fila de novo"""
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = None
+
+
+OUTBOUND = OutboundQueue(OUTBOUND_WINDOW, OUTBOUND_WORKERS, (5, 5.), (50, 1.), OUTBOUND_MAX_DEPTH)
+
+
+class MetricsContext(Context):
+    """Contexto que marca o início do comando e manda as mensagens pela fila de saída"""
+
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.started_at = perf_counter()
+
+    async def send(self, content=None, *, file=None, priority: int = PRIORITY_INFO, **kwargs):
+        """Com só o conteúdo e o arquivo a mensagem vai pela fila de saída e o retorno é um future com a Message
+        enviada, então `await (await ctx.send(...))` espera o envio. Os outros argumentos enviam direto."""
+        if kwargs:
+            return await super().send(content, file=file, **kwargs)
+        return await OUTBOUND.send(('canal', self.channel.id), super().send, content, file, priority)
+
+
+async def send_dm(ctx: Context, content: Optional[str] = None, file: Optional[File] = None,
+                  priority: int = PRIORITY_INFO) -> AsyncFuture:
+    return await OUTBOUND.send(('dm', ctx.author.id), ctx.author.send, content, file, priority)
+
+
+class LoopBudgetExceeded(commands.CommandError):
+    pass
+
+
+LoopStall = namedtuple('LoopStall', ['task', 'command', 'guild', 'stack'])
+
+
+class LoopWatchdog:
+    """Mede continuamente o atraso do event loop a partir de uma thread separada.
+
+    A thread agenda um callback no loop e espera ele rodar. Se a espera passa do `threshold`, a pilha da thread do
+    loop é amostrada junto com o comando da task que está rodando, e o travamento é registrado quando o callback
+    finalmente roda. Com `strict_budget`, os comandos que travarem o loop por mais tempo que isso falham com
+    LoopBudgetExceeded, para uso nos testes.
+    """
+
+    STACK_LIMIT = 25
+
+    def __init__(self, threshold: float, strict_budget: Optional[float] = None):
+        self.threshold = threshold
+        self.strict_budget = strict_budget
+        self.limit = threshold if strict_budget is None else min(threshold, strict_budget)
+        self._loop = None
+        self._loop_thread = None
+        self._thread = None  # type: Optional[threading.Thread]
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._commands = weakref.WeakKeyDictionary()  # task -> Context
+        self._violations = weakref.WeakKeyDictionary()  # task -> maior atraso
+
+    def start(self, loop=None):
+        """Chamado de dentro do event loop que vai ser vigiado"""
+        if self._thread is not None or self.threshold <= 0:
+            return
+        self._loop = loop or get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def track(self, ctx: Context):
+        """Associa a task atual ao comando de `ctx`"""
+        task = current_task()
+        if task is not None:
+            with self._lock:
+                self._commands[task] = ctx
+
+    def finish(self, ctx: Context):
+        """Chamado no fim do comando, no modo estrito falha se ele travou o loop além do orçamento"""
+        task = current_task()
+        if task is None:
+            return
+        with self._lock:
+            self._commands.pop(task, None)
+            lag = self._violations.pop(task, None)
+        if lag is not None:
+            raise LoopBudgetExceeded(f'{ctx.command} travou o event loop por {lag * 1000:.0f}ms, '
+                                     f'o orçamento é {self.strict_budget * 1000:.0f}ms')
+
+    def _sample(self) -> LoopStall:
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = ''.join(traceback.format_stack(frame, limit=self.STACK_LIMIT)) if frame is not None else ''
+        task = current_task(self._loop)
+        with self._lock:
+            ctx = self._commands.get(task) if task is not None else None
+        if ctx is None:
+            return LoopStall(task, None, None, stack)
+        return LoopStall(task, ctx.command.qualified_name, None if ctx.guild is None else ctx.guild.id, stack)
+
+    def _report(self, lag: float, stall: Optional[LoopStall]):
+        command = stall.command if stall is not None and stall.command is not None else 'nenhum'
+        METRICS.increment('vampiro_event_loop_stalls_total', command=command)
+        if stall is None:
+            print(f'WARNING event loop travado por {lag * 1000:.0f}ms, a pilha não foi amostrada a tempo')
+            return
+        if stall.command is not None:
+            origin = f'no comando {stall.command} do servidor {stall.guild}'
+        elif stall.task is not None:
+            origin = f'na task {stall.task.get_coro()!r}'
+        else:
+            origin = 'fora de uma task'
+        print(f'WARNING event loop travado por {lag * 1000:.0f}ms {origin}\n{stall.stack}', end='')
+
+    def _mark_violation(self, stall: LoopStall, lag: float):
+        """Marca o comando ainda travado, ele falha no finish quando o loop voltar"""
+        if stall.command is not None:
+            with self._lock:
+                self._violations[stall.task] = max(lag, self._violations.get(stall.task, 0.))
+
+    def _watch(self):
+        # O atraso só é medido a partir do envio do callback, então amostrar várias vezes dentro do limite deixa o
+        # erro da medida e a chance de perder a pilha pequenos
+        interval = self.limit / 4
+        while not self._stop.wait(interval):
+            ran = threading.Event()
+            ran_at = []
+
+            def beat():
+                ran_at.append(perf_counter())
+                ran.set()
+
+            sent_at = perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(beat)
+            except RuntimeError:
+                return  # loop fechado
+            stall = None
+            strict_checked = self.strict_budget is None
+            while not ran.wait(interval):
+                if self._stop.is_set() or self._loop.is_closed():
+                    return
+                waited = perf_counter() - sent_at
+                if stall is None:
+                    stall = self._sample()
+                if not strict_checked and waited >= self.strict_budget:
+                    # Amostra de novo, a task que estoura o orçamento é a que está rodando agora
+                    self._mark_violation(self._sample(), waited)
+                    strict_checked = True
+            lag = ran_at[0] - sent_at
+            METRICS.observe('vampiro_event_loop_lag_seconds', lag)
+            if lag >= self.limit:
+                self._report(lag, stall)
+
+
+WATCHDOG = LoopWatchdog(LOOP_STALL_THRESHOLD, LOOP_STRICT_BUDGET)
+
+
+class MetricsBotMixin:
+    async def get_context(self, message, *, cls=MetricsContext):
+        ctx = await super().get_context(message, cls=cls)
+        if ctx.command is not None:
+            WATCHDOG.track(ctx)
+        return ctx
+
+
+class Bot(MetricsBotMixin, commands.Bot):
+    pass
+
 
-REGEX_ALIAS_FULL_STR = f'^{REGEX_ALIAS}$'
+class ShardedBot(MetricsBotMixin, commands.AutoShardedBot):
+    """Roda só os shards de SHARD_IDS, os outros ficam nos demais processos iniciados pelo `--shards`"""
 
-bot = commands.Bot(command_prefix='%')
 
-FACES = np.arange(1, 11, dtype=np.uint)
+if SHARD_COUNT:
+    bot = ShardedBot(command_prefix='%', shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = Bot(command_prefix='%')
+
+
+@bot.after_invoke
+async def record_command_metrics(ctx: Context):
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        METRICS.observe('vampiro_command_seconds', perf_counter() - started_at, command=ctx.command.qualified_name)
+    if ctx.command_failed:
+        METRICS.increment('vampiro_command_errors_total', command=ctx.command.qualified_name)
+    WATCHDOG.finish(ctx)
+
+
+async def _write_metrics_file(path: Path):
+    temp_path = path.with_name(f'{path.name}.tmp')
+    while True:
+        await sleep(METRICS_INTERVAL)
+        try:
+            temp_path.write_text(METRICS.prometheus())
+            os.replace(temp_path, path)
+        except OSError as e:
+            print('ERROR ao gravar as métricas', repr(e))
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = METRICS.prometheus().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (IncompleteReadError, LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+METRICS_EXPORTERS = []
+
+
+async def start_metrics_export():
+    """Exporta as métricas em METRICS_FILE e/ou em http://METRICS_HOST:METRICS_PORT/, uma única vez"""
+    if METRICS_EXPORTERS:
+        return
+    if METRICS_FILE:
+        METRICS_EXPORTERS.append(create_task(_write_metrics_file(Path(METRICS_FILE))))
+    if METRICS_PORT:
+        METRICS_EXPORTERS.append(await start_server(_serve_metrics, METRICS_HOST, int(METRICS_PORT)))
+        print(f'Métricas em http://{METRICS_HOST}:{METRICS_PORT}/')
+
+
+_EMPTY_D10_BUFFER = np.empty(0, dtype=np.uint8)
+
+
+class _DiceStream:
+    __slots__ = ['generator', 'buffer', 'position']
+
+    def __init__(self, generator: np.random.Generator):
+        self.generator = generator
+        self.buffer = _EMPTY_D10_BUFFER
+        self.position = 0
+
+
+class DiceSource:
+    """Fonte dos dados, um numpy.random.Generator (PCG64) independente por fluxo (servidor).
+
+    Os d10 das rolagens de V5 saem de um buffer pré-gerado por fluxo, que é trocado por outro quando acaba. Com `seed`
+    os fluxos são determinísticos, cada um derivado da semente e do identificador do fluxo.
+
+    Só os `max_streams` fluxos usados mais recentemente ficam em memória, fora o das DMs. Um fluxo descartado que volta
+    recebe um generator novo com a contagem de descartes na spawn_key, então nunca repete os dados que já saíram.
+    """
+
+    def __init__(self, seed: Optional[int] = None, buffer_size: int = 4096, max_streams: int = DICE_STREAMS):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.buffer_size = buffer_size
+        self.max_streams = max_streams
+        self._streams = OrderedDict()  # type: OrderedDict[Optional[int], _DiceStream]
+        self._evicted = 0
+        # O %roll rola no DND_EXECUTOR, o lock protege o LRU e evita dois generators para o mesmo fluxo
+        self._lock = threading.Lock()
+
+    def _stream(self, stream: Optional[int]) -> _DiceStream:
+        with self._lock:
+            state = self._streams.get(stream)
+            if state is not None:
+                self._streams.move_to_end(stream)
+                return state
+            if stream is None:
+                spawn_key = ()
+            elif self._evicted:
+                spawn_key = (stream, self._evicted)
+            else:
+                spawn_key = (stream,)
+            seed = np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=spawn_key)
+            state = self._streams[stream] = _DiceStream(np.random.Generator(np.random.PCG64(seed)))
+            while len(self._streams) > self.max_streams:
+                oldest = next(iter(self._streams))
+                if oldest is None:
+                    self._streams.move_to_end(None)
+                    oldest = next(iter(self._streams))
+                del self._streams[oldest]
+                self._evicted += 1
+            return state
+
+    def generator(self, stream: Optional[int] = None) -> np.random.Generator:
+        return self._stream(stream).generator
+
+    def d10(self, size, stream: Optional[int] = None) -> np.ndarray:
+        """d10 somente leitura com o formato `size`"""
+        shape = size if isinstance(size, tuple) else (size,)
+        total = prod(shape)
+        if total > self.buffer_size:
+            return self.integers(10, shape, stream, dtype=np.uint8)
+        state = self._stream(stream)
+        if state.position + total > len(state.buffer):
+            state.buffer = state.generator.integers(1, 11, self.buffer_size, dtype=np.uint8)
+            state.buffer.setflags(write=False)
+            state.position = 0
+        position = state.position
+        state.position += total
+        return state.buffer[position:position + total].reshape(shape)
+
+    def integers(self, faces: int, size, stream: Optional[int] = None, dtype=np.int64) -> np.ndarray:
+        """Dados de `faces` faces com o formato `size`"""
+        return self.generator(stream).integers(1, faces + 1, size, dtype=dtype)
+
+
+DICE = DiceSource(None if DICE_SEED is None else int(DICE_SEED))
+
+
+def dice_stream(ctx: Context) -> Optional[int]:
+    return None if ctx.guild is None else ctx.guild.id
+
 
 NUMBER_FORMATS = {
     10: '**10**',
@@ -194,34 +999,38 @@ NUMBER_FORMATS = {
     1: '~~**1**~~'
 }
 
-DICE_IMAGE = cv2.imread('d10_faces.png')
-
-DICES_FACES = {
-    (False, 10): DICE_IMAGE[0:66, 0:62],
-    (False, 1): DICE_IMAGE[0:66, 62:124],
-    (False, 2): DICE_IMAGE[0:66, 124:186],
-    (False, 3): DICE_IMAGE[0:66, 186:248],
-    (False, 4): DICE_IMAGE[0:66, 248:310],
-    (False, 5): DICE_IMAGE[66:132, 0:62],
-    (False, 6): DICE_IMAGE[66:132, 62:124],
-    (False, 7): DICE_IMAGE[66:132, 124:186],
-    (False, 8): DICE_IMAGE[66:132, 186:248],
-    (False, 9): DICE_IMAGE[66:132, 248:310],
-    (True, 10): DICE_IMAGE[132:198, 0:62],
-    (True, 1): DICE_IMAGE[132:198, 62:124],
-    (True, 2): DICE_IMAGE[132:198, 124:186],
-    (True, 3): DICE_IMAGE[132:198, 186:248],
-    (True, 4): DICE_IMAGE[132:198, 248:310],
-    (True, 5): DICE_IMAGE[198:310, 0:62],
-    (True, 6): DICE_IMAGE[198:310, 62:124],
-    (True, 7): DICE_IMAGE[198:310, 124:186],
-    (True, 8): DICE_IMAGE[198:310, 186:248],
-    (True, 9): DICE_IMAGE[198:310, 248:310],
-}
 
 DICES_PER_LINE = 10
 DICES_LIMIT = 100
 
+REPEAT_REGEX = re.compile(r'^x(\d+)$')
+REPEAT_LIMIT = int(os.getenv('REPEAT_LIMIT', '50'))
+
+DND_NUMBER = r'(?:\d+|\([-0-9+*/]+\))'
+# Os modificadores de cada termo podem vir em qualquer ordem, cada um no máximo uma vez
+DND_MODIFIER_REGEX = re.compile(f'r<(?P<minimo>{DND_NUMBER})|(?P<explode>!)|kh(?P<keep_high>{DND_NUMBER})'
+                                f'|kl(?P<keep_low>{DND_NUMBER})|>=(?P<alvo>{DND_NUMBER})')
+DND_REGEX = re.compile(f'(?P<dados>{DND_NUMBER})d(?P<faces>{DND_NUMBER})'
+                       f'(?P<modificadores>(?:{DND_MODIFIER_REGEX.pattern})*)')
+DND_REPEAT_COLUMNS = 4
+DND_AGGREGATE_THRESHOLD = int(os.getenv('DND_AGGREGATE_THRESHOLD', '200'))
+DND_DICE_LIMIT = int(os.getenv('DND_DICE_LIMIT', '10000000'))
+DND_HISTOGRAM_FACES = 100
+# Faces do histograma mostradas na mensagem compacta, o resto fica só na soma
+DND_COMPACT_HISTOGRAM_FACES = 6
+# O numpy sorteia até int64, e a soma repetida usa faces + 1 como marcador
+DND_FACES_LIMIT = int(np.iinfo(np.int64).max) - 1
+DND_CHUNK_SIZE = 1 << 16
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+PROB_PRECOMPUTE = os.getenv('PROB_PRECOMPUTE', '0') == '1'
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='dice-image')
+DND_WORKERS = int(os.getenv('DND_WORKERS', '2'))
+DND_EXECUTOR = ThreadPoolExecutor(max_workers=DND_WORKERS, thread_name_prefix='dnd-roll')
+
 COMPULSAO = {
     1: "Fome",
     2: "Fome",
@@ -237,266 +1046,2173 @@ COMPULSAO = {
 
 
 def eval_expr(expr):
-    return eval_(ast.parse(expr, mode='eval').body)
+    return compile_expr(expr)(())
 
 
-def eval_(node):
-    if isinstance(node, ast.Num):  # <number>
-        return node.n
+def _compile_expr(expr: str, names: Optional[Dict[str, int]] = None) -> Callable:
+    """Compila uma expressão aritmética em uma closure que recebe os valores das referências `names`"""
+    return _compile_node(ast.parse(expr, mode='eval').body, names or {})
+
+
+def _compile_node(node, names: Dict[str, int]) -> Callable:
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):  # <number>
+        value = node.value
+        return lambda values: value
+    elif isinstance(node, ast.Name) and node.id in names:  # <referência à ficha>
+        return op.itemgetter(names[node.id])
     elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-        return operators[type(node.op)](eval_(node.left), eval_(node.right))
+        operator = operators[type(node.op)]
+        left = _compile_node(node.left, names)
+        right = _compile_node(node.right, names)
+        return lambda values: operator(left(values), right(values))
     elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-        return operators[type(node.op)](eval_(node.operand))
+        operator = operators[type(node.op)]
+        operand = _compile_node(node.operand, names)
+        return lambda values: operator(operand(values))
     else:
         raise TypeError(node)
 
 
+compile_expr = lru_cache(maxsize=EXPRESSION_CACHE_SIZE)(_compile_expr)
+
+CompiledSheetExpression = namedtuple('CompiledSheetExpression', ['display', 'refs', 'function'])
+
+
+def _build_alias_trie(aliases) -> dict:
+    trie = {}
+    for alias in aliases:
+        node = trie
+        for char in alias:
+            node = node.setdefault(char, {})
+        node[None] = alias
+    return trie
+
+
+ALIAS_TRIE = _build_alias_trie(ALIAS)
+
+CHARACTER_NAME_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789_')
+
+
+def _match_alias(text: str, start: int) -> Optional[str]:
+    """Maior alias que começa em `start`"""
+    node = ALIAS_TRIE
+    found = None
+    for char in text[start:]:
+        node = node.get(char)
+        if node is None:
+            break
+        found = node.get(None, found)
+    return found
+
+
+def tokenize_sheet_expression(text: str):
+    """Encontra as referências `[ficha.]alias` do texto já limpo, gera (início, fim, ficha, alias)"""
+    size = len(text)
+    i = 0
+    while i < size:
+        j = i
+        while j < size and text[j] in CHARACTER_NAME_CHARS:
+            j += 1
+        if i < j < size and text[j] == '.':
+            alias = _match_alias(text, j + 1)
+            if alias is not None:
+                end = j + 1 + len(alias)
+                yield i, end, text[i:j], alias
+                i = end
+                continue
+        alias = _match_alias(text, i)
+        if alias is not None:
+            end = i + len(alias)
+            yield i, end, None, alias
+            i = end
+        else:
+            i += 1
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_sheet_expression(expression: str) -> CompiledSheetExpression:
+    """Compila uma expressão com atributos da ficha, refs são pares (ficha, atributo) na ordem dos valores"""
+    display_fragments = []
+    process_fragments = []
+    refs = []
+    names = {}
+    prefix = '_ficha'
+    while prefix in expression:
+        prefix += '_'
+    last_end = 0
+    for start, end, character, alias in tokenize_sheet_expression(clean_text(expression)):
+        fragment = expression[last_end:start]
+        display_fragments.append(fragment)
+        process_fragments.append(fragment)
+        last_end = end
+        status = ALIAS[alias]
+        display_fragments.append(status)
+        name = f'{prefix}{len(refs)}'
+        names[name] = len(refs)
+        refs.append(('' if character is None else character, status))
+        process_fragments.append(f'({name})')
+    display_fragments.append(expression[last_end:])
+    process_fragments.append(expression[last_end:])
+    return CompiledSheetExpression(''.join(display_fragments), tuple(refs),
+                                   _compile_expr(''.join(process_fragments), names))
+
+
+def _write_sheets_snapshot(snapshot, path: Path):
+    temp_path = path.with_name(f'{path.name}.tmp')
+    with METRICS.time('vampiro_persistence_seconds', backend='csv', operacao='snapshot'):
+        with temp_path.open('w', newline='') as fp:
+            snapshot.to_csv(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+
+
+class SheetsWriter:
+    """Write-behind do arquivo de fichas.
+
+    As alterações só marcam as fichas como sujas, uma tarefa em segundo plano junta todas elas em um único snapshot
+    gravado fora do event loop a cada `interval` segundos ou quando `threshold` alterações se acumulam. O snapshot é
+    qualquer objeto com to_csv, como um DataFrame ou um SheetSnapshot.
+    """
+
+    def __init__(self, path: Path, snapshot: Callable, interval: float, threshold: int):
+        self.path = path
+        self.snapshot = snapshot
+        self.interval = interval
+        self.threshold = threshold
+        self.dirty = 0
+        self._wake = None  # type: Optional[Event]
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-writer')
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._wake = Event()
+        self._task = create_task(self._run())
+
+    def mark_dirty(self):
+        self.dirty += 1
+        if self.dirty >= self.threshold and self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await wait_for(self._wake.wait(), timeout=self.interval)
+            except AsyncTimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print('ERROR ao gravar as fichas', repr(e))
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        # A cópia é feita no event loop, sem await no meio, então é um snapshot consistente. O contador só é zerado
+        # depois dela, se a cópia falhar as alterações continuam pendentes para a próxima tentativa
+        with METRICS.time('vampiro_persistence_seconds', backend='csv', operacao='copia'):
+            snapshot = self.snapshot()
+        dirty = self.dirty
+        self.dirty = 0
+        try:
+            await get_event_loop().run_in_executor(self._executor, _write_sheets_snapshot, snapshot, self.path)
+        except BaseException:
+            self.dirty += dirty
+            raise
+
+    def flush_sync(self):
+        """Gravação forçada no desligamento, depois que o event loop já parou"""
+        self._executor.shutdown(wait=True)
+        if self.dirty:
+            _write_sheets_snapshot(self.snapshot(), self.path)
+            self.dirty = 0
+
+
+class SheetLocks:
+    """Locks das fichas divididos em faixas por (guild, user).
+
+    Todas as fichas de um jogador caem na mesma faixa, então uma expressão como `ficha2.fome` é lida com uma única
+    aquisição, enquanto jogadores e servidores diferentes praticamente nunca disputam o mesmo lock.
+    """
+
+    def __init__(self, stripes: int, wait_warning: float):
+        self._locks = [Lock() for _ in range(stripes)]
+        self.wait_warning = wait_warning
+
+    def hold(self, guild: int, user: int):
+        return self.hold_many([(guild, user)])
+
+    @asynccontextmanager
+    async def hold_many(self, players: Sequence[Tuple[int, int]]):
+        """Segura as faixas de vários jogadores, sempre em ordem crescente para que duas escritas em grupo que
+        compartilham faixas não possam travar uma esperando pela outra"""
+        stripes = sorted({hash(player) % len(self._locks) for player in players})
+        if any(self._locks[i].locked() for i in stripes):
+            METRICS.increment('vampiro_sheet_lock_contended_total')
+        start = perf_counter()
+        held = []  # type: List[Lock]
+        try:
+            for i in stripes:
+                await self._locks[i].acquire()
+                held.append(self._locks[i])
+            acquired = perf_counter()
+            wait = acquired - start
+            METRICS.observe('vampiro_sheet_lock_wait_seconds', wait)
+            if wait >= self.wait_warning:
+                guild, user = players[0]
+                quem = f'{user} em {guild}' if len(players) == 1 else f'{len(players)} jogadores em {guild}'
+                print(f'WARNING esperou {wait * 1000:.1f}ms pelo lock da ficha de {quem}')
+            try:
+                yield
+            finally:
+                METRICS.observe('vampiro_sheet_lock_hold_seconds', perf_counter() - acquired)
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+
+SHEET_LOCKS = SheetLocks(SHEET_LOCK_STRIPES, SHEET_LOCK_WAIT_WARNING)
+
+SheetKey = Tuple[int, int, str]
+MacroExpressions = Tuple[str, str, str]
+MACRO_COLUMNS = ['parada', 'fome', 'dificuldade']
+
+
+class SheetStore(ABC):
+    """Interface de armazenamento das fichas, indexadas por (guild, user, character)"""
+
+    # get_many lê todos os valores de um mesmo instante, então as leituras dispensam o lock das fichas
+    atomic_reads = False
+
+    def load(self):
+        """Abre o armazenamento, chamado antes do bot conectar"""
+
+    def start(self):
+        """Inicia as tarefas em segundo plano, chamado já dentro do event loop"""
+
+    @abstractmethod
+    async def save(self, key: SheetKey, sheet: Dict[str, int]):
+        """Cria ou substitui a ficha inteira, atributos ausentes ficam com 0"""
+
+    async def save_many(self, sheets: Sequence[Tuple[SheetKey, Dict[str, int]]]):
+        """Cria ou substitui várias fichas de uma vez, em uma única escrita"""
+        for key, sheet in sheets:
+            await self.save(key, sheet)
+
+    @abstractmethod
+    async def get_many(self, refs: Sequence[Tuple[SheetKey, str]]) -> List[int]:
+        """Lê vários atributos de uma vez, levanta KeyError se alguma ficha não existir"""
+
+    async def get(self, key: SheetKey, attr: str) -> Optional[int]:
+        """Lê um atributo, None se a ficha não existir"""
+        try:
+            return (await self.get_many([(key, attr)]))[0]
+        except KeyError:
+            return None
+
+    @abstractmethod
+    async def set(self, key: SheetKey, attr: str, value: int) -> bool:
+        """Altera um atributo, False se a ficha não existir"""
+
+    @abstractmethod
+    async def increment(self, key: SheetKey, attr: str, delta: int = 1) -> Optional[int]:
+        """Soma delta a um atributo e devolve o novo valor, None se a ficha não existir"""
+
+    @abstractmethod
+    async def get_guild_sheets(self, guild: int, attrs: Sequence[str]) -> Tuple[List[Tuple[int, str]], np.ndarray]:
+        """Todas as fichas de um servidor: os pares (user, character) e a matriz (fichas, atributos)"""
+
+    @abstractmethod
+    async def increment_many(self, keys: Sequence[SheetKey], attr: str, deltas: Sequence[int]) -> List[int]:
+        """Soma os deltas a um atributo de várias fichas existentes em uma única escrita, devolve os novos valores.
+
+        Levanta KeyError sem alterar nada se alguma ficha não existir"""
+
+    @abstractmethod
+    async def get_macros(self, key: SheetKey) -> Dict[str, MacroExpressions]:
+        """Macros de uma ficha, nome -> (parada, fome, dificuldade)"""
+
+    @abstractmethod
+    async def save_macro(self, key: SheetKey, name: str, expressions: MacroExpressions):
+        """Cria ou substitui uma macro da ficha"""
+
+    @abstractmethod
+    async def delete_macro(self, key: SheetKey, name: str) -> bool:
+        """Apaga uma macro, False se ela não existir"""
+
+    async def flush(self):
+        """Garante que as alterações pendentes estejam em disco"""
+
+    def close(self):
+        """Chamado no desligamento, depois que o event loop parou"""
+
+
+def macros_path(sheets_path: Path) -> Path:
+    """Arquivo das macros do backend csv, ao lado do arquivo das fichas"""
+    return sheets_path.with_name(f'{sheets_path.stem}_macros{sheets_path.suffix}')
+
+
+def read_macros_csv(path: Path) -> Dict[SheetKey, Dict[str, MacroExpressions]]:
+    import pandas as pd
+    df = pd.read_csv(path, keep_default_na=False, dtype={k: str for k in ['character', 'macro'] + MACRO_COLUMNS})
+    macros = {}
+    for guild, user, character, name, *expressions in df[['guild', 'user', 'character', 'macro'] + MACRO_COLUMNS] \
+            .itertuples(index=False):
+        macros.setdefault((int(guild), int(user), character), {})[name] = tuple(expressions)
+    return macros
+
+
+def read_sheets_csv(path: Path) -> 'pd.DataFrame':
+    import pandas as pd
+    return pd.read_csv(path, index_col=['guild', 'user', 'character'], keep_default_na=False,
+                       dtype={k: int for k in SHEET_COLUMNS})
+
+
+class SheetSnapshot(namedtuple('SheetSnapshot', ['guilds', 'users', 'characters', 'names', 'columns'])):
+    """Fichas congeladas em um instante, nenhum dos arrays referenciados é alterado depois"""
+
+    def _flat_frame(self) -> 'pd.DataFrame':
+        import pandas as pd
+        keys = {'guild': self.guilds, 'user': self.users,
+                'character': np.array(self.names, dtype=object)[self.characters]}
+        return pd.DataFrame({**keys, **self.columns})
+
+    def to_frame(self) -> 'pd.DataFrame':
+        return self._flat_frame().set_index(['guild', 'user', 'character'])
+
+    def to_csv(self, fp):
+        # Mesmo arquivo do to_frame().to_csv, mas o pandas grava o índice comum bem mais rápido que o MultiIndex
+        self._flat_frame().to_csv(fp, index=False)
+
+
+SHEET_KEY_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9)
+UINT64_MASK = (1 << 64) - 1
+
+
+def sheet_key_hash(guild: int, user: int, code: int) -> int:
+    """Hash de 63 bits de uma chave, igual ao sheet_key_hashes do mesmo (guild, user, código do personagem)"""
+    m1, m2, m3 = SHEET_KEY_MULTIPLIERS
+    h = (guild * m1 ^ user * m2 ^ code * m3) & UINT64_MASK
+    h ^= h >> 29
+    return ((h * m1) & UINT64_MASK) >> 1
+
+
+def sheet_key_hashes(guilds: np.ndarray, users: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    m1, m2, m3 = (np.uint64(x) for x in SHEET_KEY_MULTIPLIERS)
+    h = guilds.astype(np.uint64) * m1 ^ users.astype(np.uint64) * m2 ^ codes.astype(np.uint64) * m3
+    h ^= h >> np.uint64(29)
+    h *= m1
+    return (h >> np.uint64(1)).astype(np.int64)
+
+
+class SheetTable:
+    """Fichas em colunas contíguas de inteiros pequenos, com um índice da chave para a linha.
+
+    As linhas só são acrescentadas no fim e nunca mudam de lugar. Cada coluna usa o menor tipo inteiro que comporta os
+    seus valores e é alargada quando um valor novo não cabe. As colunas entregues em um snapshot ficam somente leitura,
+    a próxima escrita em cada uma delas a copia antes (copy-on-write), então quem lê um snapshot nunca espera as
+    escritas e cada coluna é copiada no máximo uma vez por snapshot.
+
+    O índice é um array ordenado dos hashes das chaves, 12 bytes por ficha em vez dos ~150 de um dict de tuplas. As
+    fichas novas ficam em um dict pequeno até `recent_limit` delas serem juntadas ao array de uma vez.
+    """
+
+    recent_limit = 4096
+
+    def __init__(self, attrs: Sequence[str], capacity: int = 1024):
+        self.size = 0
+        self._hashes = np.zeros(0, dtype=np.int64)
+        self._order = np.zeros(0, dtype=np.int32)
+        self._recent = {}  # type: Dict[SheetKey, int]
+        self.names = []  # type: List[str]
+        self._name_codes = {}  # type: Dict[str, int]
+        self.guilds = np.zeros(capacity, dtype=np.int64)
+        self.users = np.zeros(capacity, dtype=np.int64)
+        self.characters = np.zeros(capacity, dtype=np.int32)
+        self.columns = {attr: np.zeros(capacity, dtype=np.uint8) for attr in attrs}  # type: Dict[str, np.ndarray]
+        self._shared = set()  # type: Set[str]
+
+    @classmethod
+    def from_frame(cls, df: 'pd.DataFrame', attrs: Sequence[str]) -> 'SheetTable':
+        import pandas as pd
+        size = len(df)
+        table = cls(attrs, size + size // 8 + 1024)
+        for attr in df.columns:
+            values = df[attr].to_numpy(dtype=np.int64)
+            if size:
+                table._writable(attr, int(values.min()), int(values.max()))[:size] = values
+        codes, names = pd.factorize(df.index.get_level_values('character'))
+        table.guilds[:size] = df.index.get_level_values('guild').to_numpy(dtype=np.int64)
+        table.users[:size] = df.index.get_level_values('user').to_numpy(dtype=np.int64)
+        table.characters[:size] = codes
+        table.names = names.tolist()
+        table._name_codes = {name: code for code, name in enumerate(table.names)}
+        table.size = size
+        table._index(np.arange(size))
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key: SheetKey):
+        return self._row(key) is not None
+
+    def _index(self, rows: np.ndarray):
+        """Junta as linhas ao array ordenado dos hashes"""
+        hashes = sheet_key_hashes(self.guilds[rows], self.users[rows], self.characters[rows])
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        positions = np.searchsorted(self._hashes, hashes)
+        self._hashes = np.insert(self._hashes, positions, hashes)
+        self._order = np.insert(self._order, positions, rows[order])
+
+    def _row(self, key: SheetKey) -> Optional[int]:
+        row = self._recent.get(key)
+        if row is not None:
+            return row
+        guild, user, character = key
+        code = self._name_codes.get(character)
+        if code is None:
+            return None
+        h = sheet_key_hash(guild, user, code)
+        i = int(np.searchsorted(self._hashes, h))
+        while i < len(self._hashes) and self._hashes[i] == h:
+            row = int(self._order[i])
+            if self.guilds[row] == guild and self.users[row] == user and self.characters[row] == code:
+                return row
+            i += 1
+        return None
+
+    def _writable(self, attr: str, low: int, high: int, copy: bool = True) -> np.ndarray:
+        """A coluna pronta para receber valores entre low e high, alargada ou copiada se preciso.
+
+        Com copy=False a coluna ainda entregue a um snapshot não é copiada, só para escrever nas linhas a partir de
+        `size`, que nenhum snapshot enxerga.
+        """
+        column = self.columns.get(attr)
+        if column is None:
+            column = self.columns[attr] = np.zeros(len(self.guilds), dtype=np.uint8)
+        info = np.iinfo(column.dtype)
+        if low < info.min or high > info.max:
+            dtype = np.result_type(column.dtype, np.min_scalar_type(low), np.min_scalar_type(high))
+            # uint64 com negativos vira float, fica no int64 como o DataFrame antigo
+            column = self.columns[attr] = column.astype(np.int64 if dtype.kind == 'f' else dtype)
+        elif attr in self._shared:
+            if not copy:
+                return column
+            column = self.columns[attr] = column.copy()
+        self._shared.discard(attr)
+        return column
+
+    def reserve(self, rows: int):
+        capacity = len(self.guilds)
+        if self.size + rows <= capacity:
+            return
+        capacity = max(self.size + rows, capacity + capacity // 2)
+
+        def grown(array: np.ndarray) -> np.ndarray:
+            new = np.zeros(capacity, dtype=array.dtype)
+            new[:self.size] = array[:self.size]
+            return new
+
+        self.guilds = grown(self.guilds)
+        self.users = grown(self.users)
+        self.characters = grown(self.characters)
+        self.columns = {attr: grown(column) for attr, column in self.columns.items()}
+        self._shared.clear()
+
+    def _name_code(self, name: str) -> int:
+        code = self._name_codes.get(name)
+        if code is None:
+            code = self._name_codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def get(self, key: SheetKey, attr: str) -> int:
+        """Levanta KeyError se a ficha ou o atributo não existirem"""
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return int(self.columns[attr][row])
+
+    def get_many(self, refs: Sequence[Tuple[SheetKey, str]]) -> List[int]:
+        """Como o get, procurando cada ficha uma vez só"""
+        rows = {}
+        values = []
+        for key, attr in refs:
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = self._row(key)
+                if row is None:
+                    raise KeyError(key)
+            values.append(int(self.columns[attr][row]))
+        return values
+
+    def set(self, key: SheetKey, attr: str, value: int) -> bool:
+        row = self._row(key)
+        if row is None:
+            return False
+        self._writable(attr, value, value)[row] = value
+        return True
+
+    def increment(self, key: SheetKey, attr: str, delta: int) -> Optional[int]:
+        row = self._row(key)
+        if row is None:
+            return None
+        value = int(self.columns[attr][row]) + delta
+        self._writable(attr, value, value)[row] = value
+        return value
+
+    def increment_many(self, keys: Sequence[SheetKey], attr: str, deltas: Sequence[int]) -> np.ndarray:
+        """Levanta KeyError sem alterar nada se alguma ficha não existir"""
+        rows = [self._row(key) for key in keys]
+        if None in rows:
+            raise KeyError(keys[rows.index(None)])
+        rows = np.array(rows, dtype=np.int64)
+        values = self.columns[attr][rows].astype(np.int64) + np.asarray(deltas, dtype=np.int64)
+        if len(values):
+            self._writable(attr, int(values.min()), int(values.max()))[rows] = values
+        return values
+
+    def put(self, key: SheetKey, sheet: Dict[str, int]):
+        """Cria ou substitui a ficha inteira, atributos ausentes ficam com 0"""
+        row = self._row(key)
+        if row is None:
+            self.reserve(1)
+            row = self.size
+            for attr, value in sheet.items():
+                if value:
+                    # A linha nova fica fora de todos os snapshots já entregues, então não precisa copiar as colunas
+                    self._writable(attr, value, value, copy=False)[row] = value
+            self.guilds[row], self.users[row], self.characters[row] = key[0], key[1], self._name_code(key[2])
+            self._recent[key] = row
+            self.size += 1
+            if len(self._recent) >= self.recent_limit:
+                self._index(np.fromiter(self._recent.values(), dtype=np.int64, count=len(self._recent)))
+                self._recent.clear()
+            return
+        for attr in self.columns.keys() | sheet.keys():
+            value = sheet.get(attr, 0)
+            column = self.columns.get(attr)
+            if column is None or column[row] != value:
+                self._writable(attr, value, value)[row] = value
+
+    def guild_sheets(self, guild: int, attrs: Sequence[str]) -> Tuple[List[Tuple[int, str]], np.ndarray]:
+        columns = [self.columns[attr] for attr in attrs]
+        rows = np.flatnonzero(self.guilds[:self.size] == guild)
+        keys = [(user, self.names[code]) for user, code in zip(self.users[rows].tolist(),
+                                                               self.characters[rows].tolist())]
+        values = np.empty((len(rows), len(attrs)), dtype=np.int64)
+        for i, column in enumerate(columns):
+            values[:, i] = column[rows]
+        return keys, values
+
+    def snapshot(self) -> SheetSnapshot:
+        """Visões somente leitura do estado atual, válidas mesmo depois de novas escritas"""
+        self._shared.update(self.columns)
+        size = self.size
+        return SheetSnapshot(self.guilds[:size], self.users[:size], self.characters[:size], tuple(self.names),
+                             {attr: column[:size] for attr, column in self.columns.items()})
+
+    def nbytes(self) -> int:
+        """Memória dos arrays das fichas e do índice"""
+        arrays = [self.guilds, self.users, self.characters, self._hashes, self._order, *self.columns.values()]
+        return sum(x.nbytes for x in arrays)
+
+
+class CsvSheetStore(SheetStore):
+    """Fichas em uma SheetTable em memória, persistidas em CSV pelo SheetsWriter.
+
+    Nenhum método faz await enquanto mexe na tabela, então cada chamada já é atômica dentro do event loop e as leituras
+    não precisam do lock das fichas. O SheetsWriter grava um snapshot da tabela, sem copiar as fichas no event loop.
+    """
+
+    atomic_reads = True
+
+    def __init__(self, path: Path, flush_interval: float, flush_threshold: int):
+        self.path = path
+        self.table = None  # type: Optional[SheetTable]
+        self.macros = {}  # type: Dict[SheetKey, Dict[str, MacroExpressions]]
+        self.writer = SheetsWriter(path, lambda: self.table.snapshot(), flush_interval, flush_threshold)
+        self.macros_writer = SheetsWriter(macros_path(path), self._macros_snapshot, flush_interval, flush_threshold)
+
+    def load(self):
+        if not self.path.is_file():
+            self.table = SheetTable(SHEET_COLUMNS)
+            with self.path.open('w', newline='') as fp:
+                self.table.snapshot().to_csv(fp)
+        else:
+            df = read_sheets_csv(self.path)
+            self.table = SheetTable.from_frame(df, list(df.columns) + [x for x in SHEET_COLUMNS if x not in df])
+        if macros_path(self.path).is_file():
+            self.macros = read_macros_csv(macros_path(self.path))
+
+    def _macros_snapshot(self) -> 'pd.DataFrame':
+        import pandas as pd
+        rows = [(*key, name, *expressions) for key, macros in self.macros.items()
+                for name, expressions in macros.items()]
+        return pd.DataFrame(rows, columns=['guild', 'user', 'character', 'macro'] + MACRO_COLUMNS).set_index(
+            ['guild', 'user', 'character', 'macro'])
+
+    def start(self):
+        self.writer.start()
+        self.macros_writer.start()
+
+    async def save(self, key, sheet):
+        self.table.put(key, {k: int(v) for k, v in sheet.items()})
+        self.writer.mark_dirty()
+
+    async def save_many(self, sheets):
+        self.table.reserve(len(sheets))
+        for key, sheet in sheets:
+            self.table.put(key, {k: int(v) for k, v in sheet.items()})
+        self.writer.mark_dirty()
+
+    async def get_many(self, refs):
+        return self.table.get_many(refs)
+
+    async def set(self, key, attr, value):
+        if not self.table.set(key, attr, int(value)):
+            return False
+        self.writer.mark_dirty()
+        return True
+
+    async def increment(self, key, attr, delta=1):
+        value = self.table.increment(key, attr, int(delta))
+        if value is not None:
+            self.writer.mark_dirty()
+        return value
+
+    async def get_guild_sheets(self, guild, attrs):
+        return self.table.guild_sheets(guild, attrs)
+
+    async def increment_many(self, keys, attr, deltas):
+        values = self.table.increment_many(keys, attr, deltas)
+        self.writer.mark_dirty()
+        return values.tolist()
+
+    async def get_macros(self, key):
+        return dict(self.macros.get(key, {}))
+
+    async def save_macro(self, key, name, expressions):
+        self.macros.setdefault(key, {})[name] = tuple(expressions)
+        self.macros_writer.mark_dirty()
+
+    async def delete_macro(self, key, name):
+        macros = self.macros.get(key, {})
+        if name not in macros:
+            return False
+        del macros[name]
+        if not macros:
+            del self.macros[key]
+        self.macros_writer.mark_dirty()
+        return True
+
+    async def flush(self):
+        await gather(self.writer.flush(), self.macros_writer.flush())
+
+    def close(self):
+        self.writer.flush_sync()
+        self.macros_writer.flush_sync()
+
+
+def _sql_name(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SqliteSheetStore(SheetStore):
+    """Fichas em SQLite (WAL), cada alteração de atributo é um UPDATE de uma única linha.
+
+    A conexão vive em uma thread dedicada, então as consultas não bloqueiam o event loop e ficam serializadas.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-sqlite')
+
+    def load(self):
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        self._conn = connect_sheets_db(self.path)
+
+    async def _run(self, fn, *args):
+        return await get_event_loop().run_in_executor(self._executor, self._timed, fn, *args)
+
+    @staticmethod
+    def _timed(fn, *args):
+        with METRICS.time('vampiro_persistence_seconds', backend='sqlite', operacao=fn.__name__.lstrip('_')):
+            return fn(*args)
+
+    def _save(self, key, sheet):
+        values = {k: 0 for k in SHEET_COLUMNS}
+        values.update({k: int(v) for k, v in sheet.items()})
+        with self._conn:
+            _insert_sheets(self._conn, [(*key, *[values[k] for k in SHEET_COLUMNS])])
+
+    async def save(self, key, sheet):
+        await self._run(self._save, key, sheet)
+
+    def _save_many(self, sheets):
+        rows = []
+        for key, sheet in sheets:
+            values = {k: 0 for k in SHEET_COLUMNS}
+            values.update({k: int(v) for k, v in sheet.items()})
+            rows.append((*key, *[values[k] for k in SHEET_COLUMNS]))
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            _insert_sheets(self._conn, rows)
+
+    async def save_many(self, sheets):
+        await self._run(self._save_many, sheets)
+
+    def _get_many(self, refs):
+        result = []
+        with self._conn:
+            self._conn.execute('BEGIN')
+            for (guild, user, character), attr in refs:
+                row = self._conn.execute(
+                    f'SELECT {_sql_name(attr)} FROM fichas WHERE guild = ? AND user = ? AND character = ?',
+                    (guild, user, character)).fetchone()
+                if row is None:
+                    raise KeyError((guild, user, character))
+                result.append(row[0])
+        return result
+
+    async def get_many(self, refs):
+        return await self._run(self._get_many, refs)
+
+    def _set(self, key, attr, value):
+        with self._conn:
+            cursor = self._conn.execute(
+                f'UPDATE fichas SET {_sql_name(attr)} = ? WHERE guild = ? AND user = ? AND character = ?',
+                (int(value), *key))
+        return cursor.rowcount > 0
+
+    async def set(self, key, attr, value):
+        return await self._run(self._set, key, attr, value)
+
+    def _increment(self, key, attr, delta):
+        column = _sql_name(attr)
+        with self._conn:
+            # Pega o lock de escrita antes do UPDATE, o SELECT vê o próprio incremento mesmo com outros processos
+            # escrevendo no mesmo banco
+            self._conn.execute('BEGIN IMMEDIATE')
+            cursor = self._conn.execute(
+                f'UPDATE fichas SET {column} = {column} + ? WHERE guild = ? AND user = ? AND character = ?',
+                (int(delta), *key))
+            if cursor.rowcount == 0:
+                return None
+            return self._conn.execute(
+                f'SELECT {column} FROM fichas WHERE guild = ? AND user = ? AND character = ?', key).fetchone()[0]
+
+    async def increment(self, key, attr, delta=1):
+        return await self._run(self._increment, key, attr, delta)
+
+    def _get_guild_sheets(self, guild, attrs):
+        columns = ', '.join(_sql_name(x) for x in attrs)
+        rows = self._conn.execute(f'SELECT user, character, {columns} FROM fichas WHERE guild = ? '
+                                  'ORDER BY user, character', (guild,)).fetchall()
+        return [(user, character) for user, character, *_ in rows], \
+            np.array([values for _, _, *values in rows], dtype=np.int64).reshape(len(rows), len(attrs))
+
+    async def get_guild_sheets(self, guild, attrs):
+        return await self._run(self._get_guild_sheets, guild, attrs)
+
+    def _increment_many(self, keys, attr, deltas):
+        column = _sql_name(attr)
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany(
+                f'UPDATE fichas SET {column} = {column} + ? WHERE guild = ? AND user = ? AND character = ?',
+                [(int(delta), *key) for key, delta in zip(keys, deltas)])
+            values = []
+            for key in keys:
+                row = self._conn.execute(f'SELECT {column} FROM fichas WHERE guild = ? AND user = ? AND character = ?',
+                                         key).fetchone()
+                if row is None:
+                    # A exceção sai do `with` e desfaz as fichas que já tinham sido atualizadas
+                    raise KeyError(key)
+                values.append(row[0])
+            return values
+
+    async def increment_many(self, keys, attr, deltas):
+        return await self._run(self._increment_many, keys, attr, deltas)
+
+    def _get_macros(self, key):
+        rows = self._conn.execute('SELECT nome, parada, fome, dificuldade FROM macros '
+                                  'WHERE guild = ? AND user = ? AND character = ?', key).fetchall()
+        return {name: tuple(expressions) for name, *expressions in rows}
+
+    async def get_macros(self, key):
+        return await self._run(self._get_macros, key)
+
+    def _save_macro(self, key, name, expressions):
+        with self._conn:
+            _insert_macros(self._conn, [(*key, name, *expressions)])
+
+    async def save_macro(self, key, name, expressions):
+        await self._run(self._save_macro, key, name, expressions)
+
+    def _delete_macro(self, key, name):
+        with self._conn:
+            cursor = self._conn.execute(
+                'DELETE FROM macros WHERE guild = ? AND user = ? AND character = ? AND nome = ?', (*key, name))
+        return cursor.rowcount > 0
+
+    async def delete_macro(self, key, name):
+        return await self._run(self._delete_macro, key, name)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
+
+
+def connect_sheets_db(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+    # Com shards vários processos usam o mesmo banco, quem encontrar o lock ocupado espera em vez de falhar
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    columns = ', '.join(f'{_sql_name(k)} INTEGER NOT NULL DEFAULT 0' for k in SHEET_COLUMNS)
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS fichas (
+        guild INTEGER NOT NULL,
+        user INTEGER NOT NULL,
+        character TEXT NOT NULL,
+        {columns},
+        PRIMARY KEY (guild, user, character)
+    ) WITHOUT ROWID''')
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(fichas)')}
+    for k in SHEET_COLUMNS:
+        if k not in existing:
+            conn.execute(f'ALTER TABLE fichas ADD COLUMN {_sql_name(k)} INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''CREATE TABLE IF NOT EXISTS macros (
+        guild INTEGER NOT NULL,
+        user INTEGER NOT NULL,
+        character TEXT NOT NULL,
+        nome TEXT NOT NULL,
+        parada TEXT NOT NULL,
+        fome TEXT NOT NULL,
+        dificuldade TEXT NOT NULL,
+        PRIMARY KEY (guild, user, character, nome)
+    ) WITHOUT ROWID''')
+    return conn
+
+
+def _insert_sheets(conn: sqlite3.Connection, rows):
+    columns = ', '.join(['guild', 'user', 'character'] + [_sql_name(k) for k in SHEET_COLUMNS])
+    placeholders = ', '.join(['?'] * (len(SHEET_COLUMNS) + 3))
+    conn.executemany(f'INSERT OR REPLACE INTO fichas ({columns}) VALUES ({placeholders})', rows)
+
+
+def _insert_macros(conn: sqlite3.Connection, rows):
+    conn.executemany('INSERT OR REPLACE INTO macros (guild, user, character, nome, parada, fome, dificuldade) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def import_csv_to_sqlite(csv_path: Path, db_path: Path) -> int:
+    """Importa de uma vez todas as fichas, e as macros delas, de um CSV do backend csv para o banco SQLite"""
+    sheets = read_sheets_csv(csv_path).reindex(columns=SHEET_COLUMNS, fill_value=0)
+    rows = [(int(guild), int(user), str(character), *[int(x) for x in values])
+            for (guild, user, character), values in zip(sheets.index, sheets.itertuples(index=False))]
+    macros = read_macros_csv(macros_path(csv_path)) if macros_path(csv_path).is_file() else {}
+    conn = connect_sheets_db(db_path)
+    try:
+        conn.execute('BEGIN')
+        _insert_sheets(conn, rows)
+        _insert_macros(conn, [(*key, name, *expressions) for key, x in macros.items()
+                              for name, expressions in x.items()])
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return len(rows)
+
+
+ROLL_LOG_DTYPE = np.dtype([
+    ('guild', '<u8'),
+    ('user', '<u8'),
+    ('character', 'S24'),
+    ('timestamp', '<f8'),
+    ('comando', 'u1'),
+    ('resultado', 'u1'),
+    ('fome', '<u2'),
+    ('parada', '<u4'),
+    ('dificuldade', '<u4'),
+    ('acertos', '<i8'),
+])
+
+# Maior float64 que ainda cabe no campo acertos, os resultados do %roll podem passar muito disso
+ROLL_LOG_ACERTOS_LIMIT = float(np.nextafter(2. ** 63, 0))
+
+# O código do comando gravado é a posição nesta lista, só acrescente no final
+ROLL_LOG_COMMANDS = ['roll5e', 'roll5f', 'rc', 'rcf', 'compulsao', 'roll', 'rollgrupo', 'rcgrupo']
+
+
+ROLL_LOG_CHARACTER_BYTES = ROLL_LOG_DTYPE['character'].itemsize
+
+
+def roll_log_character(character: str) -> bytes:
+    """Nome do personagem como é gravado no histórico, o mesmo na gravação e na consulta.
+
+    Nomes que cabem no campo ficam como estão. Os maiores ficam com o começo do nome seguido de um hash hexadecimal do
+    nome inteiro, em vez de serem cortados e se confundirem com outros nomes com o mesmo começo.
+    """
+    data = character.encode()
+    if len(data) <= ROLL_LOG_CHARACTER_BYTES:
+        return data
+    digest = hashlib.blake2b(data, digest_size=6).hexdigest().encode()
+    return data[:ROLL_LOG_CHARACTER_BYTES - len(digest)] + digest
+
+
+def _roll_log_acertos(acertos) -> np.ndarray:
+    """Os acertos arredondados e limitados ao int64 do registro, infinito e NaN do %roll viram o limite e 0"""
+    try:
+        values = np.atleast_1d(np.asarray(acertos, dtype=np.float64))
+    except OverflowError:
+        # Inteiro grande demais até para o float64
+        limit = int(ROLL_LOG_ACERTOS_LIMIT)
+        values = np.array([max(min(x, limit), -limit) for x in np.atleast_1d(acertos).tolist()], dtype=np.float64)
+    return np.clip(np.nan_to_num(np.round(values)), -ROLL_LOG_ACERTOS_LIMIT, ROLL_LOG_ACERTOS_LIMIT)
+
+
+class RollLog:
+    """Histórico das rolagens em um arquivo binário de registros de tamanho fixo (ROLL_LOG_DTYPE).
+
+    As rolagens se acumulam em memória e são anexadas ao arquivo em lote por uma tarefa em segundo plano, cada lote
+    é um único write com O_APPEND, então vários processos podem usar o mesmo arquivo. As consultas leem o arquivo por
+    np.memmap, sem carregar tudo na memória.
+    """
+
+    def __init__(self, path: Path, interval: float):
+        self.path = path
+        self.interval = interval
+        self._pending = []  # type: List[np.ndarray]
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='roll-log')
+
+    def start(self):
+        if self._task is None:
+            self._task = create_task(self._run())
+
+    def append(self, ctx: Context, comando: str, parada, fome, dificuldade, acertos, resultado, character='',
+               user=None):
+        """Registra as rolagens de um comando, os valores podem ser números ou arrays com uma posição por rolagem.
+
+        Por padrão as rolagens são do autor da mensagem, nas rolagens de grupo `user` e `character` vêm por rolagem.
+        """
+        acertos = _roll_log_acertos(acertos)
+        records = np.zeros(len(acertos), ROLL_LOG_DTYPE)
+        records['guild'] = 0 if ctx.guild is None else ctx.guild.id
+        records['user'] = ctx.author.id if user is None else user
+        records['character'] = roll_log_character(character) if isinstance(character, str) else \
+            [roll_log_character(x) for x in character]
+        records['timestamp'] = time()
+        records['comando'] = ROLL_LOG_COMMANDS.index(comando)
+        records['resultado'] = resultado
+        records['fome'] = np.clip(fome, 0, np.iinfo(np.uint16).max)
+        records['parada'] = np.clip(parada, 0, np.iinfo(np.uint32).max)
+        records['dificuldade'] = np.clip(dificuldade, 0, np.iinfo(np.uint32).max)
+        records['acertos'] = acertos
+        self._pending.append(records)
+
+    async def _run(self):
+        while True:
+            await sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print('ERROR ao gravar o histórico de rolagens', repr(e))
+
+    def _write(self, records: np.ndarray):
+        with METRICS.time('vampiro_persistence_seconds', backend='rolagens', operacao='append'):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                data = memoryview(records.tobytes())
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        try:
+            await get_event_loop().run_in_executor(self._executor, self._write, np.concatenate(pending))
+        except BaseException:
+            self._pending[:0] = pending
+            raise
+
+    def read(self) -> np.ndarray:
+        """Todas as rolagens gravadas, mapeadas do arquivo em modo somente leitura"""
+        size = self.path.stat().st_size // ROLL_LOG_DTYPE.itemsize if self.path.is_file() else 0
+        if not size:
+            return np.zeros(0, ROLL_LOG_DTYPE)
+        # Um registro incompleto no fim, de um write interrompido, fica de fora
+        return np.memmap(self.path, ROLL_LOG_DTYPE, mode='r', shape=(size,))
+
+    async def query(self, fn: Callable, *args):
+        """Grava as rolagens pendentes e roda `fn(rolagens, *args)` fora do event loop"""
+        await self.flush()
+        return await get_event_loop().run_in_executor(None, lambda: fn(self.read(), *args))
+
+    def close(self):
+        """Chamado no desligamento, depois que o event loop parou"""
+        self._executor.shutdown(wait=True)
+        if self._pending:
+            self._write(np.concatenate(self._pending))
+            self._pending = []
+
+
+ROLL_LOG = RollLog(ROLL_LOG_FILE, ROLL_LOG_FLUSH_INTERVAL)
+
+SHEET_STORE = None  # type: Optional[SheetStore]
+
+
+@asynccontextmanager
+async def hold_sheets_for_read(guild: int, user: int):
+    """Lock das fichas para leituras, dispensado quando o armazenamento já lê tudo de um mesmo instante"""
+    if SHEET_STORE.atomic_reads:
+        yield
+        return
+    async with SHEET_LOCKS.hold(guild, user):
+        yield
+
+
+STORE_LOADED = None  # type: Optional[Future]
+WARMED_UP = False
+
+
+@bot.before_invoke
+async def wait_sheet_store(ctx: Context):
+    """As fichas carregam enquanto o bot conecta, os comandos que chegam antes disso esperam o fim da carga"""
+    if STORE_LOADED is not None and not STORE_LOADED.done():
+        await wrap_future(STORE_LOADED)
+
+
+async def warm_up():
+    """Importa o cv2 e o PyPDF2 e preenche os caches depois de conectar, sem atrasar a conexão"""
+    started_at = perf_counter()
+    loop = get_event_loop()
+    await gather(loop.run_in_executor(IMAGE_EXECUTOR, _warm_dice_images), PDF_QUEUE.warm_up())
+    log_startup_phase('aquecimento', started_at)
+    if PROB_PRECOMPUTE and not V5_PROBABILITY_TABLES:
+        await loop.run_in_executor(None, precompute_v5_probabilities)
+
+
 @bot.event
 async def on_ready():
+    global WARMED_UP
+    if not WARMED_UP:
+        WARMED_UP = True
+        log_startup_phase('conexão ao Discord desde o início', STARTUP_STARTED_AT)
+        try:
+            await wrap_future(STORE_LOADED)
+        except Exception as e:
+            print('ERROR ao carregar as fichas', repr(e))
+            await bot.close()
+            return
+        WATCHDOG.start()
+        SHEET_STORE.start()
+        ROLL_LOG.start()
+        await start_metrics_export()
+        create_task(warm_up())
     print(f'{bot.user} has connected to Discord!')
 
 
-def create_image(rolagens_normais, rolagens_bestiais):
+def render_tiles(tiles: np.ndarray, atlas: Optional[np.ndarray] = None) -> np.ndarray:
+    """Monta a imagem a partir de uma matriz (linhas, colunas) de índices do atlas achatado, por padrão o DICE_TILES"""
+    if atlas is None:
+        atlas = DICE_TILES
+    lines, cols = tiles.shape
+    with METRICS.time('vampiro_image_seconds', etapa='montagem'):
+        img = atlas[tiles]  # type: np.ndarray
+        return img.swapaxes(1, 2).reshape((lines * DICE_HEIGHT, cols * DICE_WIDTH) + atlas.shape[3:])
+
+
+def _tile_grid(rolagens_normais, rolagens_bestiais) -> np.ndarray:
     total = len(rolagens_normais) + len(rolagens_bestiais)
-    if total > DICES_LIMIT:
-        return None
     lines = int(np.ceil(total / DICES_PER_LINE))
     cols = DICES_PER_LINE if total >= DICES_PER_LINE else total
-    image_height = 66 * lines
-    image_width = 62 * cols
-    x = 0
-    y = 0
-    i = 0
-    img = np.ones((image_height, image_width, 3), np.uint8) * 255
-
-    # TODO inserir isso em uma função
-    for roll in rolagens_normais:
-        img[y:y + 66, x:x + 62] = DICES_FACES[(False, roll)]
-        i += 1
-        if i % DICES_PER_LINE == 0:
-            x = 0
-            y += 66
-        else:
-            x += 62
-    for roll in rolagens_bestiais:
-        img[y:y + 66, x:x + 62] = DICES_FACES[(True, roll)]
-        i += 1
-        if i % DICES_PER_LINE == 0:
-            x = 0
-            y += 66
-        else:
-            x += 62
-    return img
+    # As posições que sobram na última linha ficam com o dado em branco
+    tiles = np.full(lines * cols, BLANK_DICE_INDEX, dtype=np.intp)
+    tiles[:len(rolagens_normais)] = np.asarray(rolagens_normais, dtype=np.intp) - 1
+    tiles[len(rolagens_normais):total] = np.asarray(rolagens_bestiais, dtype=np.intp) + (10 - 1)
+    return tiles.reshape((lines, cols))
 
 
-def create_image_file(rolagens_normais, rolagens_bestiais, filename):
-    img = create_image(rolagens_normais, rolagens_bestiais)
-    if img is None:
+def create_image(rolagens_normais, rolagens_bestiais):
+    total = len(rolagens_normais) + len(rolagens_bestiais)
+    if total > DICES_LIMIT or total == 0:
         return None
-    success, buffer = cv2.imencode('.png', img)
+    return render_tiles(_tile_grid(rolagens_normais, rolagens_bestiais))
+
+
+HISTOGRAM_BAR_WIDTH = 4 * DICE_WIDTH
+DICE_BACKGROUND_COLOR = DICE_TILES_INDEXED[BLANK_DICE_INDEX, 0, 0]
+
+
+def _tile_main_color(tile: np.ndarray) -> int:
+    counts = np.bincount(tile.ravel(), minlength=len(DICE_PALETTE))
+    counts[DICE_BACKGROUND_COLOR] = 0
+    # Fica com as cores saturadas, que distinguem os dados, se o dado tiver alguma
+    chroma = DICE_PALETTE.max(axis=1).astype(int) - DICE_PALETTE.min(axis=1)
+    colorful = np.where(chroma >= 64, counts, 0)
+    return int(colorful.argmax() if colorful.any() else counts.argmax())
+
+
+# Cor das barras do histograma de cada dado, a cor mais comum do dado fora o fundo
+DICE_BAR_COLORS = [_tile_main_color(tile) for tile in DICE_TILES_INDEXED[:BLANK_DICE_INDEX]]
+
+
+def render_histogram(rolagens_normais, rolagens_bestiais) -> np.ndarray:
+    """Resumo das paradas grandes em índices da paleta: cada face com uma barra proporcional a quantas vezes saiu,
+    os dados normais à esquerda e os de fome à direita"""
+    contagens = [(False, np.bincount(np.asarray(rolagens_normais, dtype=np.intp), minlength=11)[1:])]
+    if len(rolagens_bestiais):
+        contagens.append((True, np.bincount(np.asarray(rolagens_bestiais, dtype=np.intp), minlength=11)[1:]))
+    maximo = max(contagem.max() for _, contagem in contagens) or 1
+    column_width = DICE_WIDTH + HISTOGRAM_BAR_WIDTH
+    with METRICS.time('vampiro_image_seconds', etapa='montagem'):
+        img = np.full((10 * DICE_HEIGHT, len(contagens) * column_width), DICE_BACKGROUND_COLOR, dtype=np.uint8)
+        for column, (bestial, contagem) in enumerate(contagens):
+            x = column * column_width
+            for face in range(1, 11):
+                y = (face - 1) * DICE_HEIGHT
+                tile = bestial * 10 + face - 1
+                img[y:y + DICE_HEIGHT, x:x + DICE_WIDTH] = DICE_TILES_INDEXED[tile]
+                length = int(round(contagem[face - 1] / maximo * (HISTOGRAM_BAR_WIDTH - 8)))
+                img[y + DICE_HEIGHT // 3:y + 2 * DICE_HEIGHT // 3, x + DICE_WIDTH + 4:x + DICE_WIDTH + 4 + length] = \
+                    DICE_BAR_COLORS[tile]
+    return img
+
+
+# Com 100 dados o nível 3 gera uns 10% a mais de bytes que o 6 na metade do tempo
+PNG_COMPRESSION_LEVEL = 3
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_indexed_png(img: np.ndarray, palette: np.ndarray) -> bytes:
+    """PNG de 8 bits com paleta, que o cv2 não sabe gravar"""
+    height, width = img.shape
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = img  # filtro 0 em todas as linhas
+    header = struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', header),
+        _png_chunk(b'PLTE', palette[:, ::-1].tobytes()),
+        _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), PNG_COMPRESSION_LEVEL)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+
+def _encode_array(img: np.ndarray) -> Optional[bytes]:
+    """Codifica no IMAGE_FORMAT uma imagem BGR ou em índices da DICE_PALETTE"""
+    with METRICS.time('vampiro_image_seconds', etapa='codificacao'):
+        if IMAGE_FORMAT == 'paleta':
+            return encode_indexed_png(img, DICE_PALETTE)
+        import cv2
+        if img.ndim == 2:
+            img = DICE_PALETTE[img]
+        if IMAGE_FORMAT == 'webp':
+            # Qualidade acima de 100 é o modo sem perdas, que aproveita as poucas cores da paleta
+            success, buffer = cv2.imencode('.webp', img, [cv2.IMWRITE_WEBP_QUALITY, 101])
+        else:
+            success, buffer = cv2.imencode('.png', img)
     if not success:
         return None
-    file = File(BytesIO(buffer), filename)
+    return buffer.tobytes()
+
+
+def _encode_within_budget(img: np.ndarray) -> Optional[bytes]:
+    """Reduz a imagem pela metade até caber no IMAGE_BYTE_BUDGET, desistindo em 1/4 do tamanho"""
+    for step in (1, 2, 4):
+        data = _encode_array(img[::step, ::step])
+        if data is None or len(data) <= IMAGE_BYTE_BUDGET:
+            return data
+    print(f'WARNING imagem de {len(data)} bytes acima do IMAGE_BYTE_BUDGET mesmo reduzida')
+    return None
+
+
+def _encode_tiles(tiles: np.ndarray) -> Optional[bytes]:
+    return _encode_within_budget(render_tiles(tiles, DICE_TILES if IMAGE_FORMAT == 'png' else DICE_TILES_INDEXED))
+
+
+def _encode_histogram(rolagens_normais, rolagens_bestiais) -> Optional[bytes]:
+    return _encode_within_budget(render_histogram(rolagens_normais, rolagens_bestiais))
+
+
+def _encode_image(rolagens_normais, rolagens_bestiais) -> Optional[bytes]:
+    total = len(rolagens_normais) + len(rolagens_bestiais)
+    if total == 0:
+        return None
+    if total > DICES_LIMIT:
+        return _encode_histogram(rolagens_normais, rolagens_bestiais)
+    return _encode_tiles(_tile_grid(rolagens_normais, rolagens_bestiais))
+
+
+@lru_cache(maxsize=None)
+def _encode_single_die(bestial: bool, face: int) -> Optional[bytes]:
+    return _encode_image([], [face]) if bestial else _encode_image([face], [])
+
+
+def _warm_dice_images():
+    for bestial in (False, True):
+        for face in range(1, 11):
+            _encode_single_die(bestial, face)
+
+
+def _image_filename(filename: str) -> str:
+    if IMAGE_FORMAT == 'webp':
+        return filename.rsplit('.', 1)[0] + '.webp'
+    return filename
+
+
+async def create_image_file(rolagens_normais, rolagens_bestiais, filename):
+    if len(rolagens_normais) + len(rolagens_bestiais) == 1:
+        bestial = len(rolagens_bestiais) == 1
+        data = _encode_single_die(bestial, int(rolagens_bestiais[0] if bestial else rolagens_normais[0]))
+    else:
+        data = await get_event_loop().run_in_executor(IMAGE_EXECUTOR, _encode_image, rolagens_normais,
+                                                      rolagens_bestiais)
+    if data is None:
+        return None
+    file = File(BytesIO(data), _image_filename(filename))
     return file
 
 
+async def create_histogram_file(rolagens_normais, rolagens_bestiais, filename):
+    data = await get_event_loop().run_in_executor(IMAGE_EXECUTOR, _encode_histogram, rolagens_normais,
+                                                  rolagens_bestiais)
+    if data is None:
+        return None
+    return File(BytesIO(data), _image_filename(filename))
+
+
+async def create_tiles_file(tiles: np.ndarray, filename):
+    data = await get_event_loop().run_in_executor(IMAGE_EXECUTOR, _encode_tiles, tiles)
+    if data is None:
+        return None
+    return File(BytesIO(data), _image_filename(filename))
+
+
+RESULTADO_FALHA = 0
+RESULTADO_FALHA_TOTAL = 1
+RESULTADO_FALHA_BESTIAL = 2
+RESULTADO_VITORIA = 3
+RESULTADO_CRITICO_BAGUNCADO = 4
+RESULTADO_CRITICO = 5
+
+RESULTADOS_CURTOS = {
+    RESULTADO_FALHA: 'Falha padrão',
+    RESULTADO_FALHA_TOTAL: 'Falha total',
+    RESULTADO_FALHA_BESTIAL: 'Falha bestial',
+    RESULTADO_VITORIA: 'Vitória padrão',
+    RESULTADO_CRITICO_BAGUNCADO: 'Crítico bagunçado',
+    RESULTADO_CRITICO: 'Crítico padrão',
+}
+
+V5Result = namedtuple('V5Result', ['acertos', 'resultado', 'falhas_bestiais', 'falhas_totais'])
+
+
+def classify_v5(rolagens: np.ndarray, rolagens_fome: np.ndarray, dificuldade: int, acertos_previos: int = 0):
+    """Classifica as rolagens de V5 linha a linha, recebe matrizes (repetições, dados)"""
+    return _classify_v5_counts((rolagens >= 6).sum(axis=1) + (rolagens_fome >= 6).sum(axis=1),
+                               (rolagens == 10).sum(axis=1), (rolagens_fome == 10).sum(axis=1),
+                               (rolagens == 1).sum(axis=1), (rolagens_fome == 1).sum(axis=1),
+                               dificuldade, acertos_previos)
+
+
+def classify_v5_ragged(dados: np.ndarray, paradas: np.ndarray, fomes: np.ndarray, dificuldades):
+    """Classifica várias rolagens de tamanhos diferentes guardadas em sequência em `dados`.
+
+    Cada linha ocupa `paradas[i]` dados, os últimos `fomes[i]` deles são os de fome, e as contagens por linha saem
+    de um bincount sobre o índice da linha de cada dado.
+    """
+    linhas = len(paradas)
+    linha = np.repeat(np.arange(linhas), paradas)
+    posicao = np.arange(len(dados)) - np.repeat(np.cumsum(paradas) - paradas, paradas)
+    fome = posicao >= np.repeat(paradas - fomes, paradas)
+
+    def count(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(linha[mask], minlength=linhas)
+
+    return _classify_v5_counts(count(dados >= 6), count(~fome & (dados == 10)), count(fome & (dados == 10)),
+                               count(~fome & (dados == 1)), count(fome & (dados == 1)), dificuldades)
+
+
+def _classify_v5_counts(sucessos, criticos_padrao, criticos_baguncados, falhas_totais, falhas_bestiais,
+                        dificuldade, acertos_previos=0):
+    acertos = sucessos + (criticos_padrao + criticos_baguncados) + acertos_previos
+
+    sucesso = acertos >= dificuldade
+    resultado = np.select(
+        [sucesso & (criticos_padrao >= 1),
+         sucesso & (criticos_baguncados >= 1) & (criticos_padrao + criticos_baguncados >= 2),
+         sucesso,
+         falhas_bestiais >= 1,
+         falhas_totais >= 1],
+        [RESULTADO_CRITICO, RESULTADO_CRITICO_BAGUNCADO, RESULTADO_VITORIA, RESULTADO_FALHA_BESTIAL,
+         RESULTADO_FALHA_TOTAL],
+        RESULTADO_FALHA)
+    return V5Result(acertos, resultado, falhas_bestiais, falhas_totais)
+
+
+def _status_v5(resultado: int, margem: int, falhas_bestiais: int, falhas_totais: int) -> str:
+    if resultado == RESULTADO_CRITICO:
+        return f'Crítico padrão com {margem} de margem'
+    elif resultado == RESULTADO_CRITICO_BAGUNCADO:
+        return f'Crítico bagunçado com {margem} de margem'
+    elif resultado == RESULTADO_VITORIA:
+        return f'Vitória padrão com {margem} de margem'
+    elif resultado == RESULTADO_FALHA_BESTIAL:
+        return f'Falha bestial com {falhas_bestiais} de falha na fome'
+    elif resultado == RESULTADO_FALHA_TOTAL:
+        return f'Falha total com {falhas_totais} de falha'
+    return 'Falha padrão'
+
+
+def _split_repeticoes(args, defaults):
+    """Separa o modificador de repetição `xN`, que pode vir no lugar de qualquer argumento opcional"""
+    for i, arg in enumerate(args):
+        match = REPEAT_REGEX.match(arg.strip().lower())
+        if match is not None:
+            return list(args[:i]) + list(defaults[i:]), int(match[1])
+    return list(args), 1
+
+
+async def _check_repeticoes(ctx: Context, repeticoes: int) -> bool:
+    if 1 <= repeticoes <= REPEAT_LIMIT:
+        return True
+    await ctx.send(f'Total de repetições "{repeticoes}" inválido, use de 1 a {REPEAT_LIMIT}.')
+    return False
+
+
 @bot.command(name='roll5e', help='''Executa uma rolagem de Vampire 5e
     `/roll5e [parada]`
     `/roll5e [parada] [fome]`
     `/roll5e [parada] [fome] [dificuldade]`
     `/roll5e [parada] [fome] [dificuldade] [acertos prévios]`
 todos os valores podem ser informado como expressões aritméticas como 5+3+2
-Acertos prévios é útil ao utilizar força de vontade para refazer uma rolagem anterior''')
-async def roll5e(ctx: Context, parada: str = '1', fome: str = '0', dificuldade: str = '0', acertos_previos: str = '0'):
+Acertos prévios é útil ao utilizar força de vontade para refazer uma rolagem anterior
+Termine com x[repetições] para rolar a mesma parada várias vezes, por exemplo `/roll5e 7 2 3 x20`''')
+async def roll5e(ctx: Context, parada: str = '1', fome: str = '0', dificuldade: str = '0', acertos_previos: str = '0',
+                 repeticoes: str = ''):
+    args, repeticoes_int = _split_repeticoes((parada, fome, dificuldade, acertos_previos, repeticoes),
+                                             ('1', '0', '0', '0', ''))
+    parada, fome, dificuldade, acertos_previos = args[:4]
+    if not await _check_repeticoes(ctx, repeticoes_int):
+        return
     try:
         parada_int = eval_expr(parada)
     except (ValueError, KeyError, TypeError):
         await ctx.send(f'Parada "{parada}" inválida.')
         return
-    if parada_int <= 0:
-        await ctx.send(f'Total de parada "{parada_int}" inválido, caso queira rolar somente um dado'
-                       ', tente novamente com 1.')
-        return
     try:
         fome_int = eval_expr(fome)
     except (ValueError, KeyError, TypeError):
         await ctx.send(f'Fome "{fome}" inválida.')
         return
-    if fome_int < 0:
-        await ctx.send(f'Total de fome "{fome_int}" inválido, caso queira rolar sem fome'
-                       ', tente novamente com 0.')
-
-    fome_int = min(fome_int, parada_int)
-
     try:
         dificuldade_int = eval_expr(dificuldade)
     except (ValueError, KeyError, TypeError):
         await ctx.send(f'Dificuldade "{dificuldade}" inválida.')
         return
-    if dificuldade_int < 0:
-        await ctx.send(f'Total de dificuldade "{dificuldade_int}" inválido, caso queira rolar sem dificuldade definida'
-                       ', tente novamente com 0.')
-
     try:
         acertos_previos_int = eval_expr(acertos_previos)
     except (ValueError, KeyError, TypeError):
         await ctx.send(f'Acertos prévios "{acertos_previos}" inválidos.')
         return
+    await roll_v5(ctx, parada_int, fome_int, dificuldade_int, acertos_previos_int, repeticoes_int)
+
+
+async def roll_v5(ctx: Context, parada_int: int, fome_int: int = 0, dificuldade_int: int = 0,
+                  acertos_previos_int: int = 0, repeticoes: int = 1, comando: str = 'roll5e', character: str = ''):
+    """Rolagem do roll5e com os valores já avaliados, `comando` e `character` são registrados no histórico"""
+    if parada_int <= 0:
+        await ctx.send(f'Total de parada "{parada_int}" inválido, caso queira rolar somente um dado'
+                       ', tente novamente com 1.')
+        return
     if fome_int < 0:
-        await ctx.send(f'Total de acertos prévios "{acertos_previos_int}" inválido, caso queira rolar sem eles'
+        await ctx.send(f'Total de fome "{fome_int}" inválido, caso queira rolar sem fome'
                        ', tente novamente com 0.')
 
-    rolagens = np.random.choice(FACES, parada_int - fome_int)
+    fome_int = min(fome_int, parada_int)
+
+    if dificuldade_int < 0:
+        await ctx.send(f'Total de dificuldade "{dificuldade_int}" inválido, caso queira rolar sem dificuldade definida'
+                       ', tente novamente com 0.')
 
-    rolagens_fome = np.random.choice(FACES, fome_int)
+    if fome_int < 0:
+        await ctx.send(f'Total de acertos prévios "{acertos_previos_int}" inválido, caso queira rolar sem eles'
+                       ', tente novamente com 0.')
 
-    criticos_padrao = (rolagens == 10).sum()
-    criticos_baguncados = (rolagens_fome == 10).sum()
+    if repeticoes > 1:
+        await _roll_v5_repetido(ctx, parada_int, fome_int, dificuldade_int, acertos_previos_int, repeticoes,
+                                comando, character)
+        return
 
-    acertos = (rolagens >= 6).sum() + (rolagens_fome >= 6).sum() + (
-            criticos_padrao + criticos_baguncados) + acertos_previos_int
+    rolagens = DICE.d10((1, parada_int - fome_int), dice_stream(ctx))
 
-    falhas_bestiais = (rolagens_fome == 1).sum()
-    falhas_totais = (rolagens == 1).sum()
+    rolagens_fome = DICE.d10((1, fome_int), dice_stream(ctx))
 
-    if acertos >= dificuldade_int:
-        margem = acertos - dificuldade_int
-        if criticos_padrao >= 1:
-            status = f'Crítico padrão com {margem} de margem'
-        elif criticos_baguncados >= 1 and criticos_padrao + criticos_baguncados >= 2:
-            status = f'Crítico bagunçado com {margem} de margem'
-        else:
-            status = f'Vitória padrão com {margem} de margem'
-    elif falhas_bestiais >= 1:
-        status = f'Falha bestial com {falhas_bestiais} de falha na fome'
-    elif falhas_totais >= 1:
-        status = f'Falha total com {falhas_totais} de falha'
-    else:
-        status = 'Falha padrão'
+    v5 = classify_v5(rolagens, rolagens_fome, dificuldade_int, acertos_previos_int)
+    ROLL_LOG.append(ctx, comando, parada_int, fome_int, dificuldade_int, v5.acertos - acertos_previos_int,
+                    v5.resultado, character)
+    acertos = v5.acertos[0]
+    status = _status_v5(v5.resultado[0], acertos - dificuldade_int, v5.falhas_bestiais[0], v5.falhas_totais[0])
+    rolagens = rolagens[0]
+    rolagens_fome = rolagens_fome[0]
 
     await ctx.send(f"""> **{status}**
     Acertos: {acertos}
     Rolagens normais: {', '.join([NUMBER_FORMATS[x] for x in rolagens])}
     Rolagens de fome: {', '.join([NUMBER_FORMATS[x] for x in rolagens_fome])}""",
-                   file=create_image_file(rolagens, rolagens_fome, f'rolagem_{ctx.guild}.png'))
+                   file=await create_image_file(rolagens, rolagens_fome, f'rolagem_{ctx.guild}.png'),
+                   priority=PRIORITY_ROLL)
+
+
+async def _roll_v5_repetido(ctx: Context, parada_int: int, fome_int: int, dificuldade_int: int,
+                            acertos_previos_int: int, repeticoes: int, comando: str, character: str):
+    """Rola a mesma parada várias vezes em uma única matriz (repetições, dados)"""
+    rolagens = DICE.d10((repeticoes, parada_int - fome_int), dice_stream(ctx))
+    rolagens_fome = DICE.d10((repeticoes, fome_int), dice_stream(ctx))
+    v5 = classify_v5(rolagens, rolagens_fome, dificuldade_int, acertos_previos_int)
+    ROLL_LOG.append(ctx, comando, parada_int, fome_int, dificuldade_int, v5.acertos - acertos_previos_int,
+                    v5.resultado, character)
+    contagem = np.bincount(v5.resultado, minlength=len(RESULTADOS_CURTOS))
+    linhas = [f'{i:>3} {acertos:>7}  {RESULTADOS_CURTOS[resultado]}'
+              for i, (acertos, resultado) in enumerate(zip(v5.acertos, v5.resultado), 1)]
+    resumo = ', '.join(f'{RESULTADOS_CURTOS[k]}: {contagem[k]}' for k in sorted(RESULTADOS_CURTOS, reverse=True)
+                       if contagem[k])
+    if parada_int <= DICES_PER_LINE and repeticoes * parada_int <= DICES_LIMIT:
+        # Uma linha de dados por repetição, na mesma ordem da tabela
+        tiles = np.hstack((rolagens.astype(np.intp) - 1, rolagens_fome.astype(np.intp) + (10 - 1)))
+        file = await create_tiles_file(tiles, f'rolagens_{ctx.guild}.png')
+    else:
+        # Paradas grandes viram um histograma das faces de todas as repetições
+        file = await create_histogram_file(rolagens.ravel(), rolagens_fome.ravel(), f'rolagens_{ctx.guild}.png')
+    await ctx.send(f"""> **{repeticoes} rolagens de {parada_int} dados, fome {fome_int}, dificuldade {dificuldade_int}**
+```
+  # Acertos  Resultado
+{chr(10).join(linhas)}
+```
+{resumo}""", file=file, priority=PRIORITY_ROLL)
+
+
+def _add_v5_die(dist: np.ndarray, fome: bool) -> np.ndarray:
+    """Soma um dado à distribuição (acertos, tem 10 normal, 10s de fome até 2, tem 1 de fome, tem 1 normal)"""
+    size = dist.shape[0]
+    new = np.zeros((size + 2,) + dist.shape[1:])
+    new[:size] += 0.4 * dist  # 2 a 5
+    new[1:size + 1] += 0.4 * dist  # 6 a 9
+    if fome:
+        new[:size, :, :, 1] += 0.1 * dist.sum(axis=3)
+        new[2:size + 2, :, 1] += 0.1 * dist[:, :, 0]
+        new[2:size + 2, :, 2] += 0.1 * dist[:, :, 1:].sum(axis=2)
+    else:
+        new[:size, :, :, :, 1] += 0.1 * dist.sum(axis=4)
+        new[2:size + 2, 1] += 0.1 * dist.sum(axis=1)
+    return new
+
+
+@lru_cache(maxsize=None)
+def _v5_normal_distribution(normais: int) -> np.ndarray:
+    if normais == 0:
+        dist = np.zeros((1, 2, 3, 2, 2))
+        dist[0, 0, 0, 0, 0] = 1.
+        return dist
+    return _add_v5_die(_v5_normal_distribution(normais - 1), False)
+
+
+def _v5_probability_table(dist: np.ndarray):
+    sem_critico = dist[:, 0]
+    sucessos = np.stack([
+        dist[:, 1].sum(axis=(1, 2, 3)),
+        sem_critico[:, 2].sum(axis=(1, 2)),
+        sem_critico[:, :2].sum(axis=(1, 2, 3)),
+    ], axis=1)
+    sem_bestial = dist[:, :, :, 0]
+    falhas = np.stack([
+        dist[:, :, :, 1].sum(axis=(1, 2, 3)),
+        sem_bestial[:, :, :, 1].sum(axis=(1, 2)),
+        sem_bestial[:, :, :, 0].sum(axis=(1, 2)),
+    ], axis=1)
+    zeros = np.zeros((1, 3))
+    # sucessos[d] = P(acertos >= d), falhas[d] = P(acertos < d), para d de 0 a 2 * parada + 1
+    sucessos = np.concatenate((np.cumsum(sucessos[::-1], axis=0)[::-1], zeros))
+    falhas = np.concatenate((zeros, np.cumsum(falhas, axis=0)))
+    sucessos.setflags(write=False)
+    falhas.setflags(write=False)
+    return sucessos, falhas
+
+
+V5_PROBABILITY_TABLES = {}  # type: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]]
+
+
+def v5_probability_table(parada: int, fome: int):
+    """Probabilidades exatas das rolagens do roll5e por dificuldade, calculadas convolucionando dado a dado.
+
+    Devolve duas matrizes (dificuldade, 3): as chances de crítico padrão, crítico bagunçado e vitória padrão com
+    acertos >= dificuldade, e as de falha bestial, falha total e falha padrão com acertos < dificuldade.
+    """
+    table = V5_PROBABILITY_TABLES.get((parada, fome))
+    if table is None:
+        dist = _v5_normal_distribution(parada - fome)
+        for _ in range(fome):
+            dist = _add_v5_die(dist, True)
+        table = V5_PROBABILITY_TABLES[parada, fome] = _v5_probability_table(dist)
+    return table
+
+
+def v5_probabilities(parada: int, fome: int, dificuldade: int) -> Dict[int, float]:
+    """Probabilidade de cada resultado do roll5e"""
+    fome = min(max(fome, 0), parada)
+    sucessos, falhas = v5_probability_table(parada, fome)
+    index = min(max(dificuldade, 0), len(sucessos) - 1)
+    critico, baguncado, vitoria = sucessos[index]
+    bestial, total, falha = falhas[index]
+    return {
+        RESULTADO_CRITICO: critico,
+        RESULTADO_CRITICO_BAGUNCADO: baguncado,
+        RESULTADO_VITORIA: vitoria,
+        RESULTADO_FALHA_BESTIAL: bestial,
+        RESULTADO_FALHA_TOTAL: total,
+        RESULTADO_FALHA: falha,
+    }
+
+
+def precompute_v5_probabilities(limit: int = DICES_LIMIT):
+    """Calcula as tabelas de todas as paradas até `limit`, reaproveitando a distribuição a cada dado de fome"""
+    for normais in range(limit + 1):
+        dist = _v5_normal_distribution(normais)
+        for fome in range(limit - normais + 1):
+            if fome:
+                dist = _add_v5_die(dist, True)
+            if normais + fome and (normais + fome, fome) not in V5_PROBABILITY_TABLES:
+                V5_PROBABILITY_TABLES[normais + fome, fome] = _v5_probability_table(dist)
+
+
+@bot.command(name='prob', help='''Calcula as chances exatas de uma rolagem do roll5e
+    `/prob [parada] [fome] [dificuldade]`
+todos os valores podem ser informado como expressões aritméticas como 5+3+2''')
+async def roll5e_probability(ctx: Context, parada: str = '1', fome: str = '0', dificuldade: str = '0'):
+    try:
+        parada_int = int(eval_expr(parada))
+        fome_int = int(eval_expr(fome))
+        dificuldade_int = int(eval_expr(dificuldade))
+    except (ValueError, KeyError, TypeError, SyntaxError):
+        await ctx.send(f'Rolagem "{parada} {fome} {dificuldade}" inválida.')
+        return
+    if not 1 <= parada_int <= DICES_LIMIT:
+        await ctx.send(f'Total de parada "{parada_int}" inválido, use de 1 a {DICES_LIMIT}.')
+        return
+    probabilidades = v5_probabilities(parada_int, fome_int, dificuldade_int)
+    vitoria = sum(probabilidades[k] for k in (RESULTADO_CRITICO, RESULTADO_CRITICO_BAGUNCADO, RESULTADO_VITORIA))
+    linhas = [f'{RESULTADOS_CURTOS[k]}: {probabilidades[k]:.2%}' for k in sorted(probabilidades, reverse=True)]
+    await ctx.send(f"""> **{parada_int} dados, fome {min(max(fome_int, 0), parada_int)}, dificuldade {dificuldade_int}**
+    Chance de vitória: {vitoria:.2%}
+    {(chr(10) + '    ').join(linhas)}""")
 
 
 @bot.command(name='rc', help='''Executa um checagem de sangue''')
 async def roll_rouse_check(ctx: Context):
-    resultado = np.random.choice(FACES, size=(1,))  # type: np.ndarray
+    resultado = DICE.d10(1, dice_stream(ctx))  # type: np.ndarray
+    ROLL_LOG.append(ctx, 'rc', 1, 0, 0, resultado, resultado >= 6)
     await ctx.send(f'''> **{'Passou' if resultado >= 6 else '+1 Fome'}**
-    resultado: {resultado[0]}''', file=create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'))
+    resultado: {resultado[0]}''', file=await create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'),
+                   priority=PRIORITY_ROLL)
 
 
 @bot.command(name='compulsao', help='''Executa um teste de compulsão''')
 async def roll_compulsao(ctx: Context):
-    resultado = np.random.choice(FACES, size=(1,))  # type: np.ndarray
+    resultado = DICE.d10(1, dice_stream(ctx))  # type: np.ndarray
     compulsao = COMPULSAO[resultado[0]]
+    ROLL_LOG.append(ctx, 'compulsao', 1, 0, 0, resultado, 0)
     await ctx.send(f'''> **{compulsao}**
-    resultado: {resultado[0]}''', file=create_image_file(resultado, [], f'Compulsao {ctx.guild}.png'))
+    resultado: {resultado[0]}''', file=await create_image_file(resultado, [], f'Compulsao {ctx.guild}.png'),
+                   priority=PRIORITY_ROLL)
 
 
 @bot.command(name='roll', help='''Executa uma rolagem de D&D5e
 É aceito algo do tipo %roll 5d6kH1kL2+3d10+6
-Ou seja [quantos dados]d[quantas faces]kH[matendo os N mais altos]kL[Mantendo os N mais baixos]''')
-async def roll_dnd(ctx: Context, rolagem: str = '1d6'):
+Ou seja [quantos dados]d[quantas faces]kH[matendo os N mais altos]kL[Mantendo os N mais baixos]
+Depois das faces também dá para usar r<N para rerolar os dados menores que N e ! para os dados no valor máximo
+explodirem, rolando mais um dado cada, e no fim do termo >=N conta os dados com N ou mais em vez de somar
+Por exemplo %roll 10d10!>=8 ou %roll 4d6r<2kh3
+Termine com x[repetições] para rolar a mesma expressão várias vezes, por exemplo %roll 2d6+3 x20''')
+async def roll_dnd(ctx: Context, rolagem: str = '1d6', repeticoes: str = ''):
+    (rolagem, _), repeticoes_int = _split_repeticoes((rolagem, repeticoes), ('1d6', ''))
+    if not await _check_repeticoes(ctx, repeticoes_int):
+        return
+    if repeticoes_int > 1:
+        await _roll_dnd_repetido_command(ctx, rolagem, repeticoes_int)
+        return
+    try:
+        result, message = await get_event_loop().run_in_executor(DND_EXECUTOR, _roll_dnd_message, rolagem,
+                                                                 dice_stream(ctx))
+    except ValueError as e:
+        await ctx.send(f'Rolagem inválida `{e}`')
+        return
+    await ctx.send(message, priority=PRIORITY_ROLL)
+    ROLL_LOG.append(ctx, 'roll', 0, 0, 0, result, 0)
+
+
+def _roll_dnd_message(rolagem: str, stream: Optional[int] = None):
+    """Rola e monta a mensagem do %roll, roda no DND_EXECUTOR para não travar o event loop"""
+    result, result_exp, steps = _roll_dnd(rolagem, stream)
+    message = _format_dnd_message(result, result_exp, steps)
+    if len(message) > DISCORD_MESSAGE_LIMIT:
+        message = _format_dnd_message(result, result_exp, steps, compact=True)[:DISCORD_MESSAGE_LIMIT]
+    return result, message
+
+
+async def _roll_dnd_repetido_command(ctx: Context, rolagem: str, repeticoes: int):
     try:
-        result, result_exp, steps = _roll_dnd(rolagem)
+        results, textos, somas = await get_event_loop().run_in_executor(DND_EXECUTOR, _roll_dnd_repetido, rolagem,
+                                                                        repeticoes, dice_stream(ctx))
     except ValueError as e:
         await ctx.send(f'Rolagem inválida `{e}`')
         return
+    colunas = textos[:DND_REPEAT_COLUMNS]
+    header = '  # ' + ' '.join(f'{x:>8}' for x in ['Total'] + [x[:8] for x in colunas])
+    linhas = [f'{i:>3} ' + ' '.join(f'{x:>8g}' for x in [result] + [soma[i - 1] for soma in somas[:len(colunas)]])
+              for i, result in enumerate(results, 1)]
+    await ctx.send(f"""> **{repeticoes} rolagens de `{rolagem}`**
+```
+{header}
+{chr(10).join(linhas)}
+```
+Mínimo: {results.min():g}, máximo: {results.max():g}, média: {results.mean():.2f}""", priority=PRIORITY_ROLL)
+    ROLL_LOG.append(ctx, 'roll', 0, 0, 0, results, 0)
+
+
+DndStep = namedtuple('DndStep', ['use_keep', 'results', 'final_result', 'desprezados', 'texto', 'soma', 'histograma',
+                                 'alvo'])
+DndTerm = namedtuple('DndTerm', ['dados', 'faces', 'keep_high', 'keep_low', 'minimo', 'explode', 'alvo'])
+
+
+class DiceBudget:
+    """Dados que ainda podem ser rolados por uma expressão inteira do %roll, somando todos os termos e explosões"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.restante = limit
+
+    def take(self, dados: int):
+        """Desconta os dados antes de rolar, levanta ValueError se passar do limite"""
+        if dados > self.restante:
+            raise ValueError(f'Quantidade de dados da rolagem acima do limite de {self.limit}!')
+        self.restante -= dados
+
+
+def _format_dnd_message(result, result_exp: str, steps, compact: bool = False) -> str:
     message = [f'> **Resultado final: {result:g}**']
     append_message = message.append
-    for use_keep, results, final_result, desprezados, texto in steps:
-        if use_keep:
-            append_message(f"""    Resultado de {texto} = {final_result.sum():g} ({', '.join(
-                [f'{x:g}' for x in final_result] + [f'~~{x:g}~~' for x in desprezados])})""")
+    for step in steps:
+        if step.alvo is None:
+            soma = f'{step.soma:g}'
         else:
-            append_message(
-                f"    Resultado de {texto} = {final_result.sum():g} ({', '.join(final_result.astype(str))})")
-    append_message(f'Avaliação final: `{result_exp}`')
-    await ctx.send('\n'.join(message))
-
-
-def _roll_dnd(rolagem: str):
-    dados_match = re.finditer(
-        r'(?P<dados>\d+|\([-0-9+*/]+\))d(?P<faces>\d+|\([-0-9+*/]+\))'
-        r'(?:kh(?P<keep_high>\d+|\([-0-9+*/]+\)))?(?:kl(?P<keep_low>\d+|\([-0-9+*/]+\)))?',
-        rolagem.lower())
+            soma = f"{step.soma:g} {'sucesso' if step.soma == 1 else 'sucessos'}"
+        if step.histograma is not None:
+            faces = [f'{face}×{count}' for face, count in enumerate(step.histograma, 1) if count]
+            if compact and len(faces) > DND_COMPACT_HISTOGRAM_FACES:
+                faces = faces[:DND_COMPACT_HISTOGRAM_FACES] + ['…']
+            append_message(f"    Resultado de {step.texto} = {soma} [{', '.join(faces)}]")
+            continue
+        if compact or step.results is None:
+            append_message(f'    Resultado de {step.texto} = {soma}')
+            continue
+        if step.alvo is None:
+            dados = [f'{x:g}' for x in step.final_result]
+        else:
+            dados = [f'**{x:g}**' if x >= step.alvo else f'{x:g}' for x in step.final_result]
+        if step.use_keep:
+            dados += [f'~~{x:g}~~' for x in step.desprezados]
+        append_message(f"    Resultado de {step.texto} = {soma} ({', '.join(dados)})")
+    if not compact:
+        append_message(f'Avaliação final: `{result_exp}`')
+    return '\n'.join(message)
+
+
+def _dnd_faces(term: DndTerm, size, stream: Optional[int] = None, dtype=np.int64) -> np.ndarray:
+    """Dados do termo, os rerolados até sair `minimo` ou mais já saem direto entre minimo e faces"""
+    if term.minimo > 1:
+        return DICE.integers(term.faces - term.minimo + 1, size, stream, dtype) + dtype(term.minimo - 1)
+    return DICE.integers(term.faces, size, stream, dtype)
+
+
+def _dnd_dice_chunks(term: DndTerm, budget: DiceBudget, stream: Optional[int] = None) -> Iterator[np.ndarray]:
+    """Rola os dados do termo em blocos, inclusive os que vêm das explosões.
+
+    Cada rodada de explosão rola de uma vez só os dados novos dos que saíram no valor máximo na rodada anterior, então
+    um 100d10! custa poucas operações do NumPy. Os dados iniciais já devem ter sido descontados do `budget`, as
+    explosões são descontadas antes de cada rodada.
+    """
+    for start in range(0, term.dados, DND_CHUNK_SIZE):
+        pendentes = min(DND_CHUNK_SIZE, term.dados - start)
+        while pendentes:
+            chunk = _dnd_faces(term, pendentes, stream)
+            yield chunk
+            pendentes = int(np.count_nonzero(chunk == term.faces)) if term.explode else 0
+            budget.take(pendentes)
+
+
+def _dnd_explode_rows(results: np.ndarray, term: DndTerm, budget: DiceBudget,
+                      stream: Optional[int] = None) -> np.ndarray:
+    """Acrescenta as explosões de cada linha de uma matriz (repetições, dados), completando as linhas com 0 à direita
+
+    As rodadas são vetorizadas como no _dnd_dice_chunks, guardando só a linha de origem de cada dado que explodiu.
+    """
+    repeticoes, dados = results.shape
+    explodindo = np.flatnonzero(results == term.faces) // dados
+    linhas = []
+    valores = []
+    while len(explodindo):
+        budget.take(len(explodindo))
+        novos = _dnd_faces(term, len(explodindo), stream, results.dtype.type)
+        linhas.append(explodindo)
+        valores.append(novos)
+        explodindo = explodindo[novos == term.faces]
+    if not linhas:
+        return results
+    order = np.argsort(np.concatenate(linhas), kind='stable')
+    linhas = np.concatenate(linhas)[order]
+    valores = np.concatenate(valores)[order]
+    extras = np.bincount(linhas, minlength=repeticoes)
+    inicio = np.cumsum(extras) - extras
+    matrix = np.zeros((repeticoes, dados + int(extras.max())), dtype=results.dtype)
+    matrix[:, :dados] = results
+    matrix[linhas, dados + np.arange(len(linhas)) - inicio[linhas]] = valores
+    return matrix
+
+
+def _dnd_sum(values: np.ndarray, faces: int) -> int:
+    """Soma dos dados, em int64 quando o pior caso cabe nele e em inteiros do Python quando poderia dar a volta"""
+    if len(values) * faces <= DND_FACES_LIMIT:
+        return int(values.sum())
+    return sum(values.tolist())
+
+
+def _roll_dnd_aggregate(term: DndTerm, budget: DiceBudget, stream: Optional[int] = None):
+    """Rola muitos dados em blocos sem guardar cada um, devolve (soma ou sucessos mantidos, histograma ou None)
+
+    Com poucas faces conta as faces com bincount e resolve kh/kl pelo histograma, com muitas faces mantém só os
+    candidatos a kh/kl usando np.partition a cada bloco.
+    """
+    faces, keep_high, keep_low, alvo = term.faces, term.keep_high, term.keep_low, term.alvo
+    use_histogram = faces <= DND_HISTOGRAM_FACES
+    histograma = np.zeros(faces + 1, dtype=np.int64) if use_histogram else None
+    soma = 0
+    high = low = np.empty(0, dtype=np.int64)
+    for chunk in _dnd_dice_chunks(term, budget, stream):
+        if use_histogram:
+            histograma += np.bincount(chunk, minlength=faces + 1)
+        elif keep_high is None and keep_low is None:
+            soma += _dnd_sum(chunk, faces) if alvo is None else int(np.count_nonzero(chunk >= alvo))
+        else:
+            if keep_high is not None:
+                high = np.concatenate((high, chunk))
+                if len(high) > keep_high:
+                    high = np.partition(high, len(high) - keep_high)[-keep_high:]
+            if keep_low is not None:
+                low = np.concatenate((low, chunk))
+                if len(low) > keep_low:
+                    low = np.partition(low, keep_low - 1)[:keep_low]
+    if use_histogram:
+        histograma = histograma[1:]
+        if keep_high is None and keep_low is None:
+            mantidos = histograma
+        else:
+            mantidos = np.zeros(faces, dtype=np.int64)
+            if keep_low is not None:
+                antes = np.cumsum(histograma) - histograma
+                mantidos += np.clip(keep_low - antes, 0, histograma)
+            if keep_high is not None:
+                depois = np.cumsum(histograma[::-1])[::-1] - histograma
+                mantidos += np.clip(keep_high - depois, 0, histograma)
+        if alvo is None:
+            soma = int(mantidos @ np.arange(1, faces + 1, dtype=np.int64))
+        else:
+            soma = int(mantidos[alvo - 1:].sum())
+    elif keep_high is not None or keep_low is not None:
+        mantidos = np.concatenate((high, low))
+        soma = _dnd_sum(mantidos, faces) if alvo is None else int(np.count_nonzero(mantidos >= alvo))
+    return soma, histograma
+
+
+def _dnd_number(text: str) -> int:
+    value = _evaluate_dnd_expression(text)
+    if value != int(value):
+        raise ValueError(f'{text} não é um número inteiro!')
+    return int(value)
+
+
+def _dnd_term(match) -> DndTerm:
+    """Avalia e valida os parâmetros de um termo [dados]d[faces] seguido dos modificadores r<[N], !, kh[N], kl[N] e
+    >=[N] em qualquer ordem"""
+    modifiers = dict.fromkeys(DND_MODIFIER_REGEX.groupindex)
+    for modifier in DND_MODIFIER_REGEX.finditer(match['modificadores']):
+        if modifiers[modifier.lastgroup] is not None:
+            raise ValueError(f'Modificador repetido em {match.group()}!')
+        modifiers[modifier.lastgroup] = modifier[modifier.lastgroup]
+    dados = _dnd_number(match['dados'])
+    if dados <= 0:
+        raise ValueError(f'Quantidade de dados inválida: {dados}!')
+    faces = _dnd_number(match['faces'])
+    if faces <= 0:
+        raise ValueError(f'Quantidade de faces inválida: {faces}!')
+    if faces > DND_FACES_LIMIT:
+        raise ValueError(f'Quantidade de faces acima do limite de {DND_FACES_LIMIT}: {faces}!')
+    if dados > DND_DICE_LIMIT:
+        raise ValueError(f'Quantidade de dados acima do limite de {DND_DICE_LIMIT}: {dados}!')
+    keep_high = modifiers['keep_high']
+    keep_low = modifiers['keep_low']
+    if keep_low is not None:
+        keep_low = _dnd_number(keep_low)
+        if keep_low <= 0:
+            raise ValueError(f'Quantidade de dados menores para manter inválida: {keep_low}!')
+    if keep_high is not None:
+        keep_high = _dnd_number(keep_high)
+        if keep_high <= 0:
+            raise ValueError(f'Quantidade de dados maiores para manter inválida: {keep_high}!')
+    minimo = 1
+    if modifiers['minimo'] is not None:
+        minimo = _dnd_number(modifiers['minimo'])
+        if not 1 <= minimo <= faces:
+            raise ValueError(f'Valor para rerolar os dados menores inválido: {minimo}!')
+    explode = modifiers['explode'] is not None
+    if explode and minimo == faces:
+        raise ValueError(f'Os dados de {match.group()} explodiriam para sempre!')
+    alvo = modifiers['alvo']
+    if alvo is not None:
+        alvo = _dnd_number(alvo)
+        if alvo <= 0:
+            raise ValueError(f'Valor dos sucessos inválido: {alvo}!')
+    return DndTerm(dados, faces, keep_high, keep_low, minimo, explode, alvo)
+
+
+def _evaluate_dnd_expression(expression: str, names: Optional[Dict[str, int]] = None, values=()):
+    """Avalia a expressão com os termos já rolados, o que sobrou fora dos termos e não é conta vira ValueError.
+
+    Com os vetores do %roll repetido a divisão por zero do numpy daria inf ou nan, o errstate a transforma em erro
+    como na rolagem simples.
+    """
+    try:
+        with np.errstate(divide='raise', invalid='raise'):
+            return _compile_expr(expression, names)(values)
+    except (SyntaxError, TypeError, KeyError):
+        raise ValueError(f'Expressão inválida: {expression}') from None
+    except (ZeroDivisionError, FloatingPointError):
+        raise ValueError('Divisão por zero!') from None
+
+
+def _dnd_row_totals(results: np.ndarray, alvo: Optional[int], faces: int) -> np.ndarray:
+    """Soma ou sucessos de cada linha, os zeros que completam as linhas não contam em nenhum dos dois.
+
+    Como no _dnd_sum, as somas que poderiam passar de int64 são feitas em inteiros do Python.
+    """
+    if alvo is None:
+        if results.shape[1] * faces <= DND_FACES_LIMIT:
+            return results.sum(axis=1, dtype=np.int64)
+        return results.astype(object).sum(axis=1)
+    return np.count_nonzero(results >= alvo, axis=1).astype(np.int64)
+
+
+def _roll_dnd_repetido(rolagem: str, repeticoes: int, stream: Optional[int] = None):
+    """Rola a expressão várias vezes, cada termo vira uma matriz (repetições, dados) somada por linha
+
+    Os termos são substituídos por referências na expressão compilada, que é avaliada de uma vez sobre os vetores de
+    somas. Com explosões as linhas têm tamanhos diferentes e são completadas com 0, que não soma e não é sucesso. Os
+    dados de todos os termos e repetições saem de um único DiceBudget, conferido antes de alocar as matrizes, que usam o
+    menor tipo inteiro que comporta as faces.
+    """
+    prefix = '_dados'
+    while prefix in rolagem:
+        prefix += '_'
+    last_end = 0
+    fragments = []
+    names = {}
+    textos = []
+    somas = []
+    terms = [(match, _dnd_term(match)) for match in DND_REGEX.finditer(rolagem.lower())]
+    budget = DiceBudget(DND_DICE_LIMIT)
+    budget.take(sum(term.dados for _, term in terms) * repeticoes)
+    for match, term in terms:
+        dados, keep_high, keep_low = term.dados, term.keep_high, term.keep_low
+        # Uma face a mais no tipo para o marcador das linhas completadas no kl
+        dtype = np.min_scalar_type(term.faces + 1).type
+        results = _dnd_faces(term, (repeticoes, dados), stream, dtype)
+        if term.explode:
+            results = _dnd_explode_rows(results, term, budget, stream)
+        largura = results.shape[1]
+        if keep_high is not None or keep_low is not None:
+            # np.partition separa só os dados mantidos de cada linha, sem ordenar a matriz inteira
+            mantidos = []
+            if keep_low is not None:
+                keep = min(keep_low, largura)
+                marcador = term.faces + 1
+                menores = np.partition(np.where(results == 0, dtype(marcador), results), keep - 1, axis=1)[:, :keep]
+                mantidos.append(np.where(menores == marcador, dtype(0), menores))
+            if keep_high is not None:
+                keep = min(keep_high, largura)
+                mantidos.append(np.partition(results, largura - keep, axis=1)[:, -keep:])
+            soma = _dnd_row_totals(np.hstack(mantidos), term.alvo, term.faces)
+        else:
+            soma = _dnd_row_totals(results, term.alvo, term.faces)
+        fragments.append(rolagem[last_end:match.start()])
+        name = f'{prefix}{len(somas)}'
+        names[name] = len(somas)
+        fragments.append(f'({name})')
+        textos.append(match.group())
+        somas.append(soma)
+        last_end = match.end()
+    fragments.append(rolagem[last_end:])
+    results = np.broadcast_to(_evaluate_dnd_expression(''.join(fragments), names, somas), (repeticoes,))
+    return results, textos, somas
+
+
+def _roll_dnd(rolagem: str, stream: Optional[int] = None):
+    terms = [(match, _dnd_term(match)) for match in DND_REGEX.finditer(rolagem.lower())]
+    # Um único limite para a expressão toda, conferido antes de rolar qualquer termo
+    budget = DiceBudget(DND_DICE_LIMIT)
+    budget.take(sum(term.dados for _, term in terms))
     last_end = 0
     new_str = []
     append_str = new_str.append
     rolls_results = []
     append_roll_result = rolls_results.append
-    for match in dados_match:
-        dados = eval_expr(match['dados'])
-        if dados <= 0:
-            raise ValueError(f'Quantidade de dados inválida: {dados}!')
-        faces = eval_expr(match['faces'])
-        if faces <= 0:
-            raise ValueError(f'Quantidade de faces inválida: {faces}!')
-        keep_high = match['keep_high']
-        keep_low = match['keep_low']
-        results = np.random.choice(np.arange(1, faces + 1, dtype=np.int), dados)  # type: np.ndarray
-        if keep_high is not None or keep_low is not None:
-            results_copy = results.copy()  # type: np.ndarray
-            results_copy.sort()
-            final_result = np.array([])
-            if keep_low is not None:
-                keep_low = eval_expr(keep_low)
-                if keep_low <= 0:
-                    raise ValueError(f'Quantidade de dados menores para manter inválida: {keep_low}!')
-                final_result = results_copy[:keep_low]
-            if keep_high is not None:
-                keep_high = eval_expr(keep_high)
-                if keep_high <= 0:
-                    raise ValueError(f'Quantidade de dados maiores para manter inválida: {keep_high}!')
-                final_result = np.hstack((final_result, results_copy[-keep_high:]))
-                desprezados = results_copy[keep_low:-keep_high]
-            else:
-                desprezados = results_copy[keep_low:]
-            append_roll_result((True, results, final_result, desprezados, match.group()))
+    for match, term in terms:
+        keep_high, keep_low = term.keep_high, term.keep_low
+        use_keep = keep_high is not None or keep_low is not None
+        if term.dados > DND_AGGREGATE_THRESHOLD:
+            soma, histograma = _roll_dnd_aggregate(term, budget, stream)
+            append_roll_result(DndStep(use_keep, None, None, None, match.group(), soma, histograma, term.alvo))
+            final_str_fragment = f'({soma})'
         else:
-            final_result = results
-            append_roll_result((False, results, final_result, np.array([]), match.group()))
+            results = np.concatenate(list(_dnd_dice_chunks(term, budget, stream)))  # type: np.ndarray
+            if use_keep:
+                results_copy = results.copy()  # type: np.ndarray
+                results_copy.sort()
+                final_result = np.array([])
+                if keep_low is not None:
+                    final_result = results_copy[:keep_low]
+                if keep_high is not None:
+                    final_result = np.hstack((final_result, results_copy[-keep_high:]))
+                    desprezados = results_copy[keep_low:-keep_high]
+                else:
+                    desprezados = results_copy[keep_low:]
+            else:
+                final_result = results
+                desprezados = np.array([])
+            if term.alvo is None:
+                soma = _dnd_sum(final_result, term.faces)
+                final_str_fragment = f"({'+'.join([f'{x:g}' for x in final_result])})"
+            else:
+                soma = int(np.count_nonzero(final_result >= term.alvo))
+                final_str_fragment = f'({soma})'
+            append_roll_result(DndStep(use_keep, results, final_result, desprezados, match.group(), soma, None,
+                                       term.alvo))
         match_start = match.start()
         match_end = match.end()
         if last_end != match_start:
             append_str(rolagem[last_end:match_start])
-        append_str(f"({'+'.join([f'{x:g}' for x in final_result])})")
+        append_str(final_str_fragment)
         last_end = match_end
     if last_end != len(rolagem):
         append_str(rolagem[last_end:])
     final_str = ''.join(new_str)
-    result = eval_expr(final_str)
+    result = _evaluate_dnd_expression(final_str)
     return result, final_str, rolls_results
 
 
-def _read_sheet_from_pdf(pdf_file):
-    pdf = PdfFileReader(str(pdf_file))
-    fields = pdf.getFields()
-    sheet = {ALIAS[x]: 0 for x in DISCIPLINAS}
+SHEET_FIELD_LEVEL = 0
+SHEET_FIELD_DISCIPLINA = 1
+SHEET_FIELD_PODER = 2
+
+DISCIPLINA_FIELD_SUFFIXES = list(zip([''] + list(range(1, 6)), ['A', 'C', 'E', 'B', 'D', 'F']))
+
+
+def _build_sheet_field_lookup() -> Dict[str, Tuple[int, object]]:
+    """Campo do AcroForm -> (tipo, destino), somente os campos que a leitura da ficha usa.
+
+    O destino é o atributo da ficha para os níveis e a posição da disciplina para o nome e os poderes dela.
+    """
+    lookup = {}
     for field, qtd in IMPORTANT_FIELDS:
         sheet_field = ALIAS[clean_text(field, True)]
-        sheet[sheet_field] = 0
         for field_suffix in [''] + list(range(1, qtd)):
-            if fields[f'{field}{field_suffix}'].get(r'/V') == r'/Sim':
-                sheet[sheet_field] += 1
-    for displina_field_suffix, level_suffix in zip([''] + list(range(1, 6)), ['A', 'C', 'E', 'B', 'D', 'F']):
-        disciplina_name = fields[f'Nome da Disciplina{displina_field_suffix}'].get('/V')
+            lookup[f'{field}{field_suffix}'] = (SHEET_FIELD_LEVEL, sheet_field)
+    for i, (disciplina_field_suffix, level_suffix) in enumerate(DISCIPLINA_FIELD_SUFFIXES):
+        lookup[f'Nome da Disciplina{disciplina_field_suffix}'] = (SHEET_FIELD_DISCIPLINA, i)
+        for power_suffix in [''] + list(range(1, 5)):
+            lookup[f'Poder{level_suffix}{power_suffix}'] = (SHEET_FIELD_PODER, i)
+    return lookup
+
+
+SHEET_FIELD_LOOKUP = _build_sheet_field_lookup()
+
+
+def _acroform_values(pdf, wanted: Dict[str, object]) -> dict:
+    """Valores (/V) dos campos do formulário cujo nome está em `wanted`.
+
+    Percorre a árvore /Fields do AcroForm como o getFields do PyPDF2: o nome é o /TM ou o /T do próprio campo, os
+    filhos vêm antes do pai e, com nomes repetidos, fica o último visitado. A diferença é que só lê os nomes, em vez de
+    montar um dicionário com todos os atributos de todos os campos do documento.
+    """
+    acroform = pdf.trailer['/Root'].getObject().get('/AcroForm')
+    if acroform is None:
+        return {}
+    values = {}
+    stack = [(x, False) for x in reversed(acroform.getObject().get('/Fields', []))]
+    while stack:
+        ref, kids_done = stack.pop()
+        field = ref.getObject()
+        kids = field.get('/Kids')
+        if kids is not None and not kids_done:
+            stack.append((field, True))
+            stack.extend((x, False) for x in reversed(kids.getObject()))
+            continue
+        name = field.get('/TM', field.get('/T'))
+        if name is not None and name in wanted:
+            values[name] = field.get('/V')
+    return values
+
+
+def _read_sheet_from_pdf(pdf_data: bytes):
+    from PyPDF2 import PdfFileReader
+    pdf = PdfFileReader(BytesIO(pdf_data))
+    values = _acroform_values(pdf, SHEET_FIELD_LOOKUP)
+    sheet = {ALIAS[x]: 0 for x in DISCIPLINAS}
+    disciplinas = [None] * len(DISCIPLINA_FIELD_SUFFIXES)
+    poderes = [[] for _ in DISCIPLINA_FIELD_SUFFIXES]  # type: List[List[str]]
+    # Os níveis e os nomes das disciplinas são obrigatórios, os campos de poder só são lidos nas disciplinas
+    # preenchidas, então uma disciplina vazia pode não ter os poderes no PDF
+    for name, (kind, target) in SHEET_FIELD_LOOKUP.items():
+        if kind == SHEET_FIELD_LEVEL:
+            sheet[target] = sheet.get(target, 0) + (values[name] == r'/Sim')
+        elif kind == SHEET_FIELD_DISCIPLINA:
+            disciplinas[target] = values[name]
+        else:
+            poderes[target].append(name)
+    for disciplina_name, power_fields in zip(disciplinas, poderes):
         if disciplina_name is None:
             continue
         cleaned_disciplina = clean_text(disciplina_name, True)
         normalized_name = [x for x in DISCIPLINAS if x in cleaned_disciplina]
         if len(normalized_name) != 1:
             raise ValueError(f'Error in disciplina {disciplina_name} {cleaned_disciplina} {normalized_name}')
-        normalized_name = ALIAS[normalized_name[0]]
-        for power_suffix in [''] + list(range(1, 5)):
-            if fields[f'Poder{level_suffix}{power_suffix}'].get(r'/V') == r'/Sim':
-                sheet[normalized_name] += 1
+        sheet[ALIAS[normalized_name[0]]] += sum(values[x] == r'/Sim' for x in power_fields)
     return sheet
 
 
+def _warm_pdf_worker():
+    import PyPDF2  # noqa: F401
+
+
+class PdfQueueFull(Exception):
+    pass
+
+
+class PdfParseQueue:
+    """Fila limitada de leitura de fichas, o PyPDF2 roda em um pool de processos fora do event loop.
+
+    As fichas lidas ficam em um LRU pelo sha256 do PDF, reenviar o mesmo arquivo não passa pela fila.
+    """
+
+    def __init__(self, workers: int, limit: int, cache_size: int):
+        self.workers = workers
+        self.limit = limit
+        self.cache_size = cache_size
+        self.pending = 0
+        self._slots = Semaphore(workers)
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        self._cache = OrderedDict()  # type: OrderedDict[bytes, dict]
+
+    def _pool(self) -> ProcessPoolExecutor:
+        """O pool de processos, criado no primeiro uso.
+
+        Sem fork: o filho de um fork herdaria as threads dos executores e os locks que elas seguravam no momento. Os
+        processos do forkserver importam este módulo de novo, por isso o pool não é criado já na importação.
+        """
+        if self._executor is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(start_method))
+        return self._executor
+
+    def position(self) -> int:
+        """Posição na fila de quem entrar agora, 0 se já vai ser lido direto"""
+        return max(self.pending - self.workers + 1, 0)
+
+    async def warm_up(self):
+        """Sobe os processos e importa o PyPDF2 neles antes da primeira ficha"""
+        loop = get_event_loop()
+        await gather(*(loop.run_in_executor(self._pool(), _warm_pdf_worker) for _ in range(self.workers)))
+
+    def _cached(self, digest: bytes) -> Optional[dict]:
+        sheet = self._cache.get(digest)
+        if sheet is None:
+            return None
+        self._cache.move_to_end(digest)
+        METRICS.increment('vampiro_pdf_cache_hits_total')
+        # Cópia, quem recebe a ficha pode alterá-la antes de gravar
+        return dict(sheet)
+
+    async def _parse(self, pdf_data: bytes, digest: bytes) -> dict:
+        """Lê um PDF que já foi contado em `pending`"""
+        try:
+            async with self._slots:
+                with METRICS.time('vampiro_pdf_parse_seconds'):
+                    sheet = await get_event_loop().run_in_executor(self._pool(), _read_sheet_from_pdf, pdf_data)
+        finally:
+            self.pending -= 1
+        if self.cache_size > 0:
+            self._cache[digest] = dict(sheet)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sheet
+
+    async def parse(self, pdf_data: bytes) -> dict:
+        digest = hashlib.sha256(pdf_data).digest()
+        sheet = self._cached(digest)
+        if sheet is not None:
+            return sheet
+        if self.pending >= self.limit:
+            raise PdfQueueFull()
+        self.pending += 1
+        return await self._parse(pdf_data, digest)
+
+    async def parse_many(self, pdfs: Sequence[bytes]) -> list:
+        """Lê vários PDFs em paralelo, a posição de cada um no resultado tem a ficha ou a exceção da leitura.
+
+        Todos entram na fila juntos, então uma importação só é recusada se a fila já estiver cheia.
+        """
+        digests = [hashlib.sha256(x).digest() for x in pdfs]
+        result = [self._cached(x) for x in digests]
+        missing = [i for i, x in enumerate(result) if x is None]
+        if missing and self.pending >= self.limit:
+            raise PdfQueueFull()
+        self.pending += len(missing)
+        parsed = await gather(*(self._parse(pdfs[i], digests[i]) for i in missing), return_exceptions=True)
+        for i, sheet in zip(missing, parsed):
+            result[i] = sheet
+        return result
+
+
+PDF_QUEUE = PdfParseQueue(PDF_WORKERS, PDF_QUEUE_LIMIT, PDF_CACHE_SIZE)
+
+
 @bot.command(name='ficha', help='''Envie a ficha por PDF, e então é feita a leitura dela e armazenamento dos dados
 Você pode dar um nome personalizado para a ficha, para poder ter mais de uma ao fazer as rolagens
 Utilize a sua ficha nos comandos terminados em f
@@ -514,68 +3230,192 @@ O nome da ficha só pode ter letras números e _''')
         await ctx.send('''> **ERRO**
 Envie a sua ficha em PDF como anexo e somente ela para que possa ser feita a leitura''')
         return
-    create_task(ctx.send('Baixando e lendo a sua ficha'))
-    with TemporaryDirectory() as temp_dir_name:
-        temp_dir = Path(temp_dir_name)
-        sheet_file = temp_dir / 'sheet.pdf'
-        try:
-            with sheet_file.open('wb') as fp:
-                await attachments[0].save(fp)
-            await message.delete()
-            sheet = await save_sheet(sheet_file, ctx.guild.id, author.id, name)
-        except BaseException as e:
-            await ctx.send('''> **ERRO**
+    if PDF_QUEUE.pending >= PDF_QUEUE.limit:
+        await ctx.send('''> **ERRO**
+Muitas fichas sendo lidas agora, tente novamente em alguns instantes''')
+        return
+    position = PDF_QUEUE.position()
+    if position:
+        await ctx.send(f'Baixando a sua ficha, ela é a {position}ª da fila de leitura')
+    else:
+        await ctx.send('Baixando e lendo a sua ficha')
+    try:
+        pdf_data = await attachments[0].read()
+        await message.delete()
+        sheet = await save_sheet(pdf_data, ctx.guild.id, author.id, name)
+    except PdfQueueFull:
+        await ctx.send('''> **ERRO**
+Muitas fichas sendo lidas agora, tente novamente em alguns instantes''')
+        return
+    except BaseException as e:
+        await ctx.send('''> **ERRO**
 Erro ao ler a sua ficha, peça para o Eros verificar, mais detalhes se encontram no log da aplicação''')
-            raise e
+        raise e
     await ctx.send('> **Lido**\nVerifique sua DM')
-    await author.send(f'''> **Lido**
+    await send_dm(ctx, f'''> **Lido**
 ```{"""
 """.join([f'{k}: {v}' for k, v in sheet.items()])}```
 ''')
 
 
-async def save_sheet(sheet_file, guild, author, name):
-    sheet = _read_sheet_from_pdf(sheet_file)
+async def save_sheet(pdf_data: bytes, guild, author, name):
+    sheet = await PDF_QUEUE.parse(pdf_data)
     sheet['vitalidade atual'] = sheet['vitalidade']
-    global df
-    df_row = (guild, author, name)
-    async with DF_LOCK:
-        df.loc[df_row, :] = 0
-        for k, v in sheet.items():
-            df.loc[df_row, k] = int(v)
-        df = df.astype(int)
-        df.to_csv(SHEETS_FILE)
+    async with SHEET_LOCKS.hold(guild, author):
+        await SHEET_STORE.save((guild, author, name), sheet)
     return sheet
 
 
-async def evaluate_sheet_expression(guild, user, expression):
-    matchs = re.finditer(REGEX_ALIAS, clean_text(expression))
-    new_str_display_fragments = []
-    append_display_fragment = new_str_display_fragments.append
-    new_str_process_fragments = []
-    append_process_fragments = new_str_process_fragments.append
+def sheet_name_from_filename(filename: str) -> str:
+    """Nome da ficha a partir do nome do arquivo, `Ficha Dona Lúcia.pdf` vira `ficha_dona_lucia`"""
+    return re.sub(r'[^a-z0-9_]+', '_', clean_text(Path(filename).stem)).strip('_')
 
-    def append_fragment(fragment):
-        nonlocal append_process_fragments, append_display_fragment
-        append_process_fragments(fragment)
-        append_display_fragment(fragment)
 
-    last_end = 0
-    for match in matchs:
-        start = match.start()
-        append_fragment(expression[last_end:start])
-        end = match.end()
-        last_end = end
-        status = ALIAS[match.group(2)]
-        append_display_fragment(status)
-        character = match.group(1)
-        if character is None:
-            character = ''
-        async with DF_LOCK:
-            value = df.loc[(guild, user, character), status]
-        append_process_fragments(f'({value})')
-    append_fragment(expression[last_end:])
-    return ''.join(new_str_display_fragments), int(eval_expr(''.join(new_str_process_fragments)))
+ZIP_PDF_MAX_BYTES = 20 * 1024 * 1024
+ZIP_TOTAL_MAX_BYTES = 100 * 1024 * 1024
+
+
+def _zip_pdfs(zip_data: bytes, limit: int) -> List[Tuple[str, bytes]]:
+    """Extrai os PDFs de um zip, ignorando pastas e os metadados do macOS.
+
+    Os tamanhos descompactados declarados no zip são conferidos antes de ler qualquer arquivo, e o zipfile não
+    descompacta além do tamanho declarado, então um zip bomba é recusado sem ocupar memória. Zips com senha, com uma
+    compressão que o zipfile não suporta ou com dados corrompidos viram ValueError, como os outros zips inválidos.
+    """
+    with zipfile.ZipFile(BytesIO(zip_data)) as archive:
+        infos = [x for x in archive.infolist() if not x.is_dir() and x.filename.lower().endswith('.pdf')
+                 and not x.filename.startswith('__MACOSX/')]
+        if len(infos) > limit:
+            raise ValueError(f'{len(infos)} PDFs no zip, o máximo é {limit}')
+        too_big = [x.filename for x in infos if x.file_size > ZIP_PDF_MAX_BYTES]
+        if too_big:
+            raise ValueError(f'{too_big[0]} passa de {ZIP_PDF_MAX_BYTES // 1024 // 1024}MB descompactado')
+        if sum(x.file_size for x in infos) > ZIP_TOTAL_MAX_BYTES:
+            raise ValueError(f'os PDFs passam de {ZIP_TOTAL_MAX_BYTES // 1024 // 1024}MB descompactados')
+        try:
+            return [(Path(x.filename).name, archive.read(x)) for x in infos]
+        except NotImplementedError:
+            raise ValueError('compressão ou criptografia não suportada')
+        except RuntimeError:
+            # O zipfile levanta RuntimeError para arquivos criptografados, o NotImplementedError é uma subclasse dele
+            raise ValueError('protegido por senha')
+        except (zlib.error, EOFError):
+            raise ValueError('dados corrompidos')
+
+
+async def _bulk_import_files(attachments: List[Attachment]):
+    """Baixa os anexos em paralelo, devolve os PDFs (nome, conteúdo) e os erros (nome, motivo) por arquivo"""
+    datas = await gather(*(x.read() for x in attachments))
+    pdfs = []
+    errors = []
+    for attachment, data in zip(attachments, datas):
+        filename = attachment.filename.lower()
+        if filename.endswith('.pdf'):
+            pdfs.append((attachment.filename, data))
+        elif filename.endswith('.zip'):
+            try:
+                pdfs.extend(await get_event_loop().run_in_executor(None, _zip_pdfs, data, BULK_IMPORT_LIMIT))
+            except (zipfile.BadZipFile, ValueError) as e:
+                errors.append((attachment.filename, f'zip inválido: {e}'))
+        else:
+            errors.append((attachment.filename, 'não é PDF nem zip'))
+    return pdfs, errors
+
+
+def format_report(lines: List[str], header: str) -> str:
+    """Junta as linhas de um relatório em uma mensagem, cortando as que não cabem no limite do Discord"""
+    kept = []
+    size = len(header) + 8
+    for i, line in enumerate(lines):
+        size += len(line) + 1
+        if size > DISCORD_MESSAGE_LIMIT - 40:
+            kept.append(f'... e mais {len(lines) - i}')
+            break
+        kept.append(line)
+    return header + '\n```\n' + '\n'.join(kept) + '\n```'
+
+
+async def evaluate_sheet_expression(guild, user, expression):
+    return (await evaluate_sheet_expressions(guild, user, expression))[0]
+
+
+async def evaluate_sheet_expressions(guild, user, *expressions):
+    """Avalia várias expressões lendo todos os atributos da ficha de uma única vez"""
+    return await evaluate_compiled_expressions(guild, user, [compile_sheet_expression(x) for x in expressions])
+
+
+async def evaluate_compiled_expressions(guild, user, compiled: Sequence[CompiledSheetExpression],
+                                        default_character: str = ''):
+    """Avalia expressões já compiladas, as referências sem ficha usam a `default_character`"""
+    refs = [((guild, user, character or default_character), status) for x in compiled
+            for character, status in x.refs]
+    values = await SHEET_STORE.get_many(refs) if refs else []
+    result = []
+    offset = 0
+    for x in compiled:
+        end = offset + len(x.refs)
+        result.append((x.display, int(x.function([int(v) for v in values[offset:end]]))))
+        offset = end
+    return result
+
+
+@bot.command(name='importar', help=f'''Importa várias fichas de uma vez, envie os PDFs ou um zip com eles como anexo
+O nome de cada ficha vem do nome do arquivo, por exemplo `ficha_dona_lucia.pdf` vira a ficha ficha_dona_lucia
+Todas as fichas lidas são gravadas juntas e a resposta mostra o resultado de cada arquivo
+Máximo de {BULK_IMPORT_LIMIT} PDFs por importação''')
+async def import_sheets(ctx: Context):
+    message = ctx.message  # type: Message
+    attachments = message.attachments  # type: List[Attachment]
+    author = ctx.author  # type: User
+    if not attachments:
+        await ctx.send('''> **ERRO**
+Envie as fichas em PDF, ou um zip com elas, como anexos da mensagem''')
+        return
+    if PDF_QUEUE.pending >= PDF_QUEUE.limit:
+        await ctx.send('''> **ERRO**
+Muitas fichas sendo lidas agora, tente novamente em alguns instantes''')
+        return
+    await ctx.send('Baixando e lendo as fichas')
+    try:
+        pdfs, errors = await _bulk_import_files(attachments)
+        await message.delete()
+        if len(pdfs) > BULK_IMPORT_LIMIT:
+            await ctx.send(f'''> **ERRO**
+{len(pdfs)} fichas enviadas, o máximo por importação é {BULK_IMPORT_LIMIT}''')
+            return
+        names = {}
+        to_parse = []
+        for filename, data in pdfs:
+            name = sheet_name_from_filename(filename)
+            if name in names:
+                errors.append((filename, f'mesmo nome de ficha que {names[name]}'))
+            else:
+                names[name] = filename
+                to_parse.append((filename, name, data))
+        parsed = await PDF_QUEUE.parse_many([data for _, _, data in to_parse])
+    except PdfQueueFull:
+        await ctx.send('''> **ERRO**
+Muitas fichas sendo lidas agora, tente novamente em alguns instantes''')
+        return
+    except BaseException as e:
+        await ctx.send('''> **ERRO**
+Erro ao importar as fichas, peça para o Eros verificar, mais detalhes se encontram no log da aplicação''')
+        raise e
+    sheets = []
+    lines = []
+    for (filename, name, _), sheet in zip(to_parse, parsed):
+        if isinstance(sheet, BaseException):
+            print('ERROR ao ler a ficha', filename, repr(sheet))
+            errors.append((filename, 'não foi possível ler a ficha'))
+            continue
+        sheet['vitalidade atual'] = sheet['vitalidade']
+        sheets.append(((ctx.guild.id, author.id, name), sheet))
+        lines.append(f'{filename}: ok, ficha {name or "padrão"}')
+    if sheets:
+        async with SHEET_LOCKS.hold(ctx.guild.id, author.id):
+            await SHEET_STORE.save_many(sheets)
+    lines.extend(f'{filename}: erro, {error}' for filename, error in errors)
+    await ctx.send(format_report(lines, f'> **Importação**\n{len(sheets)} fichas lidas, {len(errors)} erros'))
 
 
 @bot.command(name='setf', help='''Altera o valor de um atributo da ficha
@@ -589,29 +3429,27 @@ Manda o bagulho direito, o que é {attr}?''')
     final_attr = ALIAS[attr]
     guild = ctx.guild.id
     user = ctx.author.id
-    try:
-        display_expr, value_int = await evaluate_sheet_expression(guild, user, value)
-    except BaseException as e:
-        await ctx.send(f'''> **Erro**
+    async with SHEET_LOCKS.hold(guild, user):
+        try:
+            display_expr, value_int = await evaluate_sheet_expression(guild, user, value)
+        except BaseException as e:
+            await ctx.send(f'''> **Erro**
 Manda o bagulho direito, o que é {value}?''')
-        raise e
-    try:
-        key = (guild, user, character)
-        async with DF_LOCK:
-            if key not in df.index:
-                await ctx.send(f'''> **Erro**
-Manda o bagulho direito,quem é {character}?''')
-                return
-            df.loc[key, final_attr] = value_int
-            df.to_csv(SHEETS_FILE)
-    except BaseException as e:
-        await ctx.send('''> **ERRO**
+            raise e
+        try:
+            updated = await SHEET_STORE.set((guild, user, character), final_attr, value_int)
+        except BaseException as e:
+            await ctx.send('''> **ERRO**
 Erro ao atualizar a sua ficha, peça para o Eros verificar, mais detalhes se encontram no log da aplicação''')
-        raise e
-    create_task(ctx.send(f'''> **Feito**
+            raise e
+    if not updated:
+        await ctx.send(f'''> **Erro**
+Manda o bagulho direito,quem é {character}?''')
+        return
+    await ctx.send(f'''> **Feito**
 {final_attr} = {display_expr}
-Verifique a sua DM para mais informações!'''))
-    await ctx.author.send(f'''> **Atualizado**
+Verifique a sua DM para mais informações!''')
+    await send_dm(ctx, f'''> **Atualizado**
 {final_attr} = {value_int}''')
 
 
@@ -626,13 +3464,12 @@ Manda o bagulho direito, o que é {attr}?''')
     guild = ctx.guild.id
     user = ctx.author.id
     key = (guild, user, character)
-    async with DF_LOCK:
-        if key not in df.index:
-            await ctx.send(f'''> **Erro**
+    value = await SHEET_STORE.get(key, final_attr)
+    if value is None:
+        await ctx.send(f'''> **Erro**
 Manda o bagulho direito,quem é {character}?''')
-            return
-        value = df.loc[key, final_attr]
-    await ctx.author.send(f'{final_attr} = {value}')
+        return
+    await send_dm(ctx, f'{final_attr} = {value}')
 
 
 @bot.command(name='roll5f', help='''Rola os dados como o roll5e, mas utilizando também os dados da ficha
@@ -640,51 +3477,570 @@ Por exempo %roll5f força+briga''')
 async def roll_5e_with_sheet(ctx: Context, parada: str = '1', fome: str = 'fome', dificuldade: str = '0'):
     user = ctx.author.id
     guild = ctx.guild.id
-    parada_explain, parada_int = await evaluate_sheet_expression(guild, user, parada)
-    fome_explain, fome_int = await evaluate_sheet_expression(guild, user, fome)
-    dificuldade_explain, dificuldade_int = await evaluate_sheet_expression(guild, user, dificuldade)
-    await ctx.send(f'Rolando parada=[{parada_explain}] fome=[{fome_explain}] dificuldade=[{dificuldade_explain}]')
-    await roll5e(ctx, str(parada_int), str(fome_int), str(dificuldade_int))
+    async with hold_sheets_for_read(guild, user):
+        (parada_explain, parada_int), (fome_explain, fome_int), (dificuldade_explain, dificuldade_int) = \
+            await evaluate_sheet_expressions(guild, user, parada, fome, dificuldade)
+    await ctx.send(f'Rolando parada=[{parada_explain}] fome=[{fome_explain}] dificuldade=[{dificuldade_explain}]',
+                   priority=PRIORITY_ROLL)
+    await roll_v5(ctx, parada_int, fome_int, dificuldade_int, comando='roll5f')
+
+
+MACROS_PER_CHARACTER = 50
+
+# Macros já compiladas por (guild, user, character, nome), só as MACRO_CACHE_SIZE usadas mais recentemente. Todas as
+# mensagens de um servidor chegam no mesmo processo, então com shards o cache de cada processo continua válido
+MACRO_CACHE = OrderedDict()  # type: OrderedDict[Tuple[int, int, str, str], Tuple[CompiledSheetExpression, ...]]
+
+
+def _cache_macro(key: Tuple[int, int, str, str], compiled: Tuple[CompiledSheetExpression, ...]):
+    MACRO_CACHE[key] = compiled
+    MACRO_CACHE.move_to_end(key)
+    while len(MACRO_CACHE) > MACRO_CACHE_SIZE:
+        MACRO_CACHE.popitem(last=False)
+
+
+def _split_macro_name(text: str) -> Optional[Tuple[str, str]]:
+    """`[ficha.]macro` -> (ficha, macro), None se o nome for inválido"""
+    character, _, name = text.lower().rpartition('.')
+    if re.match(r'^[a-z0-9_]*$', character) is None or re.match(r'^[a-z0-9_]+$', name) is None:
+        return None
+    return character, name
+
+
+async def load_macro(guild: int, user: int, character: str, name: str):
+    key = (guild, user, character, name)
+    compiled = MACRO_CACHE.get(key)
+    if compiled is not None:
+        MACRO_CACHE.move_to_end(key)
+        return compiled
+    expressions = (await SHEET_STORE.get_macros((guild, user, character))).get(name)
+    if expressions is None:
+        return None
+    compiled = tuple(compile_sheet_expression(x) for x in expressions)
+    _cache_macro(key, compiled)
+    return compiled
+
+
+@bot.group(name='macro', invoke_without_command=True, help='''Paradas salvas da sua ficha, rolam como o roll5f
+    `/macro [ficha.]nome` rola a macro
+    `/macro salvar [ficha.]nome [parada] [fome] [dificuldade]` por exemplo `/macro salvar ataque força+briga fome 3`
+    `/macro listar [ficha]`
+    `/macro apagar [ficha.]nome`
+Sem o nome da ficha é usada a ficha padrão, os atributos sem ficha na parada também são lidos da ficha da macro''')
+async def macro(ctx: Context, nome: str = ''):
+    if not nome:
+        await ctx.send('Use `%macro [ficha.]nome` para rolar uma macro, mais detalhes em `%help macro`.')
+        return
+    split = _split_macro_name(nome)
+    if split is None:
+        await ctx.send(f'Macro "{nome}" inválida, use `%macro [ficha.]nome`.')
+        return
+    character, name = split
+    guild = ctx.guild.id
+    user = ctx.author.id
+    compiled = await load_macro(guild, user, character, name)
+    if compiled is None:
+        await ctx.send(f'Macro "{nome}" não encontrada, veja as suas com `%macro listar`.')
+        return
+    async with hold_sheets_for_read(guild, user):
+        (parada_explain, parada_int), (fome_explain, fome_int), (dificuldade_explain, dificuldade_int) = \
+            await evaluate_compiled_expressions(guild, user, compiled, character)
+    await ctx.send(f'Rolando {name} parada=[{parada_explain}] fome=[{fome_explain}] '
+                   f'dificuldade=[{dificuldade_explain}]', priority=PRIORITY_ROLL)
+    await roll_v5(ctx, parada_int, fome_int, dificuldade_int, comando='roll5f', character=character)
+
+
+@macro.command(name='salvar', help='Salva uma parada da ficha para rolar com `%macro nome`')
+async def save_macro(ctx: Context, nome: str, parada: str = '1', fome: str = 'fome', dificuldade: str = '0'):
+    split = _split_macro_name(nome)
+    if split is None or split[1] in macro.all_commands:
+        await ctx.send(f'''> **Erro**
+O nome da macro "{nome}" só pode ter letras números e _, e não pode ser {', '.join(macro.all_commands)}''')
+        return
+    character, name = split
+    expressions = (parada, fome, dificuldade)
+    try:
+        compiled = tuple(compile_sheet_expression(x) for x in expressions)
+    except (SyntaxError, TypeError, KeyError):
+        await ctx.send(f'Parada "{parada} {fome} {dificuldade}" inválida.')
+        return
+    key = (ctx.guild.id, ctx.author.id, character)
+    macros = await SHEET_STORE.get_macros(key)
+    if name not in macros and len(macros) >= MACROS_PER_CHARACTER:
+        await ctx.send(f'A ficha já tem {len(macros)} macros, apague alguma com `%macro apagar` antes.')
+        return
+    await SHEET_STORE.save_macro(key, name, expressions)
+    _cache_macro((*key, name), compiled)
+    await ctx.send(f'Macro {name} salva: parada=[{compiled[0].display}] fome=[{compiled[1].display}] '
+                   f'dificuldade=[{compiled[2].display}]')
+
+
+@macro.command(name='listar', help='Lista as macros de uma ficha')
+async def list_macros(ctx: Context, character: str = ''):
+    macros = await SHEET_STORE.get_macros((ctx.guild.id, ctx.author.id, character.lower()))
+    if not macros:
+        await ctx.send('Nenhuma macro salva nesta ficha, crie com `%macro salvar`.')
+        return
+    linhas = [f'{name}: {parada} | {fome} | {dificuldade}'
+              for name, (parada, fome, dificuldade) in sorted(macros.items())]
+    await ctx.send(format_report(linhas, f'> **Macros da ficha {character or "padrão"}**'))
+
+
+@macro.command(name='apagar', help='Apaga uma macro')
+async def delete_macro(ctx: Context, nome: str):
+    split = _split_macro_name(nome)
+    if split is None:
+        await ctx.send(f'Macro "{nome}" inválida, use `%macro apagar [ficha.]nome`.')
+        return
+    character, name = split
+    key = (ctx.guild.id, ctx.author.id, character)
+    MACRO_CACHE.pop((*key, name), None)
+    if await SHEET_STORE.delete_macro(key, name):
+        await ctx.send(f'Macro {name} apagada')
+    else:
+        await ctx.send(f'Macro "{nome}" não encontrada.')
 
 
 @bot.command(name='rcf', help='Rola o rc e atualiza automaticamente a ficha')
 async def rouse_check_sheet(ctx: Context, nome: str = ''):
-    resultado = np.random.choice(FACES, size=(1,))  # type: np.ndarray
+    resultado = DICE.d10(1, dice_stream(ctx))  # type: np.ndarray
     if resultado >= 6:
+        ROLL_LOG.append(ctx, 'rcf', 1, 0, 0, resultado, 1, nome)
         await ctx.send(f'''> **Passou**
-            resultado: {resultado[0]}''', file=create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'))
+            resultado: {resultado[0]}''', file=await create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'),
+                       priority=PRIORITY_ROLL)
     else:
         key = (ctx.guild.id, ctx.author.id, nome)
         try:
-            async with DF_LOCK:
-                if key not in df.index:
-                    await ctx.send(f'''> **Erro**
+            async with SHEET_LOCKS.hold(ctx.guild.id, ctx.author.id):
+                fome = await SHEET_STORE.increment(key, 'fome')
+            if fome is None:
+                await ctx.send(f'''> **Erro**
 Manda o bagulho direito,quem é {nome}?''')
-                    return
-                df.loc[key, 'fome'] += 1
-                fome = df.loc[key, 'fome']
-                df.to_csv(SHEETS_FILE)
+                return
         except BaseException as e:
             await ctx.send('''> **ERRO**
 Erro ao atualizar a sua ficha, peça para o Eros verificar, mais detalhes se encontram no log da aplicação''')
             raise e
+        ROLL_LOG.append(ctx, 'rcf', 1, 0, 0, resultado, 0, nome)
         await ctx.send(f'''> **+1 Fome**
-                    resultado: {resultado[0]}''', file=create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'))
-        await ctx.author.send(f'fome = {fome}')
+                    resultado: {resultado[0]}''',
+                       file=await create_image_file(resultado, [], f'Rouse check {ctx.guild}.png'),
+                       priority=PRIORITY_ROLL)
+        await send_dm(ctx, f'fome = {fome}')
+
+
+def _runs(mask: np.ndarray) -> Tuple[int, int]:
+    """Maior sequência de True e a sequência de True que termina no último elemento"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if not len(starts):
+        return 0, 0
+    return int((ends - starts).max()), int(ends[-1] - starts[-1]) if ends[-1] == len(mask) else 0
+
+
+def select_rolls(log: np.ndarray, guild: int, user: int, character: Optional[str] = None,
+                 since: Optional[float] = None) -> np.ndarray:
+    """Rolagens de um jogador em ordem cronológica, filtradas coluna a coluna sem passar pelo pandas"""
+    mask = (log['guild'] == guild) & (log['user'] == user)
+    if character is not None:
+        mask &= log['character'] == roll_log_character(character)
+    if since is not None:
+        mask &= log['timestamp'] >= since
+    rolls = log[mask]
+    return rolls[np.argsort(rolls['timestamp'], kind='stable')]
+
+
+def _commands_mask(rolls: np.ndarray, *comandos: str) -> np.ndarray:
+    return np.isin(rolls['comando'], [ROLL_LOG_COMMANDS.index(x) for x in comandos])
+
+
+def roll_history_lines(log: np.ndarray, guild: int, user: int, character: str, since: Optional[float]) -> List[str]:
+    rolls = select_rolls(log, guild, user, character, since)
+    v5 = rolls[_commands_mask(rolls, 'roll5e', 'roll5f', 'rollgrupo')]
+    rc = rolls[_commands_mask(rolls, 'rc', 'rcf', 'rcgrupo')]
+    linhas = []
+    if len(v5):
+        contagem = np.bincount(v5['resultado'], minlength=len(RESULTADOS_CURTOS))
+        linhas.append(f'Rolagens de V5: {len(v5)}, média de {v5["acertos"].mean():.2f} acertos')
+        linhas.extend(f'  {RESULTADOS_CURTOS[k]}: {contagem[k]} ({contagem[k] / len(v5):.1%})'
+                      for k in sorted(RESULTADOS_CURTOS, reverse=True))
+        maior_falhas, atual_falhas = _runs(v5['resultado'] < RESULTADO_VITORIA)
+        maior_sucessos, atual_sucessos = _runs(v5['resultado'] >= RESULTADO_VITORIA)
+        linhas.append(f'Maior sequência de falhas: {maior_falhas}, de sucessos: {maior_sucessos}')
+        linhas.append(f'Sequência atual: {atual_falhas} falhas' if atual_falhas else
+                      f'Sequência atual: {atual_sucessos} sucessos')
+    if len(rc):
+        linhas.append(f'Checagens de sangue: {len(rc)}, +1 fome em {int((rc["resultado"] == 0).sum())}')
+    compulsoes = int(_commands_mask(rolls, 'compulsao').sum())
+    if compulsoes:
+        linhas.append(f'Testes de compulsão: {compulsoes}')
+    dnd = int(_commands_mask(rolls, 'roll').sum())
+    if dnd:
+        linhas.append(f'Rolagens de D&D: {dnd}')
+    return linhas
+
+
+@lru_cache(maxsize=None)
+def _v5_acertos_moments(parada: int, fome: int) -> Tuple[float, float]:
+    """Média e variância dos acertos de uma parada, a partir de P(acertos >= d) das tabelas do %prob"""
+    sucessos, _ = v5_probability_table(parada, fome)
+    at_least = sucessos[1:].sum(axis=1)
+    d = np.arange(1, len(sucessos))
+    mean = at_least.sum()
+    return float(mean), float(((2 * d - 1) * at_least).sum() - mean ** 2)
+
+
+def dice_luck_lines(log: np.ndarray, guild: int, user: int, since: Optional[float]) -> List[str]:
+    """Compara os resultados das rolagens com o esperado para as mesmas paradas, fome e dificuldade"""
+    rolls = select_rolls(log, guild, user, since=since)
+    v5 = rolls[_commands_mask(rolls, 'roll5e', 'roll5f', 'rollgrupo') & (rolls['parada'] <= DICES_LIMIT)]
+    rc = rolls[_commands_mask(rolls, 'rc', 'rcf', 'rcgrupo')]
+    linhas = []
+    z = 0.
+    if len(v5):
+        combos, counts = np.unique(np.stack([v5['parada'], v5['fome'], v5['dificuldade']], axis=1).astype(np.int64),
+                                   axis=0, return_counts=True)
+        esperado = np.zeros(len(RESULTADOS_CURTOS))
+        media = variancia = 0.
+        for (parada, fome, dificuldade), n in zip(combos.tolist(), counts.tolist()):
+            for k, p in v5_probabilities(parada, fome, dificuldade).items():
+                esperado[k] += n * p
+            mean, var = _v5_acertos_moments(parada, min(fome, parada))
+            media += n * mean
+            variancia += n * var
+        acertos = int(v5['acertos'].sum())
+        z = (acertos - media) / variancia ** .5 if variancia else 0.
+        contagem = np.bincount(v5['resultado'], minlength=len(RESULTADOS_CURTOS))
+        linhas.append(f'Rolagens de V5: {len(v5)}, {acertos} acertos para {media:.1f} esperados ({z:+.1f} desvios)')
+        linhas.extend(f'  {RESULTADOS_CURTOS[k]}: {contagem[k]} para {esperado[k]:.1f} esperados'
+                      for k in sorted(RESULTADOS_CURTOS, reverse=True))
+    if len(rc):
+        passou = int(rc['resultado'].sum())
+        linhas.append(f'Checagens de sangue: {passou} de {len(rc)} passaram, {len(rc) / 2:.1f} esperadas')
+    if not linhas:
+        return linhas
+    if z <= -2:
+        linhas.append('Veredito: dados amaldiçoados')
+    elif z >= 2:
+        linhas.append('Veredito: dados abençoados')
+    else:
+        linhas.append('Veredito: dados dentro do esperado')
+    return linhas
+
+
+async def _history_since(ctx: Context, dias: str) -> Tuple[bool, Optional[float]]:
+    if not dias:
+        return True, None
+    if not dias.isdigit() or int(dias) == 0:
+        await ctx.send(f'Total de dias "{dias}" inválido, use um número inteiro maior que 0.')
+        return False, None
+    return True, time() - int(dias) * 86400
+
+
+@bot.command(name='historico', help='''Estatísticas das suas rolagens com uma ficha
+    `/historico [ficha] [dias]`
+Mostra a distribuição dos resultados do roll5e, roll5f e rollgrupo, as maiores sequências de falhas e sucessos,
+as checagens de sangue, os testes de compulsão e as rolagens de D&D, opcionalmente só dos últimos dias''')
+async def roll_history(ctx: Context, nome: str = '', dias: str = ''):
+    if nome.isdigit() and not dias:
+        nome, dias = '', nome
+    valid, since = await _history_since(ctx, dias)
+    if not valid:
+        return
+    linhas = await ROLL_LOG.query(roll_history_lines, ctx.guild.id, ctx.author.id, nome, since)
+    if not linhas:
+        await ctx.send('Nenhuma rolagem registrada ainda')
+        return
+    await ctx.send(f'''> **Histórico da ficha {nome or "padrão"}**
+```
+{chr(10).join(linhas)}
+```''')
+
+
+@bot.command(name='dados', help='''Compara as suas rolagens neste servidor com o esperado
+    `/dados [dias]`
+Mostra quantos acertos e quantos de cada resultado eram esperados para as mesmas paradas, fome e dificuldade''')
+async def dice_luck(ctx: Context, dias: str = ''):
+    valid, since = await _history_since(ctx, dias)
+    if not valid:
+        return
+    linhas = await ROLL_LOG.query(dice_luck_lines, ctx.guild.id, ctx.author.id, since)
+    if not linhas:
+        await ctx.send('Nenhuma rolagem registrada ainda')
+        return
+    await ctx.send(f'''> **Seus dados**
+```
+{chr(10).join(linhas)}
+```''')
+
+
+GROUP_DICE_LIMIT = 100_000
+GROUP_MEMBER_REGEX = re.compile(r'^<@!?(\d+)>(?:\.([a-z0-9_]*))?$')
+
+
+def _split_group_args(args: Sequence[str]) -> Tuple[List[str], Optional[set]]:
+    """Separa as expressões das menções `@jogador` (todas as fichas) ou `@jogador.ficha` que escolhem o grupo"""
+    expressions = []
+    selected = set()
+    for arg in args:
+        match = GROUP_MEMBER_REGEX.match(arg.strip().lower())
+        if match is None:
+            expressions.append(arg)
+        else:
+            selected.add((int(match[1]), match[2]))
+    return expressions, selected or None
+
+
+async def load_group(ctx: Context, selected: Optional[set], attrs: Sequence[str]):
+    """Fichas do servidor, ou só as escolhidas, e a matriz (fichas, atributos) com os valores de `attrs`"""
+    keys, values = await SHEET_STORE.get_guild_sheets(ctx.guild.id, attrs)
+    if selected is not None:
+        rows = [i for i, (user, character) in enumerate(keys)
+                if (user, None) in selected or (user, character) in selected]
+        keys = [keys[i] for i in rows]
+        values = values[rows]
+    return keys, values
+
+
+def _character_label(ctx: Context, user: int, character: str) -> str:
+    member = ctx.guild.get_member(user)
+    name = str(user) if member is None else member.display_name
+    return f'{name}.{character}' if character else name
+
+
+@bot.command(name='rollgrupo', help='''Rola a mesma parada para todos os personagens do servidor, cada um com a sua
+    `/rollgrupo [parada] [fome] [dificuldade] [@jogador ou @jogador.ficha ...]`
+Por exemplo `/rollgrupo raciocínio+prontidão` para todos ou `/rollgrupo destreza+furtividade fome 3 @Ana @Beto.ficha2`
+O resultado é uma tabela ordenada pelos acertos''')
+async def roll_group(ctx: Context, *args: str):
+    expressions, selected = _split_group_args(args)
+    if not 1 <= len(expressions) <= 3:
+        await ctx.send('Use `%rollgrupo [parada] [fome] [dificuldade]` seguido das menções de quem vai rolar, '
+                       'sem menções rolam todas as fichas do servidor.')
+        return
+    expressions += ['fome', '0'][len(expressions) - 1:]
+    try:
+        compiled = [compile_sheet_expression(x) for x in expressions]
+    except (SyntaxError, TypeError, KeyError):
+        await ctx.send(f'Rolagem "{" ".join(expressions)}" inválida.')
+        return
+    if any(character for x in compiled for character, _ in x.refs):
+        await ctx.send('No rollgrupo use só os atributos, sem o nome da ficha, cada personagem rola com a própria.')
+        return
+    attrs = sorted({status for x in compiled for _, status in x.refs})
+    keys, values = await load_group(ctx, selected, attrs)
+    if not keys:
+        await ctx.send('Nenhuma ficha encontrada para o grupo.')
+        return
+    columns = {status: values[:, i] for i, status in enumerate(attrs)}
+    # As expressões compiladas só usam operadores, então avaliam direto sobre as colunas
+    paradas, fomes, dificuldades = [
+        np.broadcast_to(np.asarray(x.function([columns[status] for _, status in x.refs])).astype(np.int64),
+                        (len(keys),))
+        for x in compiled]
+    paradas = np.maximum(paradas, 0)
+    fomes = np.clip(fomes, 0, paradas)
+    total = int(paradas.sum())
+    if total > GROUP_DICE_LIMIT:
+        await ctx.send(f'O grupo rolaria {total} dados, o máximo é {GROUP_DICE_LIMIT}.')
+        return
+    v5 = classify_v5_ragged(DICE.d10(total, dice_stream(ctx)), paradas, fomes, dificuldades)
+    ROLL_LOG.append(ctx, 'rollgrupo', paradas, fomes, dificuldades, v5.acertos, v5.resultado,
+                    [character for _, character in keys], [user for user, _ in keys])
+    linhas = [f'  # {"Personagem":<20} Parada Fome Acertos  Resultado']
+    for i, row in enumerate(np.lexsort((-v5.resultado, -v5.acertos)), 1):
+        user, character = keys[row]
+        linhas.append(f'{i:>3} {_character_label(ctx, user, character)[:20]:<20} {paradas[row]:>6} {fomes[row]:>4} '
+                      f'{v5.acertos[row]:>7}  {RESULTADOS_CURTOS[v5.resultado[row]]}')
+    await ctx.send(format_report(linhas, f'> **Rolagem de grupo parada=[{compiled[0].display}] '
+                                         f'fome=[{compiled[1].display}] dificuldade=[{compiled[2].display}]**'),
+                   priority=PRIORITY_ROLL)
+
+
+@bot.command(name='rcgrupo', help='''Checagem de sangue de todos os personagens do servidor, atualizando a fome deles
+    `/rcgrupo [@jogador ou @jogador.ficha ...]`
+Sem menções entram todas as fichas do servidor''')
+async def rouse_check_group(ctx: Context, *args: str):
+    expressions, selected = _split_group_args(args)
+    if expressions:
+        await ctx.send('Use `%rcgrupo` seguido só das menções de quem vai rolar, sem menções rolam todas as fichas.')
+        return
+    keys, values = await load_group(ctx, selected, ['fome'])
+    if not keys:
+        await ctx.send('Nenhuma ficha encontrada para o grupo.')
+        return
+    dados = DICE.d10(len(keys), dice_stream(ctx))
+    falhas = np.flatnonzero(dados < 6)
+    fomes = values[:, 0].copy()
+    if len(falhas):
+        try:
+            # Toda a fome do grupo é atualizada em uma única escrita, segurando a faixa de cada jogador envolvido
+            async with SHEET_LOCKS.hold_many([(ctx.guild.id, keys[i][0]) for i in falhas]):
+                fomes[falhas] = await SHEET_STORE.increment_many([(ctx.guild.id, *keys[i]) for i in falhas], 'fome',
+                                                                 [1] * len(falhas))
+        except BaseException as e:
+            await ctx.send('''> **ERRO**
+Erro ao atualizar as fichas, peça para o Eros verificar, mais detalhes se encontram no log da aplicação''')
+            raise e
+    ROLL_LOG.append(ctx, 'rcgrupo', 1, 0, 0, dados, dados >= 6, [character for _, character in keys],
+                    [user for user, _ in keys])
+    linhas = [f'  # {"Personagem":<20} Dado  Resultado']
+    for i, row in enumerate(np.argsort(-dados.astype(np.int64), kind='stable'), 1):
+        user, character = keys[row]
+        resultado = 'Passou' if dados[row] >= 6 else f'+1 Fome, fome = {fomes[row]}'
+        linhas.append(f'{i:>3} {_character_label(ctx, user, character)[:20]:<20} {dados[row]:>4}  {resultado}')
+    await ctx.send(format_report(linhas, f'> **Checagem de sangue do grupo, {len(falhas)} de {len(keys)} '
+                                         f'ganharam fome**'), priority=PRIORITY_ROLL)
+
+
+@bot.command(name='stats', help='Resumo das métricas de desempenho do bot, somente para o dono do bot')
+@commands.is_owner()
+async def show_stats(ctx: Context):
+    lines = METRICS.summary()
+    if len(lines) == 1:
+        await ctx.send('Nenhuma métrica registrada ainda')
+        return
+    message = []
+    size = 0
+    for line in lines:
+        if size + len(line) + 10 > DISCORD_MESSAGE_LIMIT:
+            await ctx.send('```\n' + '\n'.join(message) + '\n```')
+            message = []
+            size = 0
+        message.append(line)
+        size += len(line) + 1
+    await ctx.send('```\n' + '\n'.join(message) + '\n```')
+
+
+@show_stats.error
+async def show_stats_error(ctx: Context, error):
+    if isinstance(error, commands.NotOwner):
+        await ctx.send('''> **Erro**
+Somente o dono do bot pode ver as estatísticas''')
+    else:
+        print('ERROR no %stats', repr(error))
+
+
+def start_store(background: bool = False):
+    """Cria o SHEET_STORE e carrega as fichas, com `background` a carga roda em uma thread enquanto o bot conecta"""
+    global SHEET_STORE, STORE_LOADED
+    if SHEETS_BACKEND == 'sqlite':
+        SHEET_STORE = SqliteSheetStore(SHEETS_DB)
+    elif SHEETS_BACKEND == 'csv' and SHARD_COUNT:
+        raise ValueError('O backend csv não pode ser dividido entre processos, use SHEETS_BACKEND=sqlite com shards')
+    elif SHEETS_BACKEND == 'csv':
+        SHEET_STORE = CsvSheetStore(SHEETS_FILE, SHEETS_FLUSH_INTERVAL, SHEETS_FLUSH_THRESHOLD)
+    else:
+        raise ValueError(f'SHEETS_BACKEND desconhecido: {SHEETS_BACKEND}')
+    store = SHEET_STORE
 
+    def load():
+        started_at = perf_counter()
+        store.load()
+        log_startup_phase(f'fichas ({SHEETS_BACKEND})', started_at)
 
-def start_df():
-    global df
-    if not SHEETS_FILE.is_file():
-        df = pd.DataFrame(columns=['guild', 'user', 'character'] + sorted(list(set(ALIAS.values())))).set_index(
-            ['guild', 'user', 'character'])
-        df.to_csv(SHEETS_FILE)
+    if background:
+        STORE_LOADED = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-load').submit(load)
     else:
-        df = pd.read_csv(SHEETS_FILE, index_col=['guild', 'user', 'character'], keep_default_na=False,
-                         dtype={k: int for k in set(ALIAS.values())})
+        load()
+        STORE_LOADED = Future()
+        STORE_LOADED.set_result(None)
+
+
+def shard_groups(shard_count: int, processes: int) -> List[List[int]]:
+    return [list(range(i, shard_count, processes)) for i in range(processes)]
+
+
+def _shard_environment(shard_count: int, shard_ids: List[int], index: int) -> Dict[str, str]:
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=','.join(str(x) for x in shard_ids))
+    # Cada processo exporta as suas próprias métricas
+    if METRICS_PORT:
+        env['METRICS_PORT'] = str(int(METRICS_PORT) + index)
+    if METRICS_FILE:
+        path = Path(METRICS_FILE)
+        env['METRICS_FILE'] = str(path.with_name(f'{path.stem}-{index}{path.suffix}'))
+    return env
+
+
+def supervise(shard_count: int, processes: int):
+    """Roda os shards em `processes` processos filhos, reiniciando os que caírem, até receber SIGINT ou SIGTERM"""
+    if SHEETS_BACKEND != 'sqlite':
+        raise ValueError('Os shards compartilham as fichas pelo SQLite, use SHEETS_BACKEND=sqlite')
+    groups = shard_groups(shard_count, processes)
+    children = {}  # type: Dict[int, subprocess.Popen]
+    started_at = {}  # type: Dict[int, float]
+    stopping = []
+
+    def spawn(index: int):
+        print(f'Iniciando o processo {index} com os shards {groups[index]} de {shard_count}')
+        children[index] = subprocess.Popen([sys.executable, str(Path(__file__).resolve())],
+                                           env=_shard_environment(shard_count, groups[index], index))
+        started_at[index] = perf_counter()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for child in children.values():
+            if child.poll() is None:
+                child.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(len(groups)):
+        if stopping:
+            break
+        spawn(index)
+        # O Discord limita quantos shards podem se identificar ao mesmo tempo
+        blocking_sleep(SHARD_START_INTERVAL)
+    restarts = {}  # type: Dict[int, float]
+    while children or restarts:
+        blocking_sleep(1)
+        now = perf_counter()
+        for index, child in list(children.items()):
+            code = child.poll()
+            if code is None:
+                continue
+            del children[index]
+            if stopping:
+                continue
+            # Quem cai logo depois de iniciar espera antes de tentar de novo, para não ficar reiniciando sem parar
+            delay = 0 if now - started_at[index] > 60 else 6 * SHARD_START_INTERVAL
+            print(f'ERROR o processo {index} saiu com {code}, reiniciando em {delay:.0f}s')
+            restarts[index] = now + delay
+        if stopping:
+            restarts.clear()
+        for index, restart_at in list(restarts.items()):
+            if restart_at <= now:
+                del restarts[index]
+                spawn(index)
 
 
 if __name__ == '__main__':
-    print('Iniciando')
-    start_df()
-    bot.run(TOKEN)
+    parser = argparse.ArgumentParser(description='Bot simples para rolagens do RPG vampiro 5e')
+    parser.add_argument('--gerar-cache', action='store_true',
+                        help='Gera o STARTUP_CACHE com os apelidos e o atlas dos dados e sai')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='Supervisor: roda N shards em processos separados, que compartilham as fichas pelo SQLite')
+    parser.add_argument('--processos', type=int, metavar='P',
+                        help='Quantidade de processos do --shards, cada um com N/P shards (padrão um por shard)')
+    parser.add_argument('--importar-csv', metavar='CSV', nargs='?', const=str(SHEETS_FILE),
+                        help='Importa as fichas de um CSV (por padrão SHEETS_FILE) para o SQLite em SHEETS_DB e sai')
+    args = parser.parse_args()
+    if args.gerar_cache:
+        write_startup_cache(STARTUP_CACHE, _startup_fingerprint(), build_startup_tables())
+        print(f'Cache de inicialização gravado em {STARTUP_CACHE}')
+    elif args.shards:
+        supervise(args.shards, min(args.processos or args.shards, args.shards))
+    elif args.importar_csv is not None:
+        total = import_csv_to_sqlite(Path(args.importar_csv), SHEETS_DB)
+        print(f'{total} fichas importadas para {SHEETS_DB}')
+    else:
+        print('Iniciando' if not SHARD_COUNT else f'Iniciando os shards {SHARD_IDS} de {SHARD_COUNT}')
+        start_store(background=True)
+        try:
+            bot.run(TOKEN)
+        finally:
+            print('Gravando fichas pendentes')
+            SHEET_STORE.close()
+            ROLL_LOG.close()
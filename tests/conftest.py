@@ -0,0 +1,39 @@
+"""Configuração dos testes, `python -m pytest` funciona a partir de qualquer diretório"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# O main.py exige SHEETS_FILE no import
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+os.environ.setdefault('SHEETS_FILE', str(Path(tempfile.gettempdir()) / 'test_sheets.csv'))
+os.environ.setdefault('ROLL_LOG_FILE', str(Path(tempfile.gettempdir()) / 'test_rolagens.bin'))
+
+
+@pytest.fixture
+def run():
+    """Roda uma corrotina no event loop do bot"""
+    import main
+    return main.bot.loop.run_until_complete
+
+
+@pytest.fixture(autouse=True, scope='session')
+def close_outbound():
+    """Encerra as tarefas da fila de saída que algum teste tenha iniciado"""
+    yield
+    import main
+    main.bot.loop.run_until_complete(main.OUTBOUND.close())
+
+
+@pytest.fixture
+def dice(monkeypatch):
+    """Dados determinísticos"""
+    import main
+    source = main.DiceSource(0)
+    monkeypatch.setattr(main, 'DICE', source)
+    return source
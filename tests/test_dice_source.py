@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+
+import main
+
+
+def expected_d10(seed, spawn_key, size):
+    generator = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=spawn_key)))
+    return generator.integers(1, 11, size, dtype=np.uint8)
+
+
+def test_streams_are_derived_from_seed_and_stream():
+    dice = main.DiceSource(7, buffer_size=64)
+    rolled = np.concatenate([dice.d10(5, 123) for _ in range(12)])
+    assert rolled.tolist() == expected_d10(7, (123,), 64)[:60].tolist()
+    assert dice.d10(3).tolist() == expected_d10(7, (), 64)[:3].tolist()
+
+
+def test_streams_are_bounded():
+    dice = main.DiceSource(0, buffer_size=16, max_streams=8)
+    dice.d10(1)
+    for stream in range(1000):
+        dice.d10(2, stream)
+        dice.integers(6, 3, stream)
+    assert len(dice._streams) == 8
+    # O fluxo das DMs nunca é descartado
+    assert None in dice._streams
+    assert list(dice._streams)[-1] == 999
+
+
+def test_recently_used_streams_are_kept():
+    dice = main.DiceSource(0, max_streams=4)
+    for stream in range(100):
+        dice.d10(1, 0)
+        dice.d10(1, stream)
+    assert 0 in dice._streams
+
+
+def test_evicted_stream_never_repeats_its_dice():
+    dice = main.DiceSource(0, buffer_size=16, max_streams=2)
+    first = dice.integers(1000, 50, 1).tolist()
+    dice.integers(1000, 1, 2)
+    dice.integers(1000, 1, 3)
+    assert 1 not in dice._streams
+    again = dice.integers(1000, 50, 1).tolist()
+    assert first != again
+    assert first == main.DiceSource(0).integers(1000, 50, 1).tolist()
+
+
+def test_d10_slices_are_read_only():
+    dice = main.DiceSource(0, buffer_size=16)
+    rolled = dice.d10((2, 3), 5)
+    assert rolled.shape == (2, 3) and not rolled.flags.writeable
+    assert dice.d10(100, 5).shape == (100,)
+
+
+def test_concurrent_generators_are_unique():
+    dice = main.DiceSource(0, max_streams=16)
+    generators = []
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        generators.append(dice.generator(42))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(x) for x in generators}) == 1
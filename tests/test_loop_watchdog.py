@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+from benchmarks.replay import Replay, ReplayEvent, StubTransport
+
+
+@pytest.fixture
+def commands():
+    """Um comando que trava o event loop e um que não trava"""
+    @main.bot.command(name='teste_trava')
+    async def blocking(ctx):
+        time.sleep(0.3)
+        await ctx.send('travou')
+
+    @main.bot.command(name='teste_leve')
+    async def cheap(ctx):
+        await asyncio.sleep(0.05)
+        await ctx.send('ok')
+
+    yield
+    main.bot.remove_command('teste_trava')
+    main.bot.remove_command('teste_leve')
+
+
+@pytest.fixture
+def strict_watchdog(monkeypatch):
+    watchdog = main.LoopWatchdog(0.1, 0.15)
+    monkeypatch.setattr(main, 'WATCHDOG', watchdog)
+    watchdog.start(main.bot.loop)
+    yield watchdog
+    watchdog.stop()
+
+
+@pytest.fixture
+def replay():
+    replay = Replay(StubTransport(0), [], 0.1)
+    replay.install()
+    yield replay
+    main.bot.remove_listener(replay.on_command_error, 'on_command_error')
+
+
+def dispatch(run, replay, *messages):
+    async def each():
+        # Cada mensagem na sua task, como o discord.py faz com os eventos
+        for message in messages:
+            await asyncio.create_task(replay.dispatch(ReplayEvent(0, 1, 2, message, False)))
+        await main.OUTBOUND.drain()
+
+    run(each())
+
+
+def test_blocking_command_exceeds_the_budget(run, commands, strict_watchdog, replay):
+    errors = []
+
+    async def on_command_error(ctx, error):
+        errors.append(error)
+
+    main.bot.add_listener(on_command_error, 'on_command_error')
+    try:
+        dispatch(run, replay, '%teste_leve', '%teste_trava', '%teste_leve')
+    finally:
+        main.bot.remove_listener(on_command_error, 'on_command_error')
+    assert dict(replay.errors) == {'teste_trava LoopBudgetExceeded': 1}
+    (error,) = errors
+    assert isinstance(error, main.LoopBudgetExceeded)
+    assert str(error).startswith('teste_trava travou o event loop por ')
+    assert str(error).endswith('o orçamento é 150ms')
+
+
+def test_cheap_command_passes(run, commands, strict_watchdog, replay):
+    dispatch(run, replay, *['%teste_leve'] * 5)
+    assert not replay.errors
+    assert replay.latencies['teste_leve']
+
+
+def test_stall_below_budget_is_not_a_violation(run, commands, strict_watchdog, replay):
+    @main.bot.command(name='teste_quase')
+    async def almost(ctx):
+        time.sleep(0.05)
+        await ctx.send('ok')
+
+    try:
+        dispatch(run, replay, '%teste_quase', '%teste_leve')
+    finally:
+        main.bot.remove_command('teste_quase')
+    assert not replay.errors
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = main.SqliteSheetStore(tmp_path / 'fichas.db')
+    store.load()
+    monkeypatch.setattr(main, 'SHEET_STORE', store)
+    monkeypatch.setattr(main, 'MACRO_CACHE', OrderedDict())
+    monkeypatch.setattr(main, 'MACRO_CACHE_SIZE', 2)
+    yield store
+    store.close()
+
+
+def test_keeps_only_the_most_recent_macros(run, store):
+    for name in ['a', 'b', 'c']:
+        run(store.save_macro((1, 2, ''), name, ('força+briga', 'fome', '3')))
+        assert run(main.load_macro(1, 2, '', name)) is not None
+    assert list(main.MACRO_CACHE) == [(1, 2, '', 'b'), (1, 2, '', 'c')]
+
+    # Usar uma macro a coloca de volta no fim, a mais antiga é a próxima a sair
+    run(main.load_macro(1, 2, '', 'b'))
+    run(main.load_macro(1, 2, '', 'a'))
+    assert list(main.MACRO_CACHE) == [(1, 2, '', 'b'), (1, 2, '', 'a')]
+
+
+def test_evicted_macro_is_read_again(run, store):
+    run(store.save_macro((1, 2, ''), 'a', ('força+briga', 'fome', '3')))
+    first = run(main.load_macro(1, 2, '', 'a'))
+    main.MACRO_CACHE.clear()
+    assert run(main.load_macro(1, 2, '', 'a'))[0].display == first[0].display
+    assert run(main.load_macro(1, 2, '', 'nenhuma')) is None
+    assert list(main.MACRO_CACHE) == [(1, 2, '', 'a')]
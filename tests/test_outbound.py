@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+import main
+from benchmarks.fakes import FakeChannel, FakeMessage
+
+
+@pytest.fixture
+def queue():
+    return main.OutboundQueue(0.001, 2, (5, 0.05), (1000, 1.), 1000)
+
+
+def test_send_returns_the_sent_message(run, queue):
+    channel = FakeChannel()
+
+    async def send():
+        first = await queue.send(('canal', 1), channel.send, 'a')
+        second = await queue.send(('canal', 1), channel.send, 'b')
+        return await first, await second
+
+    first, second = run(send())
+    # As duas foram juntadas em um envio só
+    assert first is second is channel.sent[0]
+    assert first.content == 'a\nb'
+    run(queue.close())
+
+
+def test_send_error_reaches_the_future(run, queue):
+    async def broken(content, file=None):
+        raise RuntimeError('falhou')
+
+    async def send():
+        future = await queue.send(('canal', 1), broken, 'a')
+        await queue.drain()
+        return future
+
+    future = run(send())
+    with pytest.raises(RuntimeError):
+        future.result()
+    run(queue.close())
+
+
+def test_context_send_returns_a_future_with_the_message(run, monkeypatch):
+    sent = []
+
+    async def send(self, content=None, *, file=None, **kwargs):
+        sent.append(content)
+        return f'mensagem {len(sent)}'
+
+    monkeypatch.setattr(main.Context, 'send', send)
+    ctx = main.MetricsContext(prefix='%', message=FakeMessage(channel=FakeChannel()))
+
+    async def both():
+        queued = await ctx.send('oi')
+        direct = await ctx.send('direto', delete_after=1)
+        return await queued, direct
+
+    assert run(both()) == ('mensagem 2', 'mensagem 1')
+
+
+def test_idle_buckets_are_evicted(run, queue):
+    channel = FakeChannel()
+
+    async def burst(keys):
+        for key in keys:
+            await queue.send(('canal', key), channel.send, 'x')
+        await queue.drain()
+
+    run(burst(range(100)))
+    run(asyncio.sleep(0.06))
+    run(burst([1000]))
+    assert list(queue._buckets) == [('canal', 1000)]
+    run(queue.close())
+
+
+def test_busy_buckets_are_kept(run, queue):
+    channel = FakeChannel()
+
+    async def burst():
+        for _ in range(4):
+            await queue.send(('canal', 1), channel.send, 'x')
+            await queue.drain()
+        await queue.send(('canal', 2), channel.send, 'x')
+        await queue.drain()
+
+    run(burst())
+    assert set(queue._buckets) == {('canal', 1), ('canal', 2)}
+    run(queue.close())
+
+
+def test_close_stops_the_workers(run, queue):
+    channel = FakeChannel()
+
+    async def send_and_close():
+        for i in range(10):
+            await queue.send(('canal', i % 3), channel.send, str(i))
+        tasks = list(queue._tasks)
+        await queue.close()
+        return tasks
+
+    tasks = run(send_and_close())
+    assert len(channel.sent) == 3
+    assert all(task.done() for task in tasks)
+    # Depois de fechada a fila volta a funcionar com a próxima mensagem
+    assert run(run(queue.send(('canal', 0), channel.send, 'de novo'))).content == 'de novo'
+    run(queue.close())
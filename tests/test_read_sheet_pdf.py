@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+import main
+from benchmarks.pdfs import fillable_pdf, sheet_fields
+
+
+def read_with_get_fields(pdf_data: bytes):
+    """A leitura de antes do percurso do AcroForm, pelo getFields do PyPDF2"""
+    from io import BytesIO
+    from PyPDF2 import PdfFileReader
+    fields = PdfFileReader(BytesIO(pdf_data)).getFields()
+    sheet = {main.ALIAS[x]: 0 for x in main.DISCIPLINAS}
+    for field, qtd in main.IMPORTANT_FIELDS:
+        sheet_field = main.ALIAS[main.clean_text(field, True)]
+        sheet[sheet_field] = 0
+        for field_suffix in [''] + list(range(1, qtd)):
+            if fields[f'{field}{field_suffix}'].get(r'/V') == r'/Sim':
+                sheet[sheet_field] += 1
+    for displina_field_suffix, level_suffix in zip([''] + list(range(1, 6)), ['A', 'C', 'E', 'B', 'D', 'F']):
+        disciplina_name = fields[f'Nome da Disciplina{displina_field_suffix}'].get('/V')
+        if disciplina_name is None:
+            continue
+        cleaned_disciplina = main.clean_text(disciplina_name, True)
+        normalized_name = [x for x in main.DISCIPLINAS if x in cleaned_disciplina]
+        if len(normalized_name) != 1:
+            raise ValueError(f'Error in disciplina {disciplina_name} {cleaned_disciplina} {normalized_name}')
+        normalized_name = main.ALIAS[normalized_name[0]]
+        for power_suffix in [''] + list(range(1, 5)):
+            if fields[f'Poder{level_suffix}{power_suffix}'].get(r'/V') == r'/Sim':
+                sheet[normalized_name] += 1
+    return sheet
+
+
+def assert_same_reading(pdf_data: bytes):
+    try:
+        expected = read_with_get_fields(pdf_data)
+    except (KeyError, ValueError) as e:
+        with pytest.raises(type(e)):
+            main._read_sheet_from_pdf(pdf_data)
+    else:
+        assert main._read_sheet_from_pdf(pdf_data) == expected
+
+
+def fields_of(seed: int):
+    return sheet_fields(random.Random(seed))
+
+
+def is_power(name: str) -> bool:
+    return name.startswith('Poder')
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_random_sheets(seed):
+    assert_same_reading(fillable_pdf(random.Random(seed), extra_fields=seed % 3 * 10))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_empty_power_fields(seed):
+    fields = [(name, kind, None if is_power(name) else value) for name, kind, value in fields_of(seed)]
+    assert_same_reading(fillable_pdf(fields=fields))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_missing_power_fields_of_empty_disciplinas(seed):
+    fields = fields_of(seed)
+    values = {name: value for name, _, value in fields}
+    empty = [f'Poder{level}' for suffix, level in main.DISCIPLINA_FIELD_SUFFIXES
+             if values[f'Nome da Disciplina{suffix}'] is None]
+    fields = [x for x in fields if not x[0].startswith(tuple(empty))]
+    pdf_data = fillable_pdf(fields=fields)
+    assert main._read_sheet_from_pdf(pdf_data) == read_with_get_fields(pdf_data)
+
+
+def test_all_power_fields_missing_without_disciplinas():
+    fields = [(name, kind, None if name.startswith('Nome da Disciplina') else value)
+              for name, kind, value in fields_of(0) if not is_power(name)]
+    pdf_data = fillable_pdf(fields=fields)
+    sheet = main._read_sheet_from_pdf(pdf_data)
+    assert sheet == read_with_get_fields(pdf_data)
+    assert all(sheet[main.ALIAS[x]] == 0 for x in main.DISCIPLINAS)
+
+
+@pytest.mark.parametrize('missing', ['Força', 'Nome da Disciplina2', 'PoderA'])
+def test_missing_required_fields(missing):
+    # Todas as disciplinas preenchidas, então os poderes de todas são obrigatórios
+    fields = [(name, kind, b'(Potencia)' if name.startswith('Nome da Disciplina') else value)
+              for name, kind, value in fields_of(1) if name != missing]
+    pdf_data = fillable_pdf(fields=fields)
+    with pytest.raises(KeyError):
+        read_with_get_fields(pdf_data)
+    with pytest.raises(KeyError):
+        main._read_sheet_from_pdf(pdf_data)
+
+
+def test_repeated_fields_keep_the_last():
+    fields = fields_of(2)
+    overrides = [(name, kind, b'/Sim' if value == b'/Off' else b'/Off') for name, kind, value in fields
+                 if kind == b'/Btn'][::3]
+    pdf_data = fillable_pdf(fields=fields + overrides)
+    assert main._read_sheet_from_pdf(pdf_data) == read_with_get_fields(pdf_data)
+    assert main._read_sheet_from_pdf(pdf_data) != main._read_sheet_from_pdf(fillable_pdf(fields=fields))
+
+
+def test_queue_reads_in_processes_without_fork(run):
+    queue = main.PdfParseQueue(1, 5, 0)
+    assert queue._executor is None
+    pdf_data = fillable_pdf(random.Random(3))
+    try:
+        assert run(queue.parse(pdf_data)) == main._read_sheet_from_pdf(pdf_data)
+        assert queue._executor._mp_context.get_start_method() in ('forkserver', 'spawn')
+    finally:
+        queue._executor.shutdown(wait=True)
@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+import main
+from benchmarks.fakes import FakeContext
+
+
+def term(expression: str) -> main.DndTerm:
+    return main._dnd_term(main.DND_REGEX.fullmatch(expression))
+
+
+@pytest.mark.parametrize('expression', ['4d6!kh3', '4d6kh3!', '4d6kh3r<2!', '4d6!r<2kh3', '4d6r<2kh3!'])
+def test_modifiers_in_any_order(expression):
+    parsed = term(expression)
+    assert parsed.keep_high == 3
+    assert parsed.explode
+    assert parsed.minimo == (2 if 'r<' in expression else 1)
+
+
+def test_all_modifiers_in_reverse_order():
+    assert term('10d10>=8kl5kh2!r<3') == term('10d10r<3!kh2kl5>=8') == main.DndTerm(10, 10, 2, 5, 3, True, 8)
+
+
+def test_repeated_modifier_is_rejected():
+    with pytest.raises(ValueError, match='repetido'):
+        main._roll_dnd('4d6kh3kh2')
+
+
+@pytest.mark.parametrize('expression', ['4d6kh3!', '200000d6kl3!', '3d6>=5!kh2'])
+def test_trailing_explode_is_part_of_the_term(dice, expression):
+    result, final, steps = main._roll_dnd(expression)
+    assert '!' not in final
+    assert steps[0].texto == expression
+
+
+@pytest.mark.parametrize('rolagem', ['2d6+!', '2d6!!', '1d6**2', '1d6/0', '(1/0)d6'])
+def test_invalid_expression_replies_instead_of_raising(run, dice, rolagem):
+    ctx = FakeContext()
+
+    async def roll():
+        await main.roll_dnd(ctx, rolagem)
+        await main.OUTBOUND.drain()
+
+    run(roll())
+    assert [x.content.split('`')[0] for x in ctx.channel.sent] == ['Rolagem inválida ']
+
+
+def test_explode_keeps_highest_of_all_dice(dice):
+    for _ in range(50):
+        _, _, (step,) = main._roll_dnd('6d6!kh3')
+        results = step.results
+        assert len(results) == 6 + np.count_nonzero(results == 6)
+        assert sorted(step.final_result.tolist()) == sorted(results.tolist())[-3:]
+
+
+def test_explode_keeps_lowest_of_all_dice(dice):
+    for _ in range(50):
+        _, _, (step,) = main._roll_dnd('3d4!kl5')
+        results = step.results
+        assert len(results) == 3 + np.count_nonzero(results == 4)
+        assert sorted(step.final_result.tolist()) == sorted(results.tolist())[:5]
+
+
+def test_reroll_and_success_counting(dice):
+    for _ in range(50):
+        result, _, (step,) = main._roll_dnd('20d10r<5>=8')
+        assert step.results.min() >= 5
+        assert result == step.soma == np.count_nonzero(step.results >= 8)
+
+
+def test_reroll_up_to_max_face_always_succeeds(dice):
+    results, _, _ = main._roll_dnd_repetido('5d10r<10>=10', 50)
+    assert (results == 5).all()
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('3d6!', 3 * 3.5 * 6 / 5),
+    ('4d6!kh3', None),
+    ('2d6!kl3', None),
+    ('5d10!>=8', 5 * 0.3 * 10 / 9),
+    ('3d10r<4!kl2>=6', None),
+])
+def test_repeated_rolls_match_single_rolls(dice, expression, expected):
+    repeated = main._roll_dnd_repetido(expression, 50_000)[0].mean()
+    single = np.mean([main._roll_dnd(expression)[0] for _ in range(20_000)])
+    assert repeated == pytest.approx(single, rel=0.03)
+    if expected is not None:
+        assert repeated == pytest.approx(expected, rel=0.02)
+
+
+def test_aggregate_success_counting_matches_small_rolls(dice):
+    aggregate = np.mean([main._roll_dnd('1000d10!kh600>=8')[0] for _ in range(200)]) / 10
+    small = np.mean([main._roll_dnd('100d10!kh60>=8')[0] for _ in range(2000)])
+    assert aggregate == pytest.approx(small, rel=0.03)
+
+
+def test_dice_budget_covers_the_whole_expression(dice):
+    limit = main.DND_DICE_LIMIT
+    with pytest.raises(ValueError, match='limite'):
+        main._roll_dnd(f'{limit // 2}d6+{limit // 2 + 1}d6')
+    with pytest.raises(ValueError, match='limite'):
+        main._roll_dnd_repetido(f'{limit // 100}d6+1d6', 100)
+
+
+def test_explosions_count_against_the_budget(dice, monkeypatch):
+    monkeypatch.setattr(main, 'DND_DICE_LIMIT', 1000)
+    with pytest.raises(ValueError, match='limite'):
+        main._roll_dnd('999d2!')
+    with pytest.raises(ValueError, match='limite'):
+        main._roll_dnd_repetido('99d2!', 10)
+
+
+def test_explode_forever_is_rejected():
+    for expression in ['1d1!', '3d6!r<6']:
+        with pytest.raises(ValueError, match='para sempre'):
+            main._roll_dnd(expression)
+
+
+@pytest.mark.parametrize('repeticoes', [1, 3])
+def test_faces_beyond_int64_are_rejected(dice, repeticoes):
+    with pytest.raises(ValueError, match='faces acima do limite'):
+        main._roll_dnd_repetido('1d99999999999999999999', repeticoes)
+    assert main._roll_dnd_repetido(f'1d{main.DND_FACES_LIMIT}', repeticoes)[0].shape == (repeticoes,)
+
+
+@pytest.mark.parametrize('expression', ['1d6/(1d1-1)', '(1d1-1)/(1d1-1)'])
+def test_repeated_division_by_zero(dice, expression):
+    with pytest.raises(ValueError, match='Divisão por zero'):
+        main._roll_dnd(expression)
+    with pytest.raises(ValueError, match='Divisão por zero'):
+        main._roll_dnd_repetido(expression, 3)
+
+
+@pytest.mark.parametrize('expression', ['300d99999999999999999', '300d99999999999999999kh250',
+                                        '30d9223372036854775806'])
+def test_huge_sums_do_not_wrap(dice, expression):
+    result, _, (step,) = main._roll_dnd(expression)
+    # Com poucos dados a expressão final leva os dados formatados, então o resultado perde os últimos dígitos
+    assert result == pytest.approx(step.soma, rel=1e-5) and step.soma > 2 ** 63
+    results, _, (somas,) = main._roll_dnd_repetido(expression, 3)
+    assert all(x > 2 ** 63 for x in results) and list(results) == list(somas)
+
+
+def test_dnd_sum_matches_python_sum():
+    values = np.full(10, np.iinfo(np.int64).max - 1, dtype=np.int64)
+    assert main._dnd_sum(values, main.DND_FACES_LIMIT) == 10 * (2 ** 63 - 2)
+    assert main._dnd_sum(values[:1], main.DND_FACES_LIMIT) == 2 ** 63 - 2
+
+
+def test_compact_message_shortens_the_histogram(dice):
+    result, result_exp, steps = main._roll_dnd('1000d100+1000d99')
+    full = main._format_dnd_message(result, result_exp, steps)
+    compact = main._format_dnd_message(result, result_exp, steps, compact=True)
+    assert '100×' in full and '100×' not in compact
+    assert compact.count('…') == 2
+    assert len(compact) < len(full) // 5
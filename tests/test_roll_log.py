@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import main
+from benchmarks.fakes import FakeContext
+
+
+@pytest.fixture
+def roll_log(tmp_path, monkeypatch):
+    log = main.RollLog(tmp_path / 'rolagens.bin', 60)
+    monkeypatch.setattr(main, 'ROLL_LOG', log)
+    return log
+
+
+@pytest.mark.parametrize('args, rolls', [
+    (['1d6*99999999999999999999999'], 1),
+    (['1d6*99999999999999999999999', 'x3'], 3),
+    (['-1d6*99999999999999999999999', 'x2'], 2),
+])
+def test_huge_roll_replies_and_is_clamped_in_the_log(run, dice, roll_log, args, rolls):
+    ctx = FakeContext()
+
+    async def roll():
+        await main.roll_dnd(ctx, *args)
+        await main.OUTBOUND.drain()
+
+    run(roll())
+    assert len(ctx.channel.sent) == 1
+    assert 'inválida' not in ctx.channel.sent[0].content
+    (records,) = roll_log._pending
+    assert len(records) == rolls
+    limit = np.iinfo(np.int64)
+    assert all(abs(x) > 10 ** 18 for x in records['acertos'].tolist())
+    assert all(limit.min <= x <= limit.max for x in records['acertos'].tolist())
+
+
+def test_acertos_conversion():
+    values = main._roll_log_acertos([1.4, -2.6, np.inf, -np.inf, np.nan, 10 ** 30, -10 ** 400])
+    limit = main.ROLL_LOG_ACERTOS_LIMIT
+    assert values.tolist() == [1, -3, limit, -limit, 0, limit, -limit]
+    assert main._roll_log_acertos(3).tolist() == [3]
+
+
+def test_long_character_names_are_found(roll_log, run):
+    ctx = FakeContext()
+    names = ['personagem_com_um_nome_bem_comprido_1', 'personagem_com_um_nome_bem_comprido_2', 'curta', 'ação' * 6]
+    for i, name in enumerate(names):
+        roll_log.append(ctx, 'rcf', 1, 0, 0, i, 1, name)
+    roll_log.append(ctx, 'rcgrupo', 1, 0, 0, [7, 8], [1, 0], names[:2], [ctx.author.id] * 2)
+    run(roll_log.flush())
+    log = roll_log.read()
+    for i, name in enumerate(names):
+        rolls = main.select_rolls(log, ctx.guild.id, ctx.author.id, name)
+        assert rolls['acertos'].tolist() == [i] + ([7 + i] if i < 2 else [])
+    assert main.roll_log_character('curta') == b'curta'
+    assert len(main.roll_log_character(names[0])) == main.ROLL_LOG_CHARACTER_BYTES
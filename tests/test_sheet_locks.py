@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import main
+from benchmarks.fakes import FakeContext, FakeGuild, FakeUser
+
+
+@pytest.fixture
+def sqlite_store(tmp_path, monkeypatch):
+    store = main.SqliteSheetStore(tmp_path / 'fichas.db')
+    store.load()
+    monkeypatch.setattr(main, 'SHEET_STORE', store)
+    return store
+
+
+def test_hold_many_takes_stripes_in_order(run):
+    locks = main.SheetLocks(4, 1.0)
+    players = [(1, user) for user in range(40)]
+
+    async def writer(order):
+        for _ in range(20):
+            async with locks.hold_many(order):
+                await asyncio.sleep(0)
+
+    async def both():
+        await asyncio.wait_for(asyncio.gather(writer(players), writer(players[::-1])), 5)
+
+    run(both())
+    assert not any(lock.locked() for lock in locks._locks)
+
+
+def test_rcgrupo_waits_for_the_players_lock(run, dice, sqlite_store):
+    guild, player = FakeGuild(), FakeUser()
+    run(sqlite_store.save_many([((guild.id, player.id, f'ficha{i}'), {'fome': 1}) for i in range(20)]))
+    ctx = FakeContext(guild, FakeUser())
+
+    async def concurrent():
+        async with main.SHEET_LOCKS.hold(guild.id, player.id):
+            task = asyncio.create_task(main.rouse_check_group(ctx))
+            await asyncio.sleep(0.2)
+            assert not task.done()
+            fome = await sqlite_store.get((guild.id, player.id, 'ficha0'), 'fome')
+        await task
+        await main.OUTBOUND.drain()
+        return fome
+
+    assert run(concurrent()) == 1
+    assert 'ganharam fome' in ctx.channel.sent[-1].content
+
+
+def test_sqlite_increment_many_missing_sheet(run, sqlite_store):
+    keys = [(1, 2, 'a'), (1, 2, 'b')]
+    run(sqlite_store.save_many([(keys[0], {'fome': 1})]))
+    with pytest.raises(KeyError):
+        run(sqlite_store.increment_many(keys, 'fome', [1, 1]))
+    # A ficha que existia não fica com a escrita pela metade
+    assert run(sqlite_store.get(keys[0], 'fome')) == 1
+    assert run(sqlite_store.increment_many(keys[:1], 'fome', [2])) == [3]
@@ -0,0 +1,164 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+ATTRS = ['fome', 'força', 'vontade']
+
+
+@pytest.fixture
+def colliding(monkeypatch):
+    """Todas as chaves de um mesmo servidor caem no mesmo hash"""
+    monkeypatch.setattr(main, 'sheet_key_hash', lambda guild, user, code: guild % 3)
+    monkeypatch.setattr(main, 'sheet_key_hashes',
+                        lambda guilds, users, codes: (guilds % 3).astype(np.int64))
+
+
+def filled(count, recent_limit=8, capacity=4):
+    table = main.SheetTable(ATTRS, capacity)
+    table.recent_limit = recent_limit
+    for i in range(count):
+        table.put((i % 5, i, f'ficha{i % 7}'), {'fome': i % 6, 'força': i % 251, 'vontade': i})
+    return table
+
+
+def check_filled(table, count):
+    assert len(table) == count
+    for i in range(count):
+        key = (i % 5, i, f'ficha{i % 7}')
+        assert key in table
+        assert table.get_many([(key, x) for x in ATTRS]) == [i % 6, i % 251, i]
+
+
+@pytest.mark.parametrize('count', [0, 1, 7, 8, 9, 100, 1000])
+def test_growth_across_resizes_and_index_merges(count):
+    table = filled(count)
+    check_filled(table, count)
+    assert len(table.guilds) >= count
+
+
+@pytest.mark.parametrize('count', [3, 50, 300])
+def test_hash_collisions(colliding, count):
+    table = filled(count)
+    check_filled(table, count)
+    assert len(np.unique(table._hashes)) <= 3
+    key = (1, 1, 'ficha1')
+    assert table.increment(key, 'fome', 2) == 3
+    assert table.set(key, 'vontade', -5)
+    assert table.get_many([(key, 'fome'), (key, 'vontade')]) == [3, -5]
+
+
+def test_missing_keys():
+    table = filled(50)
+    missing = [(0, 0, 'nenhuma'), (0, 1, 'ficha0'), (99, 0, 'ficha0'), (1, 1, 'ficha2')]
+    for key in missing:
+        assert key not in table
+        with pytest.raises(KeyError):
+            table.get(key, 'fome')
+        with pytest.raises(KeyError):
+            table.get_many([((0, 0, 'ficha0'), 'fome'), (key, 'fome')])
+        assert not table.set(key, 'fome', 1)
+        assert table.increment(key, 'fome', 1) is None
+    before = table.snapshot().to_frame()
+    with pytest.raises(KeyError):
+        table.increment_many([(0, 0, 'ficha0'), missing[1]], 'fome', [1, 1])
+    pd.testing.assert_frame_equal(table.snapshot().to_frame(), before)
+
+
+def test_missing_key_colliding_with_existing(colliding):
+    # Não existe remoção de fichas, então a chave "apagada" é uma que nunca entrou mas tem o hash de uma que existe
+    table = filled(30)
+    existing, missing = (1, 1, 'ficha1'), (1, 1, 'ficha2')
+    assert main.sheet_key_hash(*existing[:2], 0) == main.sheet_key_hash(*missing[:2], 0)
+    assert existing in table and missing not in table
+    with pytest.raises(KeyError):
+        table.get(missing, 'fome')
+    assert table.increment(missing, 'fome', 1) is None
+    assert table.get(existing, 'fome') == 1
+
+
+def test_snapshot_is_frozen():
+    table = filled(20, capacity=20)
+    snapshot = table.snapshot()
+    frozen = snapshot.to_frame().copy()
+    arrays = [snapshot.guilds.copy(), snapshot.users.copy(), snapshot.characters.copy(),
+              {attr: column.copy() for attr, column in snapshot.columns.items()}]
+
+    key = (0, 0, 'ficha0')
+    table.set(key, 'fome', 5)
+    table.increment((1, 1, 'ficha1'), 'força', 3)
+    table.increment_many([key, (2, 2, 'ficha2')], 'vontade', [1, 1])
+    # Alarga a coluna de uint8 para tipos maiores
+    table.set(key, 'força', 1000)
+    table.set(key, 'vontade', -70000)
+    table.put((9, 9, 'nova'), {'fome': 2, 'humanidade': 7})
+    table.reserve(10_000)
+    table.put((3, 3, 'ficha3'), {'fome': 4})
+
+    assert snapshot.guilds.tolist() == arrays[0].tolist()
+    assert snapshot.users.tolist() == arrays[1].tolist()
+    assert snapshot.characters.tolist() == arrays[2].tolist()
+    assert snapshot.columns.keys() == arrays[3].keys()
+    for attr, column in arrays[3].items():
+        assert snapshot.columns[attr].tolist() == column.tolist()
+    pd.testing.assert_frame_equal(snapshot.to_frame(), frozen)
+
+    assert table.get(key, 'força') == 1000
+    assert table.get(key, 'vontade') == -70000
+    assert table.get((9, 9, 'nova'), 'humanidade') == 7
+    assert table.get((3, 3, 'ficha3'), 'força') == 0
+
+
+def test_new_snapshot_sees_writes_without_touching_old():
+    table = filled(10)
+    first = table.snapshot()
+    table.set((0, 0, 'ficha0'), 'fome', 4)
+    second = table.snapshot()
+    table.set((0, 0, 'ficha0'), 'fome', 5)
+    assert [x.columns['fome'][0] for x in (first, second, table.snapshot())] == [0, 4, 5]
+
+
+def test_csv_round_trip_matches_pandas(tmp_path):
+    path = tmp_path / 'fichas.csv'
+    columns = [x for x in main.SHEET_COLUMNS if x not in ATTRS][:3] + ATTRS
+    rows = [
+        (1, 10, '', 0, 1, 2, 3, 4, 5),
+        (1, 10, 'ficha2', 255, 256, -1, 70000, 0, 0),
+        (2**40, 2**62, 'Ação ç', -2**40, 0, 0, 0, 0, 1),
+        (2, 11, 'NA', 1, 1, 1, 1, 1, 1),
+        (2, 11, 'null', 0, 0, 0, 0, 0, 0),
+    ]
+    baseline = pd.DataFrame(rows, columns=['guild', 'user', 'character'] + columns)
+    baseline.set_index(['guild', 'user', 'character']).to_csv(path)
+
+    df = main.read_sheets_csv(path)
+    expected = io.StringIO()
+    df.to_csv(expected)
+
+    table = main.SheetTable.from_frame(df, list(df.columns))
+    written = io.StringIO()
+    table.snapshot().to_csv(written)
+    assert written.getvalue() == expected.getvalue() == path.read_text()
+    pd.testing.assert_frame_equal(table.snapshot().to_frame(), df, check_dtype=False)
+
+    reloaded = main.SheetTable.from_frame(pd.read_csv(io.StringIO(written.getvalue()),
+                                                      index_col=['guild', 'user', 'character'],
+                                                      keep_default_na=False), list(df.columns))
+    pd.testing.assert_frame_equal(reloaded.snapshot().to_frame(), df, check_dtype=False)
+
+
+def test_new_rows_do_not_copy_shared_columns():
+    table = filled(10, capacity=20)
+    snapshot = table.snapshot()
+    table.put((9, 9, 'nova'), {'fome': 2, 'força': 3, 'vontade': 4})
+    for attr in ATTRS:
+        assert np.shares_memory(table.columns[attr], snapshot.columns[attr])
+    assert table.get((9, 9, 'nova'), 'vontade') == 4
+    assert len(snapshot.to_frame()) == 10
+    # A primeira alteração de uma linha que o snapshot enxerga ainda copia a coluna
+    table.set((0, 0, 'ficha0'), 'fome', 5)
+    assert not np.shares_memory(table.columns['fome'], snapshot.columns['fome'])
+    assert snapshot.columns['fome'][0] == 0
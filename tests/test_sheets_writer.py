@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+def failing_snapshot():
+    raise MemoryError('sem memória para a cópia')
+
+
+def test_failed_snapshot_keeps_the_changes(run, tmp_path):
+    writer = main.SheetsWriter(tmp_path / 'fichas.csv', failing_snapshot, 60, 100)
+    writer.mark_dirty()
+    writer.mark_dirty()
+    with pytest.raises(MemoryError):
+        run(writer.flush())
+    assert writer.dirty == 2
+
+    writer.snapshot = lambda: pd.DataFrame({'fome': [1]})
+    run(writer.flush())
+    assert writer.dirty == 0
+    assert (tmp_path / 'fichas.csv').exists()
+
+
+def test_failed_write_keeps_the_changes(run, tmp_path):
+    writer = main.SheetsWriter(tmp_path / 'nao_existe' / 'fichas.csv', lambda: pd.DataFrame({'fome': [1]}), 60, 100)
+    writer.mark_dirty()
+    with pytest.raises(OSError):
+        run(writer.flush())
+    assert writer.dirty == 1
@@ -0,0 +1,84 @@
+import struct
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import main
+from benchmarks.fakes import FakeAttachment
+
+PDF = b'%PDF-1.4\n' + b'0' * 1000
+
+
+def make_zip(files, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    out = BytesIO()
+    with zipfile.ZipFile(out, 'w', compression) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return out.getvalue()
+
+
+def patch_headers(data: bytes, local_offset: int, central_offset: int, fmt: str, value: int) -> bytes:
+    """Troca um campo no cabeçalho local e no diretório central do primeiro arquivo do zip"""
+    data = bytearray(data)
+    central = data.index(b'PK\x01\x02')
+    struct.pack_into(fmt, data, local_offset, value)
+    struct.pack_into(fmt, data, central + central_offset, value)
+    return bytes(data)
+
+
+def import_errors(run, data: bytes):
+    pdfs, errors = run(main._bulk_import_files([FakeAttachment(data, 'fichas.zip')]))
+    assert not pdfs
+    return [reason for _, reason in errors]
+
+
+def test_reads_the_pdfs(run):
+    data = make_zip([('a.pdf', PDF), ('pasta/b.PDF', PDF), ('__MACOSX/._a.pdf', b'x'), ('leia.txt', b'x')])
+    pdfs, errors = run(main._bulk_import_files([FakeAttachment(data, 'fichas.zip')]))
+    assert pdfs == [('a.pdf', PDF), ('b.PDF', PDF)]
+    assert not errors
+
+
+def test_password_protected(run):
+    # Só o bit de criptografia nos cabeçalhos já faz o zipfile pedir a senha
+    data = patch_headers(make_zip([('a.pdf', PDF)], zipfile.ZIP_STORED), 6, 8, '<H', 0x1)
+    assert import_errors(run, data) == ['zip inválido: protegido por senha']
+
+
+def test_unsupported_compression(run):
+    data = patch_headers(make_zip([('a.pdf', PDF)], zipfile.ZIP_STORED), 8, 10, '<H', 97)
+    assert import_errors(run, data) == ['zip inválido: compressão ou criptografia não suportada']
+
+
+def test_corrupted_data(run):
+    data = bytearray(make_zip([('a.pdf', PDF * 10)]))
+    start = 30 + len('a.pdf')
+    data[start:start + 20] = b'\xff' * 20
+    assert [x.split(':')[0] for x in import_errors(run, bytes(data))] == ['zip inválido']
+
+
+def test_too_big_uncompressed(run, monkeypatch):
+    monkeypatch.setattr(main, 'ZIP_PDF_MAX_BYTES', 10_000)
+    read = []
+    monkeypatch.setattr(zipfile.ZipFile, 'read', lambda self, name, pwd=None: read.append(name))
+    errors = import_errors(run, make_zip([('a.pdf', PDF), ('b.pdf', b'0' * 10_001)]))
+    assert errors == ['zip inválido: b.pdf passa de 0MB descompactado']
+    assert not read
+
+
+def test_too_big_in_total(run, monkeypatch):
+    monkeypatch.setattr(main, 'ZIP_TOTAL_MAX_BYTES', 5000)
+    errors = import_errors(run, make_zip([(f'{i}.pdf', PDF) for i in range(5)]))
+    assert errors == ['zip inválido: os PDFs passam de 0MB descompactados']
+
+
+def test_declared_size_smaller_than_data(run):
+    # O zipfile para no tamanho declarado, o resto dos dados nunca chega a ser descompactado
+    data = patch_headers(make_zip([('a.pdf', b'0' * 1_000_000)]), 22, 24, '<I', 100)
+    assert [x.split(':')[0] for x in import_errors(run, data)] == ['zip inválido']
+
+
+@pytest.mark.parametrize('data', [b'nada de zip', make_zip([('a.pdf', PDF)])[:-30]])
+def test_not_a_zip(run, data):
+    assert [x.split(':')[0] for x in import_errors(run, data)] == ['zip inválido']